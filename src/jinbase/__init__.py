@@ -1,21 +1,24 @@
 """The main module of Jinbase."""
+import re
 from datetime import datetime, timezone
 from paradict import TypeRef
 from litedbc import LiteDBC, TransactionMode
 from jinbase import errors, queries, misc, const
 from jinbase.store import RecordInfo
-from jinbase.store.depot import Depot
+from jinbase.store.depot import Depot, RetentionPolicy
 from jinbase.store.kv import Kv
-from jinbase.store.queue import Queue
+from jinbase.store.queue import Queue, Lease
 from jinbase.store.stack import Stack
 from jinbase.const import (Model, TimestampPrecision, TIMESTAMP_PRECISION,
                            TIMEOUT, CHUNK_SIZE, JINBASE_HOME, JINBASE_VERSION,
-                           USER_HOME, DATETIME_FORMAT)
+                           USER_HOME, DATETIME_FORMAT, KV_CACHE_SIZE,
+                           INLINE_SIZE, KV_FILTER, RETENTION_LOCK_TIME)
 
 
-__all__ = ["Jinbase", "Model", "TypeRef", "RecordInfo",
-           "TimestampPrecision", "TIMEOUT", "CHUNK_SIZE",
-           "TIMESTAMP_PRECISION", "DATETIME_FORMAT",
+__all__ = ["Jinbase", "Model", "TypeRef", "RecordInfo", "RetentionPolicy",
+           "Lease", "TimestampPrecision", "TIMEOUT", "CHUNK_SIZE",
+           "TIMESTAMP_PRECISION", "DATETIME_FORMAT", "KV_CACHE_SIZE",
+           "INLINE_SIZE", "KV_FILTER", "RETENTION_LOCK_TIME",
            "USER_HOME", "JINBASE_HOME", "JINBASE_VERSION"]
 
 
@@ -25,7 +28,10 @@ class Jinbase:
     def __init__(self, filename=None, *, auto_create=True,
                  is_readonly=False, timeout=TIMEOUT,
                  type_ref=None, chunk_size=CHUNK_SIZE,
-                 timestamp_precision=TIMESTAMP_PRECISION):
+                 timestamp_precision=TIMESTAMP_PRECISION,
+                 kv_cache_size=KV_CACHE_SIZE, inline_size=INLINE_SIZE,
+                 kv_filter=KV_FILTER,
+                 retention_lock_time=RETENTION_LOCK_TIME):
         """
         Init.
 
@@ -45,10 +51,28 @@ class Jinbase:
         - timestamp_precision: An instance of the `jinbase.TimestampPrecision` namedtuple.
             Defaults to `jinbase.TIMESTAMP_PRECISION`.
             Note that this value is only relevant when the Jinbase tables are created.
+        - kv_cache_size: Byte budget of the LRU cache of decoded values
+            kept by the Kv store. Defaults to `jinbase.KV_CACHE_SIZE`,
+            that is, 0 to disable the cache.
+        - inline_size: Values whose serialized size in bytes doesn't exceed
+            this threshold are stored inline in their record row instead of
+            the data table. Defaults to `jinbase.INLINE_SIZE`. The effective
+            threshold is capped by the chunk size, and 0 disables inlining.
+        - kv_filter: Boolean to tell whether the Kv store should keep an
+            in-memory Bloom filter of its keys, so that most lookups of
+            nonexistent keys skip the database. Defaults to `jinbase.KV_FILTER`.
+        - retention_lock_time: Max seconds a write transaction that enforces
+            the retention policy of the Depot store holds the write lock.
+            Defaults to `jinbase.RETENTION_LOCK_TIME`.
         """
         self._dbc = create_dbc(filename, auto_create, is_readonly, timeout)
-        with self._dbc.cursor() as cur:
-            cur.executescript(queries.INIT_SCRIPT)
+        if self._dbc.is_readonly:
+            # tables can't be created through a readonly connection
+            check_jinbase(self._dbc)
+        else:
+            with self._dbc.cursor() as cur:
+                cur.executescript(queries.INIT_SCRIPT)
+            upgrade_jinbase(self._dbc)
         chunk_size = int(chunk_size) if chunk_size else CHUNK_SIZE
         x = ensure_jinbase(self._dbc, chunk_size,
                            TimestampPrecision(timestamp_precision))
@@ -59,9 +83,15 @@ class Jinbase:
         self._is_readonly = self._dbc.is_readonly
         self._timeout = self._dbc.timeout
         self._type_ref = TypeRef() if type_ref is None else type_ref
+        self._kv_cache_size = kv_cache_size
+        self._inline_size = int(inline_size) if inline_size else 0
+        self._kv_filter = bool(kv_filter)
+        self._retention_lock_time = retention_lock_time
         # stores
-        self._kv = Kv(self)
-        self._depot = Depot(self)
+        self._kv = Kv(self, cache_size=kv_cache_size,
+                      use_filter=self._kv_filter)
+        self._kv_buckets = dict()
+        self._depot = Depot(self, retention_lock_time=retention_lock_time)
         self._queue = Queue(self)
         self._stack = Stack(self)
 
@@ -105,6 +135,22 @@ class Jinbase:
     def timestamp_precision(self):
         return self._timestamp_precision
 
+    @property
+    def kv_cache_size(self):
+        return self._kv_cache_size
+
+    @property
+    def inline_size(self):
+        return self._inline_size
+
+    @property
+    def kv_filter(self):
+        return self._kv_filter
+
+    @property
+    def retention_lock_time(self):
+        return self._retention_lock_time
+
     @property
     def dbc(self):
         """The instance of litedbc.LiteDBC"""
@@ -283,14 +329,101 @@ class Jinbase:
         points to the same database file"""
         return self.__copy__()
 
+    def kv_bucket(self, name):
+        """
+        Get a named Kv bucket, created if it doesn't exist yet.
+        Each bucket is backed by its own tables, therefore its scans
+        never touch the pages of other buckets and dropping it is
+        a table drop.
+        Note that a bucket can't be created inside a transaction.
+
+        [params]
+        - name: Bucket name made of 1 to 64 ASCII letters, digits,
+            and underscores
+
+        [return]
+        Returns a Kv instance
+        """
+        with self._dbc.write_lock:
+            try:
+                return self._kv_buckets[name]
+            except KeyError as e:
+                pass
+            kv = Kv(self, cache_size=self._kv_cache_size,
+                    use_filter=self._kv_filter, bucket=name)
+            if not self.has_kv_bucket(name):
+                if self._is_readonly:
+                    msg = "Nonexistent bucket '{}'".format(name)
+                    raise Exception(msg)
+                self._create_kv_bucket(kv)
+            self._kv_buckets[name] = kv
+            return kv
+
+    def kv_buckets(self):
+        """Returns the sorted tuple of the names of Kv buckets"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_KV_BUCKETS)  # read
+            return tuple(row[0] for row in cur.fetch())
+
+    def has_kv_bucket(self, name):
+        """Returns True if the Kv bucket exists, else False"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.HAS_KV_BUCKET, (name, ))  # read
+            return cur.fetchone()[0] > 0
+
+    def drop_kv_bucket(self, name):
+        """
+        Drop a Kv bucket along with its tables.
+        Note that a bucket can't be dropped inside a transaction.
+
+        [params]
+        - name: The bucket name
+
+        [return]
+        Returns False if the bucket doesn't exist, else True
+        """
+        with self._dbc.write_lock:
+            if not self.has_kv_bucket(name):
+                return False
+            if self._dbc.in_transaction:
+                msg = "A bucket can't be dropped inside a transaction"
+                raise Exception(msg)
+            kv = self._kv_buckets.pop(name, None)
+            if kv is None:
+                kv = Kv(self, bucket=name)
+            kv.stop_reaper()
+            script = queries.DROP_KV_SCRIPT.format(model=kv.model_name,
+                                                   name=name)
+            with self._dbc.immediate_transaction() as cursor:
+                cursor.executescript(script)  # write
+            return True
+
     def close(self):
         """Close the connection"""
+        self._stop_reapers()
         return self._dbc.close()
 
     def destroy(self):
         """Destroy the database file"""
+        self._stop_reapers()
         return self._dbc.destroy()
 
+    def _create_kv_bucket(self, kv):
+        if self._dbc.in_transaction:
+            msg = "A bucket can't be created inside a transaction"
+            raise Exception(msg)
+        script = "".join((queries.KV_SCRIPT.format(model=kv.model_name),
+                          queries.KV_UPGRADE_SCRIPT.format(model=kv.model_name),
+                          queries.ADD_KV_BUCKET.format(name=kv.bucket,
+                                                       created_at=self.now())))
+        with self._dbc.immediate_transaction() as cursor:
+            cursor.executescript(script)  # write
+
+    def _stop_reapers(self):
+        self._kv.stop_reaper()
+        for kv in self._kv_buckets.values():
+            kv.stop_reaper()
+
     def __enter__(self):
         return self
 
@@ -300,7 +433,11 @@ class Jinbase:
     def __copy__(self):
         return Jinbase(self._filename, auto_create=self._auto_create,
                        is_readonly=self._is_readonly, timeout=self._timeout,
-                       type_ref=self._type_ref, chunk_size=self._chunk_size)
+                       type_ref=self._type_ref, chunk_size=self._chunk_size,
+                       kv_cache_size=self._kv_cache_size,
+                       inline_size=self._inline_size,
+                       kv_filter=self._kv_filter,
+                       retention_lock_time=self._retention_lock_time)
 
 
 def create_dbc(filename, auto_create, is_readonly, timeout):
@@ -314,6 +451,54 @@ def create_dbc(filename, auto_create, is_readonly, timeout):
     return dbc
 
 
+def upgrade_jinbase(dbc):
+    """Add the columns introduced by newer versions of Jinbase
+    to the tables of a database created by a previous version"""
+    with dbc.immediate_transaction() as cursor:
+        for table, column, definition in queries.ADDED_COLUMNS:
+            cursor.execute(queries.GET_TABLE_COLUMNS.format(table=table))
+            columns = {row[1] for row in cursor.fetchall()}
+            if column in columns:
+                continue
+            sql = queries.ADD_COLUMN.format(table=table, column=column,
+                                            definition=definition)
+            cursor.execute(sql)
+            backfill = queries.BACKFILL_QUERIES.get((table, column))
+            if backfill:
+                cursor.execute(backfill)
+    with dbc.cursor() as cur:
+        cur.executescript(queries.UPGRADE_SCRIPT)
+
+
+def check_jinbase(dbc):
+    """Make sure that a database opened in readonly mode has the
+    tables and columns of this version of Jinbase"""
+    with dbc.cursor() as cur:
+        cur.execute(queries.GET_TABLE_NAMES)
+        tables = {row[0] for row in cur.fetchall()}
+    if "jinbase_info" not in tables:
+        msg = "Not a Jinbase file."
+        raise Exception(msg)
+    required_tables = re.findall(r"CREATE TABLE IF NOT EXISTS (\w+)",
+                                 queries.INIT_SCRIPT)
+    missing_tables = [table for table in required_tables
+                      if table not in tables]
+    if missing_tables:
+        msg = ("The database needs an upgrade (missing tables: {}). "
+               "Open it once in read-write mode.").format(", ".join(missing_tables))
+        raise Exception(msg)
+    missing_columns = list()
+    with dbc.cursor() as cur:
+        for table, column, _ in queries.ADDED_COLUMNS:
+            cur.execute(queries.GET_TABLE_COLUMNS.format(table=table))
+            if column not in {row[1] for row in cur.fetchall()}:
+                missing_columns.append("{}.{}".format(table, column))
+    if missing_columns:
+        msg = ("The database needs an upgrade (missing columns: {}). "
+               "Open it once in read-write mode.").format(", ".join(missing_columns))
+        raise Exception(msg)
+
+
 def ensure_jinbase(dbc, chunk_size, timestamp_precision):
     sql = queries.GET_JINBASE_INFO
     if dbc.is_readonly:
@@ -10,7 +10,7 @@ class Blob:
     """The Blob class allows a Read access to the blobs of Jinbase records.
     This class isn't intended to be directly instantiated by the user."""
     def __init__(self, store, record_id, n_bytes,
-                 n_chunks):
+                 n_chunks, chunk_ids=None, inline=None):
         """
         Initialization.
 
@@ -19,13 +19,20 @@ class Blob:
         - record_id: The record's uid.
         - n_bytes: The size of the blob in bytes.
         - n_chunks: The number of chunks.
+        - chunk_ids: Optional sequence of the ids of the chunks, in order.
+            When it isn't provided, chunk ids are looked up on demand.
+        - inline: Boolean to tell whether the data is stored inline in the
+            record row, as a single chunk. Looked up on demand when it
+            isn't provided.
         """
         self._store = store
         self._record_id = record_id
         self._n_bytes = n_bytes
         self._n_chunks = n_chunks
+        self._chunk_ids = chunk_ids
+        self._inline = inline
         self._dbc = store.dbc
-        self._model_name = store.model.name.lower()
+        self._model_name = store.model_name
         self._chunk_size = store.chunk_size
         self._position = 0
         self._slice_obj = slice(0, 0, 1)
@@ -81,7 +88,7 @@ class Blob:
                 pass
 
     def _read(self, position, length):
-        if length == 0 or position == self._n_chunks:
+        if length == 0 or position == self._n_bytes:
             return b''
         elif length < -1:
             msg = "Invalid length."
@@ -106,20 +113,39 @@ class Blob:
         try:
             blob_io_file = self._blob_io_files[chunk_index]
         except KeyError as e:
-            with self._dbc.cursor() as cur:
-                sql = queries.GET_CHUNK_ID.format(model=self._model_name,
-                                                  offset=chunk_index)
-                cur.execute(sql, (self._record_id,))
-                r = cur.fetchone()
-                if r is None:
-                    msg = "Failed to get 'chunk_id' for record {}".format(self._record_id)
-                    raise Exception(msg)
-                chunk_id = r[0]
+            if self._is_inline():
+                table_name = "jinbase_{}_record".format(self._model_name)
+                blob_io_file = self._dbc.blobopen(table_name, "payload",
+                                                  self._record_id)
+            else:
+                chunk_id = self._get_chunk_id(chunk_index)
                 table_name = "jinbase_{}_data".format(self._model_name)
                 blob_io_file = self._dbc.blobopen(table_name, "chunk", chunk_id)
-                self._blob_io_files[chunk_index] = blob_io_file
+            self._blob_io_files[chunk_index] = blob_io_file
         return blob_io_file
 
+    def _is_inline(self):
+        if self._inline is None:
+            with self._dbc.cursor() as cur:
+                sql = queries.GET_RECORD_PAYLOAD.format(model=self._model_name)
+                cur.execute(sql, (self._record_id,))
+                r = cur.fetchone()
+                self._inline = r is not None and r[0] is not None
+        return self._inline
+
+    def _get_chunk_id(self, chunk_index):
+        if self._chunk_ids is not None:
+            return self._chunk_ids[chunk_index]
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_CHUNK_ID.format(model=self._model_name,
+                                              offset=chunk_index)
+            cur.execute(sql, (self._record_id,))
+            r = cur.fetchone()
+            if r is None:
+                msg = "Failed to get 'chunk_id' for record {}".format(self._record_id)
+                raise Exception(msg)
+            return r[0]
+
     def _get_chunk(self, blob_slice):
         chunk_index, slice_obj = blob_slice
         if chunk_index == self._n_chunks:
@@ -157,7 +183,7 @@ def get_blob_slices(start_index, stop_index, chunk_size):
     if start_index == stop_index:
         return ((chunk_index_1, slice(sub_index_2, sub_index_2 + 1)), )
     if chunk_index_1 == chunk_index_2:
-        return ((chunk_index_1, slice(start_index, stop_index+1)), )
+        return ((chunk_index_1, slice(sub_index_1, sub_index_2+1)), )
     blob_slices.append((chunk_index_1, slice(sub_index_1, chunk_size)))
     chunk_index = chunk_index_1
     for i in range(chunk_index_2-chunk_index_1-1):
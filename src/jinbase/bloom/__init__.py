@@ -0,0 +1,117 @@
+"""The BloomFilter class is defined here."""
+import math
+import hashlib
+from collections import namedtuple
+
+
+__all__ = ["BloomFilter", "FilterInfo"]
+
+
+FilterInfo = namedtuple("FilterInfo",
+                        ("n_items", "capacity", "n_bits", "n_hashes",
+                         "hits", "skips"))
+FilterInfo.__doc__ = """\
+Named tuple returned by BloomFilter.info()
+
+[params]
+n_items: Number of distinct added keys (approximate)
+capacity: Number of keys the filter is sized for
+n_bits: Size of the bit array
+n_hashes: Number of bits set per key
+hits: Number of lookups that found that the key may exist
+skips: Number of lookups that found that the key doesn't exist
+"""
+
+
+class BloomFilter:
+    """In-memory Bloom filter of integer and string keys.
+    A lookup either tells that a key doesn't exist or that it
+    may exist. Keys can't be removed.
+    This class isn't intended to be directly instantiated by the user."""
+    def __init__(self, capacity, error_rate):
+        """
+        Init.
+
+        [params]
+        - capacity: Number of keys the filter is sized for. Beyond it,
+            the false positive rate grows above `error_rate`.
+        - error_rate: Expected false positive rate, between 0 and 1
+        """
+        self._capacity = max(int(capacity), 1)
+        self._error_rate = float(error_rate)
+        if not 0 < self._error_rate < 1:
+            msg = "The error rate should be between 0 and 1"
+            raise ValueError(msg)
+        n_bits = -self._capacity * math.log(self._error_rate) / math.log(2) ** 2
+        self._n_bits = max(int(math.ceil(n_bits)), 8)
+        n_hashes = self._n_bits / self._capacity * math.log(2)
+        self._n_hashes = max(int(round(n_hashes)), 1)
+        self._bits = bytearray((self._n_bits + 7) // 8)
+        self._n_items = 0
+        self._hits = 0
+        self._skips = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def error_rate(self):
+        return self._error_rate
+
+    @property
+    def n_items(self):
+        return self._n_items
+
+    def add(self, key):
+        """
+        Add an integer or string key.
+
+        [return]
+        Returns False if the key was probably already added, else True.
+        Only new keys are counted in `n_items`.
+        """
+        bits = self._bits
+        is_new = False
+        for position in self._get_positions(key):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                is_new = True
+        if is_new:
+            self._n_items += 1
+        return is_new
+
+    def update(self, keys):
+        """Add many keys"""
+        for key in keys:
+            self.add(key)
+
+    def info(self):
+        """Returns a FilterInfo namedtuple"""
+        return FilterInfo(n_items=self._n_items, capacity=self._capacity,
+                          n_bits=self._n_bits, n_hashes=self._n_hashes,
+                          hits=self._hits, skips=self._skips)
+
+    def _get_positions(self, key):
+        if isinstance(key, int):
+            data = b"i" + str(key).encode()
+        else:
+            data = b"s" + key.encode("utf-8", "surrogatepass")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        # double hashing
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self._n_bits for i in range(self._n_hashes))
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._get_positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                self._skips += 1
+                return False
+        self._hits += 1
+        return True
+
+    def __len__(self):
+        return self._n_items
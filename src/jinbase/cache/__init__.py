@@ -0,0 +1,131 @@
+"""The LruCache class is defined here."""
+import copy
+import threading
+from collections import OrderedDict, namedtuple
+from paradict import Datatype
+
+
+__all__ = ["LruCache", "CacheInfo"]
+
+
+CacheInfo = namedtuple("CacheInfo",
+                       ("hits", "misses", "n_items", "n_bytes", "max_bytes"))
+CacheInfo.__doc__ = """\
+Named tuple returned by LruCache.info()
+
+[params]
+hits: Number of lookups that found their key in the cache
+misses: Number of lookups that didn't find their key in the cache
+n_items: Number of cached values
+n_bytes: Sum of the sizes in bytes of cached values
+max_bytes: The byte budget of the cache
+"""
+
+
+# values of these datatypes are copied before leaving the cache
+MUTABLE_DATATYPES = (Datatype.DICT, Datatype.LIST, Datatype.SET,
+                     Datatype.OBJ, Datatype.GRID, Datatype.BIN)
+
+
+class LruCache:
+    """Thread-safe Least Recently Used cache of decoded values,
+    bounded by a byte budget. This class isn't intended to be
+    directly instantiated by the user."""
+    def __init__(self, max_bytes):
+        """
+        Init.
+
+        [params]
+        - max_bytes: The byte budget. The size of a value is the number
+            of bytes of its stored (serialized) form.
+        """
+        self._max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def get(self, key, default=None):
+        """
+        Get a cached value.
+
+        [params]
+        - key: The key
+        - default: Value to return when the key isn't cached
+
+        [return]
+        Returns a copy of the value if it is mutable, else the value itself
+        """
+        with self._lock:
+            try:
+                value, datatype, n_bytes = self._entries[key]
+            except KeyError as e:
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+        if datatype in MUTABLE_DATATYPES:
+            return copy.deepcopy(value)
+        return value
+
+    def put(self, key, value, datatype, n_bytes):
+        """
+        Cache a value, evicting least recently used values when the
+        byte budget is exceeded. Values bigger than the budget are ignored.
+
+        [params]
+        - key: The key
+        - value: The decoded value
+        - datatype: The `paradict.Datatype` of the value
+        - n_bytes: The size of the value in bytes
+        """
+        if n_bytes > self._max_bytes:
+            return
+        if datatype in MUTABLE_DATATYPES:
+            value = copy.deepcopy(value)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, datatype, n_bytes)
+            self._n_bytes += n_bytes
+            while self._n_bytes > self._max_bytes:
+                _, (_, _, size) = self._entries.popitem(last=False)
+                self._n_bytes -= size
+
+    def discard(self, key):
+        """Remove a key from the cache"""
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        """Remove all values from the cache"""
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+
+    def info(self):
+        """Returns a CacheInfo namedtuple"""
+        with self._lock:
+            return CacheInfo(hits=self._hits, misses=self._misses,
+                             n_items=len(self._entries),
+                             n_bytes=self._n_bytes,
+                             max_bytes=self._max_bytes)
+
+    def _discard(self, key):
+        try:
+            _, _, n_bytes = self._entries.pop(key)
+        except KeyError as e:
+            return
+        self._n_bytes -= n_bytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -5,7 +5,13 @@ from enum import Enum, unique
 __all__ = ["Model", "TimestampPrecision",
            "TimeUnit", "StorageUnit", "CHUNK_SIZE", "JINBASE_HOME",
            "JINBASE_VERSION", "USER_HOME", "DATETIME_FORMAT",
-           "TIMESTAMP_PRECISION", "TIMEOUT"]
+           "TIMESTAMP_PRECISION", "TIMEOUT", "BATCH_SIZE", "BATCH_BYTES",
+           "KV_CACHE_SIZE", "PURGE_BATCH_SIZE", "REAPER_INTERVAL",
+           "INLINE_SIZE", "KV_FILTER", "FILTER_ERROR_RATE",
+           "FILTER_MIN_CAPACITY", "SHARD_VNODES", "RETENTION_BATCH_SIZE",
+           "RETENTION_LOCK_TIME", "FOLLOW_BATCH_SIZE", "FOLLOW_MIN_INTERVAL",
+           "FOLLOW_MAX_INTERVAL", "AGGREGATE_OPS",
+           "VISIBILITY_TIMEOUT"]
 
 
 # models (key-value, depot, queue, and stack)
@@ -57,6 +63,57 @@ CHUNK_SIZE = 2**20  # 1 MiB
 # timeout
 TIMEOUT = 5.0
 
+# max size in bytes of the values stored inline in their record row
+INLINE_SIZE = 512
+
+# byte budget of the Kv cache of decoded values (0 to disable it)
+KV_CACHE_SIZE = 0
+
+# whether the Kv store keeps a Bloom filter of its keys
+KV_FILTER = False
+
+# expected false positive rate of the Bloom filter of Kv keys
+FILTER_ERROR_RATE = 0.01
+
+# min number of keys the Bloom filter of Kv keys is sized for
+FILTER_MIN_CAPACITY = 1024
+
+# number of points of each shard on the consistent hash ring
+SHARD_VNODES = 64
+
+# max number of expired records deleted per write transaction
+PURGE_BATCH_SIZE = 100
+
+# max number of records deleted per write transaction by Depot retention
+RETENTION_BATCH_SIZE = 500
+
+# max seconds a write transaction of Depot retention holds the write lock
+RETENTION_LOCK_TIME = 0.05
+
+# max number of records read per query by Depot.follow
+FOLLOW_BATCH_SIZE = 100
+
+# min and max seconds between two checks for commits of other
+# connections by Depot.follow and by blocking reads of Queue and Stack,
+# which back off while the store is idle
+FOLLOW_MIN_INTERVAL = 0.001
+FOLLOW_MAX_INTERVAL = 0.05
+
+# operations supported by Depot.aggregate
+AGGREGATE_OPS = ("count", "sum", "min", "max", "avg")
+
+# seconds a Queue item leased by Queue.lease stays in flight
+VISIBILITY_TIMEOUT = 30
+
+# seconds between two sweeps of the reaper of expired Kv records
+REAPER_INTERVAL = 1.0
+
+# max number of SQL parameters bound to a single batched query
+BATCH_SIZE = 500
+
+# max number of pending data bytes buffered by bulk writes before a flush
+BATCH_BYTES = 2**25  # 32 MiB
+
 # version
 JINBASE_VERSION = 1
 
@@ -2,6 +2,7 @@
 import os
 import os.path
 import math
+from itertools import islice
 from datetime import datetime, timezone
 from jinbase import const
 
@@ -87,6 +88,38 @@ def get_limit_spec(limit):
     return "LIMIT {}".format(int(limit))
 
 
+def get_placeholders(n):
+    return ", ".join("?" * n)
+
+
+def split_batches(items, batch_size=const.BATCH_SIZE):
+    items = iter(items)
+    while True:
+        batch = tuple(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_prefix_bounds(prefix):
+    """Returns the (lower, upper) bounds of the range of strings
+    that start with `prefix`. The lower bound is inclusive, the upper
+    bound is exclusive and is None when the range is unbounded.
+    Code point order is also the order of SQLite's BINARY collation
+    on UTF-8 text."""
+    chars = list(prefix)
+    while chars:
+        code_point = ord(chars[-1]) + 1
+        # surrogates can't be encoded in UTF-8
+        if 0xD800 <= code_point <= 0xDFFF:
+            code_point = 0xE000
+        if code_point <= 0x10FFFF:
+            chars[-1] = chr(code_point)
+            return prefix, "".join(chars)
+        chars.pop()
+    return prefix, None
+
+
 def create_backup_filename(db_filename):
     current_datetime = datetime.now()
     dt = current_datetime.strftime("%Y-%m-%dT%H:%M:%S")
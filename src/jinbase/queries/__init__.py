@@ -4,72 +4,117 @@
 __all__ = []
 
 
-# Init script
-INIT_SCRIPT = """
-
--- Create the JINBASE_INFO table
-CREATE TABLE IF NOT EXISTS jinbase_info (
-    id INTEGER NOT NULL UNIQUE DEFAULT 0,
-    version INTEGER NOT NULL,
-    created_at TEXT NOT NULL,
-    chunk_size INTEGER NOT NULL,
-    timestamp_precision INTEGER NOT NULL,
-    CONSTRAINT chk_id 
-        CHECK (id == 0));
-        
-
--- Create the JINBASE_KV_RECORD table
-CREATE TABLE IF NOT EXISTS jinbase_kv_record (
+# Script creating the tables of a Kv store, either the default one
+# (model "kv") or a bucket
+KV_SCRIPT = """
+-- Create the jinbase_{model}_record table
+CREATE TABLE IF NOT EXISTS jinbase_{model}_record (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     datatype INTEGER NOT NULL,
     timestamp INTEGER NOT NULL,
     int_key INTEGER UNIQUE,
     str_key TEXT UNIQUE,
+    expiry INTEGER,
+    counter INTEGER,
+    payload BLOB,
+    version INTEGER NOT NULL DEFAULT 1,
     CONSTRAINT chk_key 
         CHECK ((int_key IS NULL AND str_key IS NOT NULL) 
               OR
               (int_key IS NOT NULL AND str_key IS NULL)));
     
--- Create index for JINBASE_KV_RECORD's timestamp
-CREATE INDEX IF NOT EXISTS idx_jinbase_kv_record_timestamp 
-    ON jinbase_kv_record (timestamp);
+-- Create index for jinbase_{model}_record's timestamp
+CREATE INDEX IF NOT EXISTS idx_jinbase_{model}_record_timestamp 
+    ON jinbase_{model}_record (timestamp);
 
--- Create the JINBASE_KV_DATA table
-CREATE TABLE IF NOT EXISTS jinbase_kv_data (
+-- Create the jinbase_{model}_data table
+CREATE TABLE IF NOT EXISTS jinbase_{model}_data (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     record_id INTEGER NOT NULL,
     chunk BLOB NOT NULL,
-    CONSTRAINT fk_jinbase_kv_data_record_id
+    CONSTRAINT fk_jinbase_{model}_data_record_id
         FOREIGN KEY (record_id) 
-            REFERENCES jinbase_kv_record(id) 
+            REFERENCES jinbase_{model}_record(id) 
                 ON DELETE CASCADE);
 
--- Create index for JINBASE_KV_DATA's record_id
-CREATE INDEX IF NOT EXISTS idx_jinbase_kv_data_record_id 
-    ON jinbase_kv_data (record_id);
+-- Create index for jinbase_{model}_data's record_id
+CREATE INDEX IF NOT EXISTS idx_jinbase_{model}_data_record_id 
+    ON jinbase_{model}_data (record_id);
 
--- Create the JINBASE_KV_POINTER table
-CREATE TABLE IF NOT EXISTS jinbase_kv_pointer (
+-- Create the jinbase_{model}_pointer table
+CREATE TABLE IF NOT EXISTS jinbase_{model}_pointer (
     field TEXT NOT NULL,
     record_id INTEGER NOT NULL,
     slice_start INTEGER NOT NULL,
     slice_stop INTEGER NOT NULL,
     PRIMARY KEY (field, record_id),
-    CONSTRAINT fk_jinbase_kv_pointer_record_id
+    CONSTRAINT fk_jinbase_{model}_pointer_record_id
         FOREIGN KEY (record_id) 
-            REFERENCES jinbase_kv_record(id) 
+            REFERENCES jinbase_{model}_record(id) 
                 ON DELETE CASCADE);
 
--- Create index for JINBASE_KV_POINTER's record_id
-CREATE INDEX IF NOT EXISTS idx_jinbase_kv_pointer_record_id 
-    ON jinbase_kv_pointer (record_id);
+-- Create index for jinbase_{model}_pointer's record_id
+CREATE INDEX IF NOT EXISTS idx_jinbase_{model}_pointer_record_id 
+    ON jinbase_{model}_pointer (record_id);
+
+-- Create the jinbase_{model}_indexed_field table
+CREATE TABLE IF NOT EXISTS jinbase_{model}_indexed_field (
+    field TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL);
+
+-- Create the jinbase_{model}_field_value table
+CREATE TABLE IF NOT EXISTS jinbase_{model}_field_value (
+    field TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    value NOT NULL,
+    PRIMARY KEY (field, record_id),
+    CONSTRAINT fk_jinbase_{model}_field_value_field
+        FOREIGN KEY (field) 
+            REFERENCES jinbase_{model}_indexed_field(field) 
+                ON DELETE CASCADE,
+    CONSTRAINT fk_jinbase_{model}_field_value_record_id
+        FOREIGN KEY (record_id) 
+            REFERENCES jinbase_{model}_record(id) 
+                ON DELETE CASCADE) WITHOUT ROWID;
+
+-- Create index for jinbase_{model}_field_value's value
+CREATE INDEX IF NOT EXISTS idx_jinbase_{model}_field_value_value 
+    ON jinbase_{model}_field_value (field, value);
+
+-- Create index for jinbase_{model}_field_value's record_id
+CREATE INDEX IF NOT EXISTS idx_jinbase_{model}_field_value_record_id 
+    ON jinbase_{model}_field_value (record_id);
 
+"""
+
+# Init script
+INIT_SCRIPT = """
+
+-- Create the JINBASE_INFO table
+CREATE TABLE IF NOT EXISTS jinbase_info (
+    id INTEGER NOT NULL UNIQUE DEFAULT 0,
+    version INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    timestamp_precision INTEGER NOT NULL,
+    CONSTRAINT chk_id 
+        CHECK (id == 0));
+        
+
+-- Create the JINBASE_KV_BUCKET table
+CREATE TABLE IF NOT EXISTS jinbase_kv_bucket (
+    name TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL);
+
+""" + KV_SCRIPT.format(model="kv") + """
 
 -- Create the JINBASE_DEPOT_RECORD table
 CREATE TABLE IF NOT EXISTS jinbase_depot_record (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     datatype INTEGER NOT NULL,
-    timestamp INTEGER NOT NULL);
+    timestamp INTEGER NOT NULL,
+    seq INTEGER,
+    payload BLOB);
     
 -- Create index for JINBASE_DEPOT_RECORD's timestamp
 CREATE INDEX IF NOT EXISTS idx_jinbase_depot_record_timestamp 
@@ -105,12 +150,53 @@ CREATE TABLE IF NOT EXISTS jinbase_depot_pointer (
 CREATE INDEX IF NOT EXISTS idx_jinbase_depot_pointer_record_id 
     ON jinbase_depot_pointer (record_id);
 
+-- Create the JINBASE_DEPOT_INDEXED_FIELD table
+CREATE TABLE IF NOT EXISTS jinbase_depot_indexed_field (
+    field TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL);
+
+-- Create the JINBASE_DEPOT_FIELD_VALUE table
+CREATE TABLE IF NOT EXISTS jinbase_depot_field_value (
+    field TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    value NOT NULL,
+    PRIMARY KEY (field, record_id),
+    CONSTRAINT fk_jinbase_depot_field_value_field
+        FOREIGN KEY (field) 
+            REFERENCES jinbase_depot_indexed_field(field) 
+                ON DELETE CASCADE,
+    CONSTRAINT fk_jinbase_depot_field_value_record_id
+        FOREIGN KEY (record_id) 
+            REFERENCES jinbase_depot_record(id) 
+                ON DELETE CASCADE) WITHOUT ROWID;
+
+-- Create index for JINBASE_DEPOT_FIELD_VALUE's value
+CREATE INDEX IF NOT EXISTS idx_jinbase_depot_field_value_value 
+    ON jinbase_depot_field_value (field, value);
+
+-- Create index for JINBASE_DEPOT_FIELD_VALUE's record_id
+CREATE INDEX IF NOT EXISTS idx_jinbase_depot_field_value_record_id 
+    ON jinbase_depot_field_value (record_id);
+
+-- Create the JINBASE_DEPOT_RETENTION table
+CREATE TABLE IF NOT EXISTS jinbase_depot_retention (
+    id INTEGER NOT NULL UNIQUE DEFAULT 0,
+    max_records INTEGER,
+    max_bytes INTEGER,
+    max_age REAL,
+    n_bytes INTEGER,
+    CONSTRAINT chk_id 
+        CHECK (id == 0));
+
 
 -- Create the JINBASE_QUEUE_RECORD table
 CREATE TABLE IF NOT EXISTS jinbase_queue_record (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     datatype INTEGER NOT NULL,
-    timestamp INTEGER NOT NULL);
+    timestamp INTEGER NOT NULL,
+    lease_expiry INTEGER,
+    lease_token INTEGER,
+    payload BLOB);
 
 -- Create index for JINBASE_QUEUE_RECORD's timestamp
 CREATE INDEX IF NOT EXISTS idx_jinbase_queue_record_timestamp 
@@ -135,7 +221,8 @@ CREATE INDEX IF NOT EXISTS idx_jinbase_queue_data_record_id
 CREATE TABLE IF NOT EXISTS jinbase_stack_record (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     datatype INTEGER NOT NULL,
-    timestamp INTEGER NOT NULL);
+    timestamp INTEGER NOT NULL,
+    payload BLOB);
     
 -- Create index for JINBASE_STACK_RECORD's timestamp
 CREATE INDEX IF NOT EXISTS idx_jinbase_stack_record_timestamp 
@@ -157,6 +244,91 @@ CREATE INDEX IF NOT EXISTS idx_jinbase_stack_data_record_id
 """
 
 
+# Schema upgrade of databases created by previous versions.
+# Columns added to existing tables, as (table, column, definition) tuples
+ADDED_COLUMNS = (("jinbase_kv_record", "expiry", "INTEGER"),
+                 ("jinbase_kv_record", "counter", "INTEGER"),
+                 ("jinbase_kv_record", "payload", "BLOB"),
+                 ("jinbase_kv_record", "version", "INTEGER NOT NULL DEFAULT 1"),
+                 ("jinbase_depot_record", "payload", "BLOB"),
+                 ("jinbase_depot_record", "seq", "INTEGER"),
+                 ("jinbase_queue_record", "payload", "BLOB"),
+                 ("jinbase_queue_record", "lease_expiry", "INTEGER"),
+                 ("jinbase_queue_record", "lease_token", "INTEGER"),
+                 ("jinbase_stack_record", "payload", "BLOB"))
+
+# Script to run on the tables of a Kv store once the added columns exist
+KV_UPGRADE_SCRIPT = """
+-- Create index for jinbase_{model}_record's expiry
+CREATE INDEX IF NOT EXISTS idx_jinbase_{model}_record_expiry 
+    ON jinbase_{model}_record (expiry) WHERE expiry IS NOT NULL;
+"""
+
+# Script to run once the added columns exist
+UPGRADE_SCRIPT = KV_UPGRADE_SCRIPT.format(model="kv") + """
+-- Create index for JINBASE_DEPOT_RECORD's seq
+CREATE INDEX IF NOT EXISTS idx_jinbase_depot_record_seq 
+    ON jinbase_depot_record (seq);
+
+-- Create index for JINBASE_QUEUE_RECORD's lease_expiry. Items that
+-- aren't leased (NULL) come first, in FIFO order
+CREATE INDEX IF NOT EXISTS idx_jinbase_queue_record_lease_expiry 
+    ON jinbase_queue_record (lease_expiry, id);
+"""
+
+# Queries to fill an added column of existing records,
+# as a dict mapping (table, column) tuples to queries
+BACKFILL_QUERIES = {("jinbase_depot_record", "seq"): """
+UPDATE jinbase_depot_record SET seq = t.seq 
+FROM (SELECT id, row_number() OVER (ORDER BY id) - 1 AS seq 
+      FROM jinbase_depot_record) AS t 
+WHERE jinbase_depot_record.id = t.id
+"""}
+
+# Kv buckets
+ADD_KV_BUCKET = """
+INSERT INTO jinbase_kv_bucket (name, created_at) VALUES ('{name}', '{created_at}') 
+    ON CONFLICT (name) DO NOTHING;
+"""
+GET_KV_BUCKETS = """
+SELECT name FROM jinbase_kv_bucket ORDER BY name
+"""
+HAS_KV_BUCKET = """
+SELECT COUNT(*) AS n FROM jinbase_kv_bucket WHERE name = ?
+"""
+# child tables are dropped first, so that dropping the record table
+# doesn't have to check foreign keys row by row
+DROP_KV_SCRIPT = """
+DROP TABLE IF EXISTS jinbase_{model}_field_value;
+DROP TABLE IF EXISTS jinbase_{model}_indexed_field;
+DROP TABLE IF EXISTS jinbase_{model}_pointer;
+DROP TABLE IF EXISTS jinbase_{model}_data;
+DROP TABLE IF EXISTS jinbase_{model}_record;
+DELETE FROM jinbase_kv_bucket WHERE name = '{name}';
+"""
+
+# AUTOINCREMENT sequences, raised by ShardedJinbase so that
+# the next record of a shard gets a planned uid
+GET_SEQUENCE = """
+SELECT seq FROM sqlite_sequence WHERE name = ?
+"""
+RAISE_SEQUENCE = """
+UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?
+"""
+ADD_SEQUENCE = """
+INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)
+"""
+GET_TABLE_NAMES = """
+SELECT name FROM sqlite_master WHERE type = 'table'
+"""
+GET_TABLE_COLUMNS = """
+PRAGMA table_info({table})
+"""
+ADD_COLUMN = """
+ALTER TABLE {table} ADD COLUMN {column} {definition}
+"""
+
+
 # PRAGMA to run at connection creation
 CONNECTION_DIRECTIVES = """
 PRAGMA foreign_keys=ON;
@@ -164,6 +336,12 @@ PRAGMA synchronous=NORMAL;
 """
 
 
+# Incremented when another connection commits changes to the database
+GET_DATA_VERSION = """
+PRAGMA data_version
+"""
+
+
 # Jinbase info
 GET_JINBASE_INFO = """
 SELECT version, created_at, chunk_size, timestamp_precision FROM jinbase_info
@@ -181,6 +359,26 @@ SELECT timestamp FROM jinbase_{model}_record ORDER BY timestamp DESC LIMIT 1
 COUNT_RECORDS = """
 SELECT COUNT(*) AS n FROM jinbase_{model}_record
 """
+GET_NEXT_RECORD_ID = """
+SELECT MAX(
+    COALESCE((SELECT seq FROM sqlite_sequence 
+              WHERE name = 'jinbase_{model}_record'), 0),
+    COALESCE((SELECT MAX(id) FROM jinbase_{model}_record), 0)) + 1
+"""
+INSERT_RECORDS = """
+INSERT INTO jinbase_{model}_record (id, datatype, timestamp, payload) 
+    VALUES (?, ?, ?, ?)
+"""
+GET_RECORD_ID_RANGE = """
+SELECT MIN(id), MAX(id) FROM jinbase_{model}_record WHERE timestamp BETWEEN ? AND ?
+"""
+STREAM_RECORDS = """
+SELECT r.id, r.datatype, r.id, COALESCE(r.payload, d.chunk) 
+FROM jinbase_{model}_record AS r 
+    LEFT JOIN jinbase_{model}_data AS d ON d.record_id = r.id 
+    WHERE r.id BETWEEN ? AND ? {criteria} 
+    ORDER BY r.id {sort_order}, d.id
+"""
 RETRIEVE_RECORDS = """
 SELECT id FROM jinbase_{model}_record WHERE ORDER BY id
 """
@@ -190,6 +388,20 @@ DELETE FROM jinbase_{model}_record WHERE id=?
 DELETE_RECORDS = """
 DELETE FROM jinbase_{model}_record
 """
+DELETE_RECORDS_BETWEEN = """
+DELETE FROM jinbase_{model}_record AS r WHERE r.id BETWEEN ? AND ? {criteria}
+"""
+GET_EDGE_ID_RANGE = """
+SELECT MIN(id), MAX(id) FROM (SELECT r.id FROM jinbase_{model}_record AS r 
+    WHERE r.id > 0 {criteria} ORDER BY r.id {sort_order} LIMIT ?)
+"""
+STREAM_RECORDS_BY_IDS = """
+SELECT r.id, r.datatype, r.id, COALESCE(r.payload, d.chunk) 
+FROM jinbase_{model}_record AS r 
+    LEFT JOIN jinbase_{model}_data AS d ON d.record_id = r.id 
+    WHERE r.id IN ({placeholders}) 
+    ORDER BY r.id, d.id
+"""
 
 
 # Data management
@@ -197,22 +409,63 @@ GET_CHUNK_ID = """
 SELECT id FROM jinbase_{model}_data WHERE record_id = ? 
 ORDER BY id LIMIT 1 OFFSET {offset}
 """
+GET_CHUNK_IDS = """
+SELECT id FROM jinbase_{model}_data WHERE record_id = ? ORDER BY id
+"""
+GET_CHUNK_SIZES = """
+SELECT id, LENGTH(chunk) FROM jinbase_{model}_data WHERE record_id = ? ORDER BY id
+"""
+UPDATE_CHUNK = """
+UPDATE jinbase_{model}_data SET chunk = ? WHERE id = ? AND chunk IS NOT ?
+"""
+DELETE_RECORD_DATA = """
+DELETE FROM jinbase_{model}_data WHERE record_id = ?
+"""
+DELETE_RECORDS_DATA_BETWEEN = """
+DELETE FROM jinbase_{model}_data WHERE record_id IN 
+    (SELECT r.id FROM jinbase_{model}_record AS r 
+        WHERE r.id BETWEEN ? AND ? {criteria})
+"""
+DELETE_CHUNKS = """
+DELETE FROM jinbase_{model}_data WHERE id IN ({placeholders})
+"""
 STORE_DATA = """
 INSERT INTO jinbase_{model}_data (record_id, chunk) VALUES (?, ?)
 """
+# records whose data is small enough have it inlined in the payload column
+# of their record row, and have no rows in the data table
+GET_RECORD_PAYLOAD = """
+SELECT payload FROM jinbase_{model}_record WHERE id = ?
+"""
+SET_RECORD_PAYLOAD = """
+UPDATE jinbase_{model}_record SET payload = ? WHERE id = ?
+"""
 RETRIEVE_DATA = """
 SELECT chunk FROM jinbase_{model}_data WHERE record_id=? ORDER BY id
 """
-COUNT_STORE_CHUNKS = """SELECT COUNT(*) AS n FROM jinbase_{model}_data
+RETRIEVE_MANY_DATA = """
+SELECT record_id, chunk FROM jinbase_{model}_data 
+    WHERE record_id IN ({placeholders}) 
+    ORDER BY record_id, id
+"""
+COUNT_STORE_CHUNKS = """
+SELECT (SELECT COUNT(*) FROM jinbase_{model}_data) 
+    + (SELECT COUNT(payload) FROM jinbase_{model}_record) AS n
 """
 COUNT_STORE_BYTES = """
-SELECT SUM(LENGTH(chunk)) AS n FROM jinbase_{model}_data
+SELECT (SELECT COALESCE(SUM(LENGTH(chunk)), 0) FROM jinbase_{model}_data) 
+    + (SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM jinbase_{model}_record) AS n
 """
 COUNT_RECORD_BYTES = """
-SELECT SUM(LENGTH(chunk)) AS n FROM jinbase_{model}_data WHERE record_id = ?
+SELECT SUM(COALESCE(LENGTH(r.payload), 0) 
+    + (SELECT COALESCE(SUM(LENGTH(d.chunk)), 0) FROM jinbase_{model}_data AS d 
+       WHERE d.record_id = r.id)) AS n 
+FROM jinbase_{model}_record AS r WHERE r.id = ?
 """
 COUNT_RECORD_CHUNKS = """
-SELECT COUNT(*) AS n FROM jinbase_{model}_data WHERE record_id = ?
+SELECT SUM((r.payload IS NOT NULL) 
+    + (SELECT COUNT(*) FROM jinbase_{model}_data AS d WHERE d.record_id = r.id)) AS n 
+FROM jinbase_{model}_record AS r WHERE r.id = ?
 """
 
 # Pointer management
@@ -223,99 +476,404 @@ VALUES (?, ?, ?, ?)
 GET_POINTER = """
 SELECT slice_start, slice_stop FROM jinbase_{model}_pointer WHERE field = ? AND record_id = ?
 """
+GET_POINTERS = """
+SELECT field, slice_start, slice_stop FROM jinbase_{model}_pointer 
+    WHERE record_id = ? AND field IN ({placeholders})
+"""
+GET_FIRST_POINTER_START = """
+SELECT MIN(slice_start) FROM jinbase_{model}_pointer WHERE record_id = ?
+"""
+GET_RECORD_POINTERS = """
+SELECT field, slice_start, slice_stop FROM jinbase_{model}_pointer WHERE record_id = ?
+"""
+SHIFT_POINTERS = """
+UPDATE jinbase_{model}_pointer SET slice_start = slice_start + ?, slice_stop = slice_stop + ? 
+    WHERE record_id = ? AND slice_start >= ?
+"""
+SET_POINTER = """
+INSERT INTO jinbase_{model}_pointer (field, record_id, slice_start, slice_stop) 
+VALUES (?, ?, ?, ?) 
+ON CONFLICT (field, record_id) 
+    DO UPDATE SET slice_start = excluded.slice_start, slice_stop = excluded.slice_stop
+"""
+DELETE_POINTER = """
+DELETE FROM jinbase_{model}_pointer WHERE field = ? AND record_id = ?
+"""
 GET_POINTED_FIELDS = """
 SELECT field FROM jinbase_{model}_pointer ORDER BY field
 """
 
 
+# Secondary indexes
+ADD_INDEXED_FIELD = """
+INSERT INTO jinbase_{model}_indexed_field (field, created_at) VALUES (?, ?) 
+    ON CONFLICT (field) DO NOTHING
+"""
+DELETE_INDEXED_FIELD = """
+DELETE FROM jinbase_{model}_indexed_field WHERE field = ?
+"""
+GET_INDEXED_FIELDS = """
+SELECT field FROM jinbase_{model}_indexed_field ORDER BY field
+"""
+ADD_FIELD_VALUE = """
+INSERT INTO jinbase_{model}_field_value (field, record_id, value) VALUES (?, ?, ?)
+"""
+DELETE_FIELD_VALUES = """
+DELETE FROM jinbase_{model}_field_value WHERE record_id = ?
+"""
+DELETE_FIELD_VALUE = """
+DELETE FROM jinbase_{model}_field_value WHERE field = ? AND record_id = ?
+"""
+# Only the bytes of the field are returned: inline payloads are sliced
+# by SQLite, and for chunked records, chunks are numbered (n) from the
+# record_id index so that only the chunks that overlap the field are read,
+# then sliced. All chunks of a record but the last hold chunk_size bytes
+STREAM_FIELD_CHUNKS = """
+SELECT p.record_id,
+    CASE WHEN r.payload IS NOT NULL 
+        THEN substr(r.payload, p.slice_start + 1, p.slice_stop - p.slice_start) 
+        ELSE substr(d.chunk, 
+                    MAX(p.slice_start - c.n * {chunk_size}, 0) + 1, 
+                    MIN(p.slice_stop - c.n * {chunk_size}, {chunk_size}) 
+                        - MAX(p.slice_start - c.n * {chunk_size}, 0)) END 
+FROM jinbase_{model}_pointer AS p 
+    JOIN jinbase_{model}_record AS r ON r.id = p.record_id 
+    LEFT JOIN (SELECT o.id, o.record_id, 
+                      (SELECT COUNT(*) FROM jinbase_{model}_data AS x 
+                          WHERE x.record_id = o.record_id AND x.id < o.id) AS n 
+               FROM jinbase_{model}_data AS o) AS c 
+        ON r.payload IS NULL AND c.record_id = p.record_id 
+            AND c.n BETWEEN p.slice_start / {chunk_size} 
+                AND (p.slice_stop - 1) / {chunk_size} 
+    LEFT JOIN jinbase_{model}_data AS d ON d.id = c.id 
+    WHERE p.field = ? {criteria} 
+    ORDER BY p.record_id, c.n
+"""
+FIND_RECORDS = """
+SELECT record_id FROM jinbase_{model}_field_value 
+    WHERE field = ? {criteria} 
+    ORDER BY value {sort_order}, record_id {sort_order} {limit}
+"""
+FIND_KV_KEYS = """
+SELECT
+    CASE
+        WHEN r.int_key IS NOT NULL THEN r.int_key
+        ELSE r.str_key
+    END AS key
+FROM jinbase_{model}_field_value AS v 
+    JOIN jinbase_{model}_record AS r ON r.id = v.record_id 
+    WHERE v.field = ? {criteria} 
+    ORDER BY v.value {sort_order}, v.record_id {sort_order} {limit}
+"""
+INDEX_CRITERIA_1 = "value = ?"
+INDEX_CRITERIA_2 = "value >= ?"
+INDEX_CRITERIA_3 = "value <= ?"
+
+
 # Key-value store
 COUNT_KEY_OCCURRENCE = """
-SELECT COUNT(*) AS n FROM jinbase_kv_record WHERE {key_type}_key=?
+SELECT COUNT(*) AS n FROM jinbase_{model}_record WHERE {key_type}_key=?
 """
 SET_KV_RECORD = """
-INSERT INTO jinbase_kv_record (datatype, timestamp, {key_type}_key) 
-    VALUES (?, ?, ?)
+INSERT INTO jinbase_{model}_record (datatype, timestamp, expiry, {key_type}_key) 
+    VALUES (?, ?, ?, ?)
+"""
+INSERT_KV_RECORDS = """
+INSERT INTO jinbase_{model}_record (id, datatype, timestamp, payload, int_key, str_key) 
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+UPDATE_KV_RECORD = """
+UPDATE jinbase_{model}_record SET datatype = ?, timestamp = ?, expiry = ?, counter = NULL, 
+    version = version + 1 
+    WHERE id = ?
+"""
+TOUCH_KV_RECORD = """
+UPDATE jinbase_{model}_record SET timestamp = ?, version = version + 1 WHERE id = ?
 """
 GET_KV_RECORD_BY_KEY = """
-SELECT id, datatype, timestamp FROM jinbase_kv_record WHERE {key_type}_key=?
+SELECT id, datatype, timestamp, expiry, counter, payload, version 
+FROM jinbase_{model}_record 
+    WHERE {key_type}_key=? {criteria}
 """
-GET_KV_KEY_BY_UID = """
-SELECT
-    CASE
-        WHEN int_key IS NOT NULL THEN int_key
-        ELSE str_key
-    END AS key
-FROM jinbase_kv_record WHERE id=?
+GET_KV_RECORDS_BY_KEYS = """
+SELECT id, datatype, timestamp, expiry, counter, payload, version, {key_type}_key 
+FROM jinbase_{model}_record 
+    WHERE {key_type}_key IN ({placeholders}) {criteria}
+"""
+GET_ALL_KV_KEYS = """
+SELECT COALESCE(int_key, str_key) FROM jinbase_{model}_record
 """
-SELECT_KEYS = """
+GET_KV_KEY_BY_UID = """
 SELECT
     CASE
         WHEN int_key IS NOT NULL THEN int_key
         ELSE str_key
     END AS key
-FROM jinbase_kv_record {criteria} ORDER BY key {sort_order} {limit}
+FROM jinbase_{model}_record WHERE id=? {criteria}
 """
 SELECT_INT_KEYS = """
 SELECT int_key as key
-FROM jinbase_kv_record 
+FROM jinbase_{model}_record 
     WHERE int_key IS NOT NULL {criteria} 
     ORDER BY key {sort_order} {limit}
 """
 SELECT_STR_KEYS = """
 SELECT str_key as key
-FROM jinbase_kv_record 
+FROM jinbase_{model}_record 
     WHERE str_key IS NOT NULL {criteria} 
     ORDER BY key {sort_order} {limit}
 """
 SELECT_STR_KEYS_WITH_GLOB = """
 SELECT str_key as key
-FROM jinbase_kv_record 
+FROM jinbase_{model}_record 
     WHERE str_key IS NOT NULL AND str_key GLOB ? {criteria} 
     ORDER BY key {sort_order} {limit}
 """
+COUNT_LIVE_KV_RECORDS = """
+SELECT COUNT(*) AS n FROM jinbase_{model}_record WHERE expiry IS NULL OR expiry > ?
+"""
+PURGE_EXPIRED_KV_RECORDS = """
+DELETE FROM jinbase_{model}_record WHERE id IN (
+    SELECT id FROM jinbase_{model}_record WHERE expiry <= ? ORDER BY expiry LIMIT ?)
+"""
+INCR_KV_COUNTER = """
+INSERT INTO jinbase_{model}_record (datatype, timestamp, {key_type}_key, counter) 
+    VALUES (?, ?, ?, ?) 
+ON CONFLICT ({key_type}_key) DO UPDATE 
+    SET counter = counter + excluded.counter, timestamp = excluded.timestamp, 
+        version = version + 1 
+    WHERE counter IS NOT NULL AND (expiry IS NULL OR expiry > ?) 
+        -- SQLite would switch to floating point on integer overflow
+        AND CASE WHEN excluded.counter > 0 
+            THEN counter <= 9223372036854775807 - excluded.counter 
+            ELSE counter >= -9223372036854775807 - 1 - excluded.counter END 
+RETURNING counter
+"""
+SET_KV_COUNTER = """
+UPDATE jinbase_{model}_record SET datatype = ?, timestamp = ?, counter = ?, payload = NULL, 
+    version = version + 1 
+    WHERE id = ?
+"""
+STREAM_KV_RECORDS = """
+SELECT r.id, r.datatype, r.{key_type}_key, COALESCE(r.payload, d.chunk), r.counter 
+FROM jinbase_{model}_record AS r 
+    LEFT JOIN jinbase_{model}_data AS d ON d.record_id = r.id 
+    WHERE r.{key_type}_key IS NOT NULL {criteria} 
+    ORDER BY r.{key_type}_key {sort_order}, d.id
+"""
 KV_CRITERIA_1 = "int_key >= {val}"
 KV_CRITERIA_2 = "int_key <= {val}"
 KV_CRITERIA_3 = "int_key BETWEEN {first} AND {last}"
 KV_CRITERIA_4 = "timestamp BETWEEN {start} AND {stop}"
+KV_CRITERIA_5 = "int_key > {val}"
+KV_CRITERIA_6 = "int_key < {val}"
+KV_CRITERIA_7 = "str_key > ?"
+KV_CRITERIA_8 = "str_key < ?"
+KV_CRITERIA_9 = "str_key >= ?"
+KV_CRITERIA_10 = "str_key >= ? AND str_key < ?"
+KV_CRITERIA_11 = "(expiry IS NULL OR expiry > {now})"
+# the unary "+" prevents SQLite from using the timestamp index,
+# so that streaming queries follow the index that matches their ORDER BY
+STREAM_CRITERIA = "+r.timestamp BETWEEN {start} AND {stop}"
 
 
 # Depot store
+AGGREGATE_DEPOT_FIELD = """
+SELECT COUNT(v.value), SUM(v.value), MIN(v.value), MAX(v.value), AVG(v.value) 
+FROM jinbase_depot_field_value AS v 
+    JOIN jinbase_depot_record AS r ON r.id = v.record_id 
+    WHERE v.field = ? AND v.record_id BETWEEN ? AND ? 
+        AND typeof(v.value) IN ('integer', 'real') {criteria}
+"""
+# Fallback of AGGREGATE_DEPOT_FIELD when SUM overflows 64-bit integers
+STREAM_DEPOT_FIELD_NUMBERS = """
+SELECT v.value 
+FROM jinbase_depot_field_value AS v 
+    JOIN jinbase_depot_record AS r ON r.id = v.record_id 
+    WHERE v.field = ? AND v.record_id BETWEEN ? AND ? 
+        AND typeof(v.value) IN ('integer', 'real') {criteria}
+"""
 GET_DEPOT_RECORD = """
-SELECT datatype, timestamp
+SELECT datatype, timestamp, payload
 FROM jinbase_depot_record WHERE id = ?
 """
-GET_DEPOT_RECORD_BY_POSITION = """
-SELECT id, datatype, timestamp
-FROM jinbase_depot_record ORDER BY id LIMIT 1 OFFSET {offset}
+GET_DEPOT_EDGE_RECORD = """
+SELECT id, datatype, payload
+FROM jinbase_depot_record ORDER BY id {sort_order} LIMIT 1
+"""
+# Records of a Depot are numbered by a dense sequence (the seq column),
+# therefore the position of a record is its seq minus the smallest seq.
+# Min and max are computed by separate subqueries so that each one
+# is a single seek on the seq index
+GET_DEPOT_SEQ_RANGE = """
+SELECT (SELECT MIN(seq) FROM jinbase_depot_record), 
+       (SELECT MAX(seq) FROM jinbase_depot_record)
+"""
+GET_DEPOT_UID_BY_SEQ = """
+SELECT id FROM jinbase_depot_record WHERE seq = ?
+"""
+GET_DEPOT_SEQ = """
+SELECT seq FROM jinbase_depot_record WHERE id = ?
+"""
+GET_DEPOT_POSITION = """
+SELECT r.seq - (SELECT MIN(seq) FROM jinbase_depot_record)
+FROM jinbase_depot_record AS r WHERE r.id = ?
+"""
+GET_NEXT_DEPOT_SEQ = """
+SELECT COALESCE(MAX(seq), -1) + 1 FROM jinbase_depot_record
+"""
+# deleted records leave holes in the sequence, which are closed
+# by shifting (single hole) or renumbering (many holes) the records
+# on the shorter side of the holes
+SHIFT_DEPOT_HEAD = """
+UPDATE jinbase_depot_record SET seq = seq + 1 WHERE seq < ?
+"""
+SHIFT_DEPOT_TAIL = """
+UPDATE jinbase_depot_record SET seq = seq - 1 WHERE seq > ?
+"""
+RENUMBER_DEPOT_HEAD = """
+UPDATE jinbase_depot_record SET seq = t.seq 
+FROM (SELECT id, ? + 1 - row_number() OVER (ORDER BY seq DESC) AS seq 
+      FROM jinbase_depot_record WHERE seq < ?) AS t 
+WHERE jinbase_depot_record.id = t.id
+"""
+RENUMBER_DEPOT_TAIL = """
+UPDATE jinbase_depot_record SET seq = t.seq 
+FROM (SELECT id, ? - 1 + row_number() OVER (ORDER BY seq ASC) AS seq 
+      FROM jinbase_depot_record WHERE seq > ?) AS t 
+WHERE jinbase_depot_record.id = t.id
 """
 APPEND_TO_DEPOT = """
-INSERT INTO jinbase_depot_record (datatype, timestamp) VALUES (?, ?)
+INSERT INTO jinbase_depot_record (datatype, timestamp, seq) 
+    VALUES (?, ?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM jinbase_depot_record))
+"""
+INSERT_DEPOT_RECORDS = """
+INSERT INTO jinbase_depot_record (id, datatype, timestamp, payload, seq) 
+    VALUES (?, ?, ?, ?, ?)
+"""
+# seq of the first record whose uid is >= (or >) a bound,
+# and of the last record whose uid is <= (or <) a bound
+GET_DEPOT_SEQ_AFTER = """
+SELECT seq FROM jinbase_depot_record WHERE id {operator} ? ORDER BY id ASC LIMIT 1
+"""
+GET_DEPOT_SEQ_BEFORE = """
+SELECT seq FROM jinbase_depot_record WHERE id {operator} ? ORDER BY id DESC LIMIT 1
+"""
+# ordering by r.id too tells SQLite that rows come grouped by record,
+# so that chunks follow the index of the data table without a sort
+STREAM_DEPOT_SLICE = """
+SELECT r.id, r.datatype, r.id, COALESCE(r.payload, d.chunk) 
+FROM jinbase_depot_record AS r 
+    LEFT JOIN jinbase_depot_data AS d ON d.record_id = r.id 
+    WHERE r.seq BETWEEN ? AND ? {criteria} 
+    ORDER BY r.seq {sort_order}, r.id {sort_order}, d.id
+"""
+DEPOT_STEP_CRITERIA = "AND (r.seq - {anchor}) % {step} = 0"
+# Depot retention. The n_bytes column tracks the byte count
+# of the depot while the policy has a max_bytes limit, else it is NULL
+GET_DEPOT_RETENTION = """
+SELECT max_records, max_bytes, max_age, n_bytes FROM jinbase_depot_retention
+"""
+SET_DEPOT_RETENTION = """
+INSERT INTO jinbase_depot_retention (id, max_records, max_bytes, max_age, n_bytes) 
+    VALUES (0, ?, ?, ?, ?) 
+    ON CONFLICT (id) DO UPDATE SET max_records = excluded.max_records, 
+        max_bytes = excluded.max_bytes, max_age = excluded.max_age, 
+        n_bytes = excluded.n_bytes
+"""
+DELETE_DEPOT_RETENTION = """
+DELETE FROM jinbase_depot_retention
+"""
+ADD_DEPOT_BYTES = """
+UPDATE jinbase_depot_retention SET n_bytes = n_bytes + ? WHERE n_bytes IS NOT NULL
+"""
+RESET_DEPOT_BYTES = """
+UPDATE jinbase_depot_retention SET n_bytes = 0 WHERE n_bytes IS NOT NULL
+"""
+COUNT_DEPOT_BYTES_BETWEEN = """
+SELECT (SELECT COALESCE(SUM(LENGTH(chunk)), 0) FROM jinbase_depot_data 
+        WHERE record_id BETWEEN ? AND ?) 
+    + (SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM jinbase_depot_record 
+       WHERE id BETWEEN ? AND ?) AS n
+"""
+GET_OLDEST_DEPOT_UID = """
+SELECT id FROM jinbase_depot_record ORDER BY id LIMIT 1
+"""
+GET_DEPOT_UID_OLDER_THAN = """
+SELECT id FROM jinbase_depot_record WHERE timestamp < ? ORDER BY timestamp LIMIT 1
 """
 GET_DEPOT_RECORDS_BETWEEN_TIMESTAMPS = """
 SELECT id FROM jinbase_depot_record WHERE timestamp BETWEEN ? AND ?
 ORDER BY id {sort_order} {limit}
 """
-COUNT_DEPOT_RECORD_OFFSET = """
-SELECT COUNT(*) AS n FROM jinbase_depot_record WHERE id <= ?
-ORDER BY id
-"""
-
 
 
 # Queue store
+# Leased items (in flight) are skipped by the front and back of the queue
+# until their lease expires. Each edge is the closest of two seeks on the
+# lease_expiry index: the items that aren't leased (NULL) and the expired
+# leases. The unary "+" keeps SQLite from walking the primary key for the
+# expired leases, which are few. The parameter is the current timestamp
 GET_QUEUE_FRONT = """
-SELECT id, datatype, timestamp 
-FROM jinbase_queue_record ORDER BY id LIMIT 1
+SELECT id, datatype, timestamp, payload FROM jinbase_queue_record 
+    WHERE id = (SELECT MIN(id) FROM (
+        SELECT * FROM (SELECT id FROM jinbase_queue_record 
+            WHERE lease_expiry IS NULL ORDER BY id LIMIT 1) 
+        UNION ALL 
+        SELECT MIN(+id) FROM jinbase_queue_record WHERE lease_expiry <= ?))
 """
 GET_QUEUE_FRONT_UID = """
-SELECT id FROM jinbase_queue_record ORDER BY id LIMIT 1
+SELECT MIN(id) FROM (
+    SELECT * FROM (SELECT id FROM jinbase_queue_record 
+        WHERE lease_expiry IS NULL ORDER BY id LIMIT 1) 
+    UNION ALL 
+    SELECT MIN(+id) FROM jinbase_queue_record WHERE lease_expiry <= ?)
 """
 GET_QUEUE_BACK = """
-SELECT id, datatype, timestamp 
-FROM jinbase_queue_record ORDER BY id DESC LIMIT 1
+SELECT id, datatype, timestamp, payload FROM jinbase_queue_record 
+    WHERE id = (SELECT MAX(id) FROM (
+        SELECT * FROM (SELECT id FROM jinbase_queue_record 
+            WHERE lease_expiry IS NULL ORDER BY id DESC LIMIT 1) 
+        UNION ALL 
+        SELECT MAX(+id) FROM jinbase_queue_record WHERE lease_expiry <= ?))
 """
 GET_QUEUE_BACK_UID = """
-SELECT id FROM jinbase_queue_record ORDER BY id DESC LIMIT 1
+SELECT MAX(id) FROM (
+    SELECT * FROM (SELECT id FROM jinbase_queue_record 
+        WHERE lease_expiry IS NULL ORDER BY id DESC LIMIT 1) 
+    UNION ALL 
+    SELECT MAX(+id) FROM jinbase_queue_record WHERE lease_expiry <= ?)
+"""
+QUEUE_CRITERIA = "AND (r.lease_expiry IS NULL OR r.lease_expiry <= {now})"
+# the next expiry of a lease is the first entry of the lease_expiry index
+# that isn't NULL
+GET_NEXT_LEASE_EXPIRY = """
+SELECT MIN(lease_expiry) FROM jinbase_queue_record
+"""
+# expired leases are found by a range scan of the lease_expiry index
+GET_EXPIRED_LEASES = """
+SELECT id FROM jinbase_queue_record 
+    WHERE lease_expiry <= ? ORDER BY lease_expiry, id LIMIT ?
+"""
+GET_QUEUE_FRONT_UIDS = """
+SELECT id FROM jinbase_queue_record WHERE lease_expiry IS NULL ORDER BY id LIMIT ?
+"""
+SET_LEASES = """
+UPDATE jinbase_queue_record SET lease_expiry = ?, lease_token = ? 
+    WHERE id IN ({placeholders})
+"""
+# the token of a lease is its receipt: a lease that expired
+# and was given to another consumer can't be acknowledged
+ACK_LEASE = """
+DELETE FROM jinbase_queue_record 
+    WHERE id = ? AND lease_expiry IS NOT NULL AND lease_token = ?
+"""
+NACK_LEASE = """
+UPDATE jinbase_queue_record SET lease_expiry = NULL, lease_token = NULL 
+    WHERE id = ? AND lease_expiry IS NOT NULL AND lease_token = ?
+"""
+COUNT_LEASES = """
+SELECT COUNT(*) FROM jinbase_queue_record WHERE lease_expiry IS NOT NULL
 """
 ENQUEUE = """
 INSERT INTO jinbase_queue_record (datatype, timestamp) VALUES (?, ?)
@@ -327,7 +885,8 @@ STACK_PUSH = """
 INSERT INTO jinbase_stack_record (datatype, timestamp) VALUES (?, ?)
 """
 GET_STACK_TOP = """
-SELECT id, datatype, timestamp FROM jinbase_stack_record ORDER BY id DESC LIMIT 1
+SELECT id, datatype, timestamp, payload FROM jinbase_stack_record 
+    ORDER BY id DESC LIMIT 1
 """
 GET_STACK_TOP_UID = """
 SELECT id FROM jinbase_stack_record ORDER BY id DESC LIMIT 1
@@ -0,0 +1,249 @@
+"""The ShardedJinbase class is defined here."""
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from jinbase import Jinbase
+from jinbase.const import Model, SHARD_VNODES
+from jinbase.sharding.store import (ShardedKv, ShardedDepot,
+                                    ShardedQueue, ShardedStack)
+
+
+__all__ = ["ShardedJinbase", "HashRing"]
+
+
+class ShardedJinbase:
+    """Jinbase spread across many database files (shards), so that
+    writers on different shards proceed in parallel, each file having
+    its own write lock. Kv keys are routed to shards by consistent hashing.
+    Depot, Queue, and Stack records are routed by an optional partition key,
+    else round-robin, and their uids are global: the shard of a record
+    is encoded in its uid.
+    Note that the order of filenames is the shard layout, thus it
+    must be the same across sessions. A ShardedJinbase object is intended
+    to be directly instantiated by the user."""
+    def __init__(self, filenames, *, n_vnodes=SHARD_VNODES,
+                 max_workers=None, **kwargs):
+        """
+        Init.
+
+        [params]
+        - filenames: Sequence of the filenames of the shards
+        - n_vnodes: Number of points of each shard on the hash ring.
+            Defaults to `jinbase.const.SHARD_VNODES`.
+        - max_workers: Max number of threads used to fan out operations
+            to shards. Defaults to the number of shards.
+        - kwargs: Keyword arguments passed to each Jinbase instance
+            (timeout, chunk_size, kv_cache_size, ...)
+        """
+        filenames = tuple(filenames)
+        if not filenames:
+            msg = "At least one filename is required"
+            raise Exception(msg)
+        if None in filenames or len(set(filenames)) != len(filenames):
+            msg = "Shard filenames should be distinct and not None"
+            raise Exception(msg)
+        self._shards = list()
+        try:
+            for filename in filenames:
+                self._shards.append(Jinbase(filename, **kwargs))
+        except Exception as e:
+            for shard in self._shards:
+                shard.close()
+            raise
+        self._shards = tuple(self._shards)
+        self._ring = HashRing(len(self._shards), n_vnodes=n_vnodes)
+        max_workers = max_workers if max_workers else len(self._shards)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="jinbase-shard")
+        # stores
+        self._kv = ShardedKv(self)
+        self._depot = ShardedDepot(self)
+        self._queue = ShardedQueue(self)
+        self._stack = ShardedStack(self)
+
+    @property
+    def kv(self):
+        return self._kv
+
+    @property
+    def depot(self):
+        return self._depot
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def stack(self):
+        return self._stack
+
+    @property
+    def shards(self):
+        """The tuple of Jinbase instances"""
+        return self._shards
+
+    @property
+    def n_shards(self):
+        return len(self._shards)
+
+    @property
+    def filenames(self):
+        return tuple(shard.filename for shard in self._shards)
+
+    @property
+    def ring(self):
+        """The HashRing instance"""
+        return self._ring
+
+    @property
+    def is_closed(self):
+        return all(shard.is_closed for shard in self._shards)
+
+    def shard_index(self, key):
+        """Returns the index of the shard of a Kv key or partition key"""
+        return self._ring.get_shard(key)
+
+    def shard(self, key):
+        """Returns the Jinbase instance of a Kv key or partition key"""
+        return self._shards[self._ring.get_shard(key)]
+
+    def scan(self):
+        """
+        Scan the shards
+
+        [returns]
+        A dictionary object whose keys are jinbase.Model namedtuples
+        and values are tuples of the total record count and total byte count.
+        """
+        result = {model: (0, 0) for model in Model}
+        for scan in self.fan_out(lambda shard: shard.scan()):
+            for model, (n_records, n_bytes) in scan.items():
+                x, y = result[model]
+                result[model] = (x + n_records, y + n_bytes)
+        return result
+
+    def count_records(self):
+        return sum(self.fan_out(lambda shard: shard.count_records()))
+
+    def count_bytes(self):
+        return sum(self.fan_out(lambda shard: shard.count_bytes()))
+
+    def count_chunks(self):
+        return sum(self.fan_out(lambda shard: shard.count_chunks()))
+
+    def latest(self):
+        """Returns the utc datetime string of the latest operation"""
+        results = [x for x in self.fan_out(lambda shard: shard.latest())
+                   if x is not None]
+        return max(results) if results else None
+
+    def vacuum(self):
+        """Vacuum the shards"""
+        self.fan_out(lambda shard: shard.vacuum())
+
+    def fan_out(self, func, indexes=None):
+        """
+        Call a function with the Jinbase instance of each shard,
+        in parallel when there are many shards.
+
+        [params]
+        - func: Function that accepts a Jinbase instance
+        - indexes: Optional iterable of shard indexes. Defaults to all shards.
+
+        [return]
+        Returns the list of results, in the order of shard indexes
+        """
+        indexes = range(len(self._shards)) if indexes is None else indexes
+        return self._map(func, [self._shards[i] for i in indexes])
+
+    def close(self):
+        """Close the connections"""
+        self._executor.shutdown()
+        for shard in self._shards:
+            shard.close()
+
+    def destroy(self):
+        """Destroy the database files"""
+        self._executor.shutdown()
+        for shard in self._shards:
+            shard.destroy()
+
+    def _map(self, func, items):
+        """Map a function over items with the thread pool"""
+        items = list(items)
+        if len(items) < 2:
+            return [func(item) for item in items]
+        return list(self._executor.map(func, items))
+
+    def _to_global_uid(self, index, uid):
+        return None if uid is None else uid * len(self._shards) + index
+
+    def _to_local_uid(self, uid):
+        """Returns the tuple (shard index, local uid)"""
+        index = uid % len(self._shards)
+        return index, uid // len(self._shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to shard indexes.
+    Each shard owns `n_vnodes` points on the ring and a key belongs
+    to the shard of the first point that follows its hash.
+    This class isn't intended to be directly instantiated by the user."""
+    def __init__(self, n_shards, n_vnodes=SHARD_VNODES):
+        """
+        Init.
+
+        [params]
+        - n_shards: Number of shards
+        - n_vnodes: Number of points of each shard on the ring
+        """
+        self._n_shards = int(n_shards)
+        self._n_vnodes = max(int(n_vnodes), 1)
+        points = sorted((_hash("shard-{}-{}".format(index, vnode).encode()), index)
+                        for index in range(self._n_shards)
+                        for vnode in range(self._n_vnodes))
+        self._hashes = [h for h, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @property
+    def n_shards(self):
+        return self._n_shards
+
+    @property
+    def n_vnodes(self):
+        return self._n_vnodes
+
+    def get_shard(self, key):
+        """
+        Get the shard of an integer or string key.
+        Numeric strings are treated as integers, like Kv keys.
+
+        [return]
+        Returns the shard index
+        """
+        if self._n_shards == 1:
+            return 0
+        i = bisect.bisect(self._hashes, _hash(_get_key_bytes(key)))
+        return self._indexes[i % len(self._hashes)]
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          "big")
+
+
+def _get_key_bytes(key):
+    if isinstance(key, str) and key.isnumeric():
+        key = int(key)
+    if isinstance(key, int):
+        return b"i" + str(key).encode()
+    if isinstance(key, str):
+        return b"s" + key.encode("utf-8", "surrogatepass")
+    msg = "Key should be either an integer or a string."
+    raise Exception(msg)
@@ -0,0 +1,668 @@
+"""The stores of ShardedJinbase are defined in this module."""
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from jinbase import queries
+from jinbase.const import Model
+from jinbase.store.kv import _ensure_key
+
+
+__all__ = ["ShardedStore", "ShardedKv", "ShardedDepot",
+           "ShardedQueue", "ShardedStack"]
+
+
+# sentinel for empty shards
+MISSING = object()
+
+
+class ShardedStore:
+    """Base class of the stores of ShardedJinbase. Store-wide operations
+    are fanned out to the shards and their results are merged.
+    Note that a sharded store isn't intended to be directly
+    instantiated by the user."""
+    def __init__(self, model, sharded_jinbase):
+        """
+        Init
+
+        [params]
+        - model: A jinbase.Model instance
+        - sharded_jinbase: ShardedJinbase object
+        """
+        self._model = model
+        self._sharded_jinbase = sharded_jinbase
+        self._store_name = model.name.lower()
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def sharded_jinbase(self):
+        return self._sharded_jinbase
+
+    @property
+    def stores(self):
+        """The tuple of the stores of the shards"""
+        return tuple(self._get_store(shard)
+                     for shard in self._sharded_jinbase.shards)
+
+    def count_records(self):
+        return sum(self._fan_out(lambda store: store.count_records()))
+
+    def count_bytes(self):
+        return sum(self._fan_out(lambda store: store.count_bytes()))
+
+    def count_chunks(self):
+        return sum(self._fan_out(lambda store: store.count_chunks()))
+
+    def is_empty(self):
+        return self.count_records() == 0
+
+    def latest(self):
+        """Returns the datetime string of the latest write operation"""
+        results = [x for x in self._fan_out(lambda store: store.latest())
+                   if x is not None]
+        return max(results) if results else None
+
+    def delete_all(self):
+        """Delete all records in the store"""
+        self._fan_out(lambda store: store.delete_all())
+
+    def _get_store(self, shard):
+        return getattr(shard, self._store_name)
+
+    def _store_at(self, index):
+        return self._get_store(self._sharded_jinbase.shards[index])
+
+    def _fan_out(self, func, indexes=None):
+        return self._sharded_jinbase.fan_out(lambda shard: func(self._get_store(shard)),
+                                             indexes=indexes)
+
+
+class ShardedKv(ShardedStore):
+    """
+    This class represents the Kv store of ShardedJinbase.
+    Keys are routed to shards by consistent hashing. Uids are global,
+    that is, the shard of a record is encoded in its uid.
+    """
+    def __init__(self, sharded_jinbase):
+        super().__init__(Model.KV, sharded_jinbase)
+
+    def exists(self, key):
+        return self._route(key).exists(key)
+
+    def info(self, key):
+        index, kv = self._route_with_index(key)
+        r = kv.info(key)
+        if r is None:
+            return
+        return r._replace(uid=self._sharded_jinbase._to_global_uid(index, r.uid))
+
+    def get(self, key, default=None):
+        return self._route(key).get(key, default=default)
+
+    def get_with_version(self, key, default=None):
+        return self._route(key).get_with_version(key, default=default)
+
+    def get_many(self, keys, default=None):
+        """Keys are grouped by shard and each group is fetched
+        in parallel with the set-based `Kv.get_many` method"""
+        keys = list(keys)
+        result = dict()
+        for r in self._map_groups(keys, lambda kv, group: kv.get_many(group,
+                                                                      default=default)):
+            result.update(r)
+        return {key: result[key] for key in map(_ensure_key, keys)}
+
+    def set(self, key, value, ttl=None):
+        index, kv = self._route_with_index(key)
+        uid = kv.set(key, value, ttl=ttl)
+        return self._sharded_jinbase._to_global_uid(index, uid)
+
+    def compare_and_set(self, key, expected_version, value, ttl=None):
+        return self._route(key).compare_and_set(key, expected_version,
+                                                value, ttl=ttl)
+
+    def replace(self, key, value):
+        index, kv = self._route_with_index(key)
+        return self._sharded_jinbase._to_global_uid(index, kv.replace(key, value))
+
+    def update(self, dict_data):
+        """Keys are grouped by shard and each group is written in parallel,
+        inside a write transaction per shard"""
+        data = dict(dict_data)
+        groups = self._group(data)
+
+        def func(index):
+            group = {key: data[key] for key in groups[index]}
+            uids = self._store_at(index).update(group)
+            return {key: self._sharded_jinbase._to_global_uid(index, uid)
+                    for key, uid in uids.items()}
+        result = dict()
+        for r in self._sharded_jinbase._map(func, sorted(groups)):
+            result.update(r)
+        return {key: result[key] for key in data}
+
+    def patch(self, key, changes):
+        index, kv = self._route_with_index(key)
+        return self._sharded_jinbase._to_global_uid(index, kv.patch(key, changes))
+
+    def incr(self, key, delta=1):
+        return self._route(key).incr(key, delta=delta)
+
+    def decr(self, key, delta=1):
+        return self._route(key).decr(key, delta=delta)
+
+    def incr_many(self, deltas):
+        data = dict(deltas)
+        groups = self._group(data)
+
+        def func(index):
+            return self._store_at(index).incr_many({key: data[key]
+                                                    for key in groups[index]})
+        result = dict()
+        for r in self._sharded_jinbase._map(func, sorted(groups)):
+            result.update(r)
+        return {key: result[key] for key in data}
+
+    def keys(self, *, after=None, time_range=None, limit=None, asc=True):
+        """Keys of the shards are merged in the sort order of `Kv.keys`"""
+        yield from self._merge_keys(lambda kv: kv.keys(after=after,
+                                                       time_range=time_range,
+                                                       limit=limit, asc=asc),
+                                    limit, asc)
+
+    def int_keys(self, first=None, last=None, *, after=None, time_range=None,
+                 limit=None, asc=True):
+        yield from self._merge_keys(lambda kv: kv.int_keys(first, last,
+                                                           after=after,
+                                                           time_range=time_range,
+                                                           limit=limit, asc=asc),
+                                    limit, asc)
+
+    def str_keys(self, glob=None, *, prefix=None, after=None, time_range=None,
+                 limit=None, asc=True):
+        yield from self._merge_keys(lambda kv: kv.str_keys(glob, prefix=prefix,
+                                                           after=after,
+                                                           time_range=time_range,
+                                                           limit=limit, asc=asc),
+                                    limit, asc)
+
+    def iterate(self, *, time_range=None, limit=None, asc=True):
+        """Records of the shards are merged in the sort order of `Kv.keys`"""
+        iterators = [kv.iterate(time_range=time_range, limit=limit, asc=asc)
+                     for kv in self.stores]
+        items = heapq.merge(*iterators, key=lambda item: _get_sort_key(item[0]),
+                            reverse=not asc)
+        yield from itertools.islice(items, limit)
+
+    def uid(self, key):
+        index, kv = self._route_with_index(key)
+        return self._sharded_jinbase._to_global_uid(index, kv.uid(key))
+
+    def key(self, uid):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).key(uid)
+
+    def count_bytes(self, key=None):
+        if key is None:
+            return super().count_bytes()
+        return self._route(key).count_bytes(key)
+
+    def count_chunks(self, key=None):
+        if key is None:
+            return super().count_chunks()
+        return self._route(key).count_chunks(key)
+
+    @contextmanager
+    def open_blob(self, key):
+        with self._route(key).open_blob(key) as blob:
+            yield blob
+
+    def load_field(self, key, field, default=None):
+        return self._route(key).load_field(key, field, default=default)
+
+    def load_fields(self, key, fields, default=None):
+        return self._route(key).load_fields(key, fields, default=default)
+
+    def fields(self):
+        """Returns the sorted tuple of pointed fields across shards"""
+        fields = set()
+        for r in self._fan_out(lambda kv: tuple(kv.fields())):
+            fields.update(r)
+        return tuple(sorted(fields))
+
+    def create_index(self, field):
+        """Create the index on each shard. Returns False if the field
+        was already indexed on every shard, else True"""
+        return any(self._fan_out(lambda kv: kv.create_index(field)))
+
+    def drop_index(self, field):
+        return any(self._fan_out(lambda kv: kv.drop_index(field)))
+
+    def indexes(self):
+        indexes = set()
+        for r in self._fan_out(lambda kv: kv.indexes()):
+            indexes.update(r)
+        return tuple(sorted(indexes))
+
+    def find(self, field, value=None, *, first=None, last=None,
+             limit=None, asc=True):
+        """Find keys by the value of an indexed field.
+        Keys are sorted by field value within each shard only,
+        and shards are visited one after another."""
+        keys = itertools.chain.from_iterable(kv.find(field, value, first=first,
+                                                     last=last, limit=limit,
+                                                     asc=asc)
+                                             for kv in self.stores)
+        yield from itertools.islice(keys, limit)
+
+    def delete(self, key):
+        return self._route(key).delete(key)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        deleted = set()
+        for r in self._map_groups(keys, lambda kv, group: kv.delete_many(group)):
+            deleted.update(r)
+        return tuple(key for key in keys if key in deleted)
+
+    def purge_expired(self, *args, **kwargs):
+        return sum(self._fan_out(lambda kv: kv.purge_expired(*args, **kwargs)))
+
+    def _route(self, key):
+        return self._sharded_jinbase.shard(key).kv
+
+    def _route_with_index(self, key):
+        index = self._sharded_jinbase.shard_index(key)
+        return index, self._store_at(index)
+
+    def _group(self, keys):
+        """Returns a dict mapping shard indexes to lists of keys"""
+        groups = dict()
+        for key in keys:
+            index = self._sharded_jinbase.shard_index(key)
+            groups.setdefault(index, list()).append(key)
+        return groups
+
+    def _map_groups(self, keys, func):
+        """Group keys by shard, then call `func(kv, group)` per shard"""
+        groups = self._group(keys)
+        return self._sharded_jinbase._map(lambda index: func(self._store_at(index),
+                                                             groups[index]),
+                                          sorted(groups))
+
+    def _merge_keys(self, get_keys, limit, asc):
+        iterators = [get_keys(kv) for kv in self.stores]
+        keys = heapq.merge(*iterators, key=_get_sort_key, reverse=not asc)
+        yield from itertools.islice(keys, limit)
+
+
+class ShardedRecordStore(ShardedStore):
+    """Base class of the sharded Depot, Queue, and Stack stores.
+    A record is written to the shard of its partition key if any,
+    else shards are filled round-robin. Uids are global: the uid of
+    a record is its local uid times the number of shards, plus the
+    index of its shard. Global uids are planned from a single counter,
+    resumed from the AUTOINCREMENT sequences of the shards, and the
+    sequence of a shard is raised before a write so that its records
+    get the planned uids. Thus, sorting uids preserves the insertion
+    order, across sessions and partition keys. Only writes of other
+    ShardedJinbase instances at the same time may interleave."""
+    def __init__(self, model, sharded_jinbase):
+        super().__init__(model, sharded_jinbase)
+        self._next_uid = None
+        self._lock = threading.Lock()
+
+    def _plan_uids(self, n, partition_key=None):
+        """Returns the global uids planned for the next n records"""
+        n_shards = self._sharded_jinbase.n_shards
+        with self._lock:
+            if self._next_uid is None:
+                self._next_uid = self._load_next_uid()
+            uid = self._next_uid
+            if partition_key is None:
+                uids = list(range(uid, uid + n))
+            else:
+                index = self._sharded_jinbase.shard_index(partition_key)
+                uid += (index - uid) % n_shards
+                uids = list(range(uid, uid + n * n_shards, n_shards))
+            if uids:
+                self._next_uid = uids[-1] + 1
+            return uids
+
+    def _load_next_uid(self):
+        """Returns the global uid that follows the largest one ever
+        given by the shards"""
+        def get_sequence(shard):
+            with shard.dbc.cursor() as cur:
+                cur.execute(queries.GET_SEQUENCE, (self._get_table(), ))  # read
+                r = cur.fetchone()
+                return 0 if r is None or r[0] is None else r[0]
+        sequences = self._sharded_jinbase.fan_out(get_sequence)
+        return max(self._sharded_jinbase._to_global_uid(index, seq)
+                   for index, seq in enumerate(sequences)) + 1
+
+    def _write(self, index, local_uid, func):
+        """Call func with the store of a shard inside a write transaction
+        in which the next local uid of the shard is raised to `local_uid`.
+        Returns the result of func"""
+        shard = self._sharded_jinbase.shards[index]
+        table = self._get_table()
+        with shard.write_transaction() as cur:
+            cur.execute(queries.RAISE_SEQUENCE, (local_uid - 1, table))  # write
+            if cur.rowcount == 0:
+                cur.execute(queries.ADD_SEQUENCE, (table, local_uid - 1))  # write
+            return func(self._store_at(index))
+
+    def _insert(self, method_name, value, partition_key=None):
+        uid = self._plan_uids(1, partition_key)[0]
+        index, local_uid = self._sharded_jinbase._to_local_uid(uid)
+        uid = self._write(index, local_uid,
+                          lambda store: getattr(store, method_name)(value))
+        uid = self._sharded_jinbase._to_global_uid(index, uid)
+        self._skip_uids(uid)
+        return uid
+
+    def _insert_many(self, method_name, values, partition_key=None):
+        values = list(values)
+        planned_uids = self._plan_uids(len(values), partition_key)
+        groups = dict()
+        for i, uid in enumerate(planned_uids):
+            index, local_uid = self._sharded_jinbase._to_local_uid(uid)
+            groups.setdefault(index, list()).append((i, local_uid))
+
+        def func(index):
+            items = groups[index]
+            batch = [values[i] for i, _ in items]
+            uids = self._write(index, items[0][1],
+                               lambda store: getattr(store, method_name)(batch))
+            return index, uids
+        result = [None] * len(values)
+        for index, uids in self._sharded_jinbase._map(func, sorted(groups)):
+            for (i, _), uid in zip(groups[index], uids):
+                result[i] = self._sharded_jinbase._to_global_uid(index, uid)
+        if result:
+            self._skip_uids(max(result))
+        return tuple(result)
+
+    def _skip_uids(self, uid):
+        """Make sure the next planned uid follows `uid`, in case
+        a record got a larger uid than planned (concurrent writers)"""
+        with self._lock:
+            self._next_uid = max(self._next_uid, uid + 1)
+
+    def _get_table(self):
+        return "jinbase_{}_record".format(self._store_at(0).model_name)
+
+    def _get_uids(self, method_name):
+        """Call a uid method on each shard.
+        Returns the sorted list of global uids"""
+        uids = self._fan_out(lambda store: getattr(store, method_name)())
+        return sorted(self._sharded_jinbase._to_global_uid(index, uid)
+                      for index, uid in enumerate(uids) if uid is not None)
+
+    def _take(self, method_name, uids, default):
+        """Call a method on the shards of the given global uids,
+        in order, until a shard returns a record"""
+        for uid in uids:
+            index, _ = self._sharded_jinbase._to_local_uid(uid)
+            value = getattr(self._store_at(index), method_name)(default=MISSING)
+            if value is not MISSING:
+                return value
+        return default
+
+    def _globalize_info(self, index, info):
+        if info is None:
+            return
+        return info._replace(uid=self._sharded_jinbase._to_global_uid(index, info.uid))
+
+
+class ShardedDepot(ShardedRecordStore):
+    """
+    This class represents the Depot store of ShardedJinbase.
+    Note that the positional methods `uid` and `position` of Depot
+    aren't supported as they would require a global ordering of records.
+    """
+    def __init__(self, sharded_jinbase):
+        super().__init__(Model.DEPOT, sharded_jinbase)
+
+    def exists(self, uid):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).exists(uid)
+
+    def info(self, uid):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._globalize_info(index, self._store_at(index).info(uid))
+
+    def get(self, uid, default=None):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).get(uid, default=default)
+
+    def get_first(self, default=None):
+        uids = self._get_first_uids(asc=True)
+        return self.get(uids[0], default=default) if uids else default
+
+    def get_last(self, default=None):
+        uids = self._get_first_uids(asc=False)
+        return self.get(uids[-1], default=default) if uids else default
+
+    def append(self, value, partition_key=None):
+        """
+        Append a value to the shard of the partition key if any,
+        else to the next shard in round-robin order.
+
+        [return]
+        Returns the global uid
+        """
+        if value is None:
+            return
+        return self._insert("append", value, partition_key)
+
+    def extend(self, values, partition_key=None):
+        return self._insert_many("extend", values, partition_key)
+
+    def uids(self, *, time_range=None, limit=None, asc=True):
+        """Global uids of the shards are merged in sorted order"""
+        iterators = [self._iterate_uids(index, store.uids(time_range=time_range,
+                                                          limit=limit, asc=asc))
+                     for index, store in enumerate(self.stores)]
+        uids = heapq.merge(*iterators, reverse=not asc)
+        yield from itertools.islice(uids, limit)
+
+    def iterate(self, *, time_range=None, limit=None, asc=True):
+        iterators = [self._iterate_records(index, store.iterate(time_range=time_range,
+                                                                limit=limit, asc=asc))
+                     for index, store in enumerate(self.stores)]
+        items = heapq.merge(*iterators, key=lambda item: item[0], reverse=not asc)
+        yield from itertools.islice(items, limit)
+
+    def count_bytes(self, uid=None):
+        if uid is None:
+            return super().count_bytes()
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).count_bytes(uid)
+
+    def count_chunks(self, uid=None):
+        if uid is None:
+            return super().count_chunks()
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).count_chunks(uid)
+
+    @contextmanager
+    def open_blob(self, uid):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        with self._store_at(index).open_blob(uid) as blob:
+            yield blob
+
+    def load_field(self, uid, field, default=None):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).load_field(uid, field, default=default)
+
+    def load_fields(self, uid, fields, default=None):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).load_fields(uid, fields, default=default)
+
+    def create_index(self, field):
+        return any(self._fan_out(lambda store: store.create_index(field)))
+
+    def drop_index(self, field):
+        return any(self._fan_out(lambda store: store.drop_index(field)))
+
+    def indexes(self):
+        indexes = set()
+        for r in self._fan_out(lambda store: store.indexes()):
+            indexes.update(r)
+        return tuple(sorted(indexes))
+
+    def find(self, field, value=None, *, first=None, last=None,
+             limit=None, asc=True):
+        """Find global uids by the value of an indexed field.
+        Uids are sorted by field value within each shard only,
+        and shards are visited one after another."""
+        uids = itertools.chain.from_iterable(
+            self._iterate_uids(index, store.find(field, value, first=first,
+                                                 last=last, limit=limit,
+                                                 asc=asc))
+            for index, store in enumerate(self.stores))
+        yield from itertools.islice(uids, limit)
+
+    def delete(self, uid):
+        index, uid = self._sharded_jinbase._to_local_uid(uid)
+        return self._store_at(index).delete(uid)
+
+    def delete_many(self, uids):
+        uids = list(uids)
+        groups = dict()
+        for uid in uids:
+            index, local_uid = self._sharded_jinbase._to_local_uid(uid)
+            groups.setdefault(index, list()).append(local_uid)
+
+        def func(index):
+            deleted = self._store_at(index).delete_many(groups[index])
+            return [self._sharded_jinbase._to_global_uid(index, uid)
+                    for uid in deleted]
+        deleted = set()
+        for r in self._sharded_jinbase._map(func, sorted(groups)):
+            deleted.update(r)
+        return tuple(uid for uid in uids if uid in deleted)
+
+    def _get_first_uids(self, asc):
+        uids = self._fan_out(lambda store: next(store.uids(limit=1, asc=asc),
+                                                None))
+        return sorted(self._sharded_jinbase._to_global_uid(index, uid)
+                      for index, uid in enumerate(uids) if uid is not None)
+
+    def _iterate_uids(self, index, uids):
+        for uid in uids:
+            yield self._sharded_jinbase._to_global_uid(index, uid)
+
+    def _iterate_records(self, index, records):
+        for uid, value in records:
+            yield self._sharded_jinbase._to_global_uid(index, uid), value
+
+
+class ShardedQueue(ShardedRecordStore):
+    """
+    This class represents the Queue store of ShardedJinbase.
+    The front of the queue is the record with the smallest global uid
+    among the fronts of the shards. Since global uids follow the
+    insertion order, the order is FIFO across shards.
+    """
+    def __init__(self, sharded_jinbase):
+        super().__init__(Model.QUEUE, sharded_jinbase)
+
+    def enqueue(self, value, partition_key=None):
+        """
+        Enqueue a value to the shard of the partition key if any,
+        else to the next shard in round-robin order.
+
+        [return]
+        Returns the global uid
+        """
+        if value is None:
+            return
+        return self._insert("enqueue", value, partition_key)
+
+    def enqueue_many(self, values, partition_key=None):
+        return self._insert_many("enqueue_many", values, partition_key)
+
+    def dequeue(self, default=None):
+        return self._take("dequeue", self._get_uids("front_uid"), default)
+
+    def peek_front(self, default=None):
+        return self._take("peek_front", self._get_uids("front_uid"), default)
+
+    def peek_back(self, default=None):
+        return self._take("peek_back", self._get_uids("back_uid")[::-1], default)
+
+    def front_uid(self):
+        uids = self._get_uids("front_uid")
+        return uids[0] if uids else None
+
+    def back_uid(self):
+        uids = self._get_uids("back_uid")
+        return uids[-1] if uids else None
+
+    def info_front(self):
+        uid = self.front_uid()
+        if uid is None:
+            return
+        index, _ = self._sharded_jinbase._to_local_uid(uid)
+        return self._globalize_info(index, self._store_at(index).info_front())
+
+    def info_back(self):
+        uid = self.back_uid()
+        if uid is None:
+            return
+        index, _ = self._sharded_jinbase._to_local_uid(uid)
+        return self._globalize_info(index, self._store_at(index).info_back())
+
+
+class ShardedStack(ShardedRecordStore):
+    """
+    This class represents the Stack store of ShardedJinbase.
+    The top of the stack is the record with the largest global uid
+    among the tops of the shards. Since global uids follow the
+    insertion order, the order is LIFO across shards.
+    """
+    def __init__(self, sharded_jinbase):
+        super().__init__(Model.STACK, sharded_jinbase)
+
+    def push(self, value, partition_key=None):
+        """
+        Push a value to the shard of the partition key if any,
+        else to the next shard in round-robin order.
+
+        [return]
+        Returns the global uid
+        """
+        if value is None:
+            return
+        return self._insert("push", value, partition_key)
+
+    def push_many(self, values, partition_key=None):
+        return self._insert_many("push_many", values, partition_key)
+
+    def pop(self, default=None):
+        return self._take("pop", self._get_uids("top_uid")[::-1], default)
+
+    def peek(self, default=None):
+        return self._take("peek", self._get_uids("top_uid")[::-1], default)
+
+    def top_uid(self):
+        uids = self._get_uids("top_uid")
+        return uids[-1] if uids else None
+
+    def info_top(self):
+        uid = self.top_uid()
+        if uid is None:
+            return
+        index, _ = self._sharded_jinbase._to_local_uid(uid)
+        return self._globalize_info(index, self._store_at(index).info_top())
+
+
+def _get_sort_key(key):
+    # integer keys come before string keys
+    return (0, key, "") if isinstance(key, int) else (1, 0, key)
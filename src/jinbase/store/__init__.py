@@ -1,18 +1,24 @@
 """The abstract Store class is defined in this module."""
+import time
+import threading
 from abc import ABC
+from itertools import groupby, chain
 from collections import namedtuple
-from paradict import Unpacker, Packer, Datatype
+from paradict import Unpacker, Packer, Datatype, unpack
 from litedbc import TransactionMode
 from jinbase import misc
 from jinbase import queries
-from jinbase.const import Model
+from jinbase.blob import Blob
+from jinbase.const import (Model, BATCH_SIZE, BATCH_BYTES,
+                           FOLLOW_MIN_INTERVAL, FOLLOW_MAX_INTERVAL)
 
 
 __all__ = ["Store", "RecordInfo"]
 
 
 RecordInfo = namedtuple("RecordInfo",
-                        ("uid", "datatype", "created_at"))
+                        ("uid", "datatype", "created_at", "version"),
+                        defaults=(None, ))
 RecordInfo.__doc__ = """\
 Named tuple returned by store.info()
 
@@ -20,32 +26,44 @@ Named tuple returned by store.info()
 uid: The record id
 datatype: An instance of `paradict.Datatype`
 created_at: Datetime string representing the creation datetime of the record
+version: Number incremented on each write of a Kv record (None for other stores)
 """
 
 
 class Store(ABC):
     """Abstract Store class intended to be subclassed by the
     Kv, Depot, Queue, and Stack stores"""
-    def __init__(self, model, jinbase):
+    def __init__(self, model, jinbase, model_name=None):
         """Init.
 
         [params]
         - model: A Model namedtuple instance
         - jinbase: Jinbase instance
+        - model_name: Name used in the names of the tables of the store.
+            Defaults to the lowercased name of the model.
         """
         self._model = Model(model)
-        self._model_name = self._model.name.lower()
+        self._model_name = (self._model.name.lower() if model_name is None
+                            else model_name)
         self._jinbase = jinbase
         self._db_epoch = jinbase.created_at
         self._timestamp_precision = jinbase.timestamp_precision
         self._dbc = jinbase.dbc
         self._type_ref = jinbase.type_ref
         self._chunk_size = jinbase.chunk_size
+        self._inline_size = min(jinbase.inline_size, self._chunk_size)
+        # notified after local writes, to wake up waiting readers
+        self._written = threading.Condition()
+        self._n_writes = 0
 
     @property
     def model(self):
         return self._model
 
+    @property
+    def model_name(self):
+        return self._model_name
+
     @property
     def jinbase(self):
         return self._jinbase
@@ -70,6 +88,10 @@ class Store(ABC):
     def chunk_size(self):
         return self._jinbase.chunk_size
 
+    @property
+    def inline_size(self):
+        return self._inline_size
+
     @property
     def dbc(self):
         return self._dbc
@@ -202,54 +224,689 @@ class Store(ABC):
             sql = queries.DELETE_RECORDS.format(model=self._model_name)
             cur.execute(sql)  # write
 
-    def _store_data(self, record_id, datatype, value):
+    def _load_fields(self, record_id, fields, default=None):
+        """Load many top-level fields of a dict record. Pointers are
+        fetched with a single query and only the bytes of the requested
+        fields are read, through a single Blob session.
+        Returns a dict mapping each field to its value or `default`."""
+        result = dict.fromkeys(fields, default)
+        if record_id is None or not result:
+            return result
+        with self._dbc.transaction() as cur:
+            pointers = list()
+            for batch in misc.split_batches(result.keys()):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.GET_POINTERS.format(model=self._model_name,
+                                                  placeholders=placeholders)
+                cur.execute(sql, (record_id, *batch))  # read
+                pointers.extend(cur.fetchall())
+            if not pointers:
+                return result
+            # read fields in storage order
+            pointers.sort(key=lambda x: x[1])
+            sql = queries.GET_RECORD_PAYLOAD.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))  # read
+            payload = cur.fetchone()[0]
+            if payload is not None:
+                for field, start, stop in pointers:
+                    data = payload[start:stop]
+                    result[field] = unpack(data, type_ref=self._type_ref)
+                return result
+            sql = queries.GET_CHUNK_SIZES.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))  # read
+            chunk_sizes = cur.fetchall()
+            chunk_ids = [chunk_id for chunk_id, _ in chunk_sizes]
+            n_bytes = sum(size for _, size in chunk_sizes)
+            blob = Blob(self, record_id, n_bytes, len(chunk_ids),
+                        chunk_ids=chunk_ids)
+            try:
+                for field, start, stop in pointers:
+                    data = blob[start:stop]  # read
+                    result[field] = unpack(data, type_ref=self._type_ref)
+            finally:
+                blob.close()
+            return result
+
+    def _create_index(self, field):
+        """Register a secondary index on a top-level field of dict records,
+        then backfill it from the existing records.
+        Returns False if the field was already indexed, else True."""
+        field = _ensure_field(field)
+        with self._dbc.immediate_transaction() as cur:
+            sql = queries.ADD_INDEXED_FIELD.format(model=self._model_name)
+            cur.execute(sql, (field, misc.now()))  # write
+            if cur.rowcount == 0:
+                return False
+            field_values = ((field, record_id, value)
+                            for record_id, value in self._iter_field_values(field)
+                            if _is_indexable(value))
+            sql = queries.ADD_FIELD_VALUE.format(model=self._model_name)
+            for batch in misc.split_batches(field_values):
+                cur.executemany(sql, batch)  # write
+            return True
+
+    def _drop_index(self, field):
+        """Delete a secondary index. Returns a boolean to tell
+        whether the index existed or not."""
+        with self._dbc.cursor() as cur:
+            sql = queries.DELETE_INDEXED_FIELD.format(model=self._model_name)
+            cur.execute(sql, (field, ))  # write
+            return cur.rowcount > 0
+
+    def _get_indexed_fields(self):
+        if self._model not in (Model.KV, Model.DEPOT):
+            return tuple()
         with self._dbc.cursor() as cur:
+            sql = queries.GET_INDEXED_FIELDS.format(model=self._model_name)
+            cur.execute(sql)  # read
+            return tuple(row[0] for row in cur.fetchall())
+
+    def _find(self, sql, field, value=None, first=None, last=None,
+              limit=None, asc=True, criteria=""):
+        """Run a FIND query against the secondary index of a field.
+        The `criteria` string is prepended to the value criteria.
+        Yields the first column of the rows."""
+        with self._dbc.transaction() as cur:
+            if field not in self._get_indexed_fields():  # read
+                msg = "The field '{}' isn't indexed".format(field)
+                raise Exception(msg)
+            criteria, params = [criteria], list()
+            for query, x in ((queries.INDEX_CRITERIA_1, value),
+                             (queries.INDEX_CRITERIA_2, first),
+                             (queries.INDEX_CRITERIA_3, last)):
+                if x is None:
+                    continue
+                if not _is_indexable(x):
+                    raise TypeError
+                criteria.append("AND {} ".format(query))
+                params.append(x)
+            criteria = "".join(criteria)
+            sql = sql.format(model=self._model_name, criteria=criteria,
+                             sort_order="ASC" if asc else "DESC",
+                             limit=misc.get_limit_spec(limit))
+            cur.execute(sql, (field, *params))  # read
+            for row in cur.fetch():
+                yield row[0]
+
+    def _index_data(self, record_id, datatype, value):
+        if datatype != Datatype.DICT:
+            return
+        indexed_fields = self._get_indexed_fields()  # read
+        if not indexed_fields:
+            return
+        with self._dbc.cursor() as cur:
+            sql = queries.ADD_FIELD_VALUE.format(model=self._model_name)
+            cur.executemany(sql, _get_field_values(record_id, value,
+                                                   indexed_fields))  # write
+
+    def _iter_field_values(self, field, criteria="", params=()):
+        """Yields (record_id, value) tuples for the records that have the
+        given top-level field. Only the bytes of the field are read from
+        the database and decoded.
+        The `criteria` string narrows the records and its placeholders
+        are bound to `params`."""
+        with self._dbc.cursor() as cur:
+            sql = queries.STREAM_FIELD_CHUNKS.format(model=self._model_name,
+                                                     chunk_size=self.chunk_size,
+                                                     criteria=criteria)
+            cur.execute(sql, (field, *params))  # read
+            for record_id, rows in groupby(cur.fetch(), key=lambda row: row[0]):
+                buffer = b"".join(piece for _, piece in rows)
+                yield record_id, unpack(buffer, type_ref=self._type_ref)
+
+    def _pack_data(self, datatype, value):
+        """Serialize a value ahead of a write transaction.
+        Returns a (payload, chunks, pointers) tuple to pass as
+        the `packed` argument of `_store_data` or `_rewrite_data`."""
+        pointers = list()
+        payload, chunks = self._split_payload(datatype, value, pointers)
+        chunks = [bytes(chunk) for chunk in chunks]
+        return payload, chunks, pointers
+
+    def _store_data(self, record_id, datatype, value, packed=None):
+        with self._dbc.cursor() as cur:
+            if packed is None:
+                pointers = list()
+                payload, chunks = self._split_payload(datatype, value,
+                                                      pointers)
+            else:
+                payload, chunks, pointers = packed
+            if payload is not None:
+                sql = queries.SET_RECORD_PAYLOAD.format(model=self._model_name)
+                cur.execute(sql, (payload, record_id))
             sql = queries.STORE_DATA.format(model=self._model_name)
-            if datatype == Datatype.BIN:
-                for chunk in misc.split_bin(value, chunk_size=self._chunk_size):
-                    cur.execute(sql, (record_id, chunk))
+            for chunk in chunks:
+                cur.execute(sql, (record_id, chunk))
+            # create pointers
+            if pointers:
+                sql = queries.ADD_POINTER.format(model=self._model_name)
+                cur.executemany(sql, [(field, record_id, start, stop)
+                                      for field, start, stop in pointers])
+            self._index_data(record_id, datatype, value)
+
+    def _store_many(self, entries, sql):
+        """Bulk insert new records and their data with `executemany`.
+        Record ids are assigned upfront (this method is intended to be
+        called inside a write transaction) and a single timestamp is
+        used for the whole batch.
+
+        [params]
+        - entries: Iterable of (datatype, value, params) tuples where params
+            are the values of the record columns following the id, datatype,
+            timestamp and payload columns in `sql`. None entries are skipped.
+        - sql: The INSERT statement for the record table
+
+        [return]
+        Returns a list of record ids, with None for skipped entries.
+        """
+        record_ids = list()
+        indexed_fields = self._get_indexed_fields()
+        with self._dbc.cursor() as cur:
+            sql_next_id = queries.GET_NEXT_RECORD_ID.format(model=self._model_name)
+            cur.execute(sql_next_id)  # read
+            record_id = cur.fetchone()[0]
+            db_timestamp = misc.get_timestamp(self._db_epoch, misc.now_dt(),
+                                              self._timestamp_precision)
+            records, chunks, pointers = list(), list(), list()
+            field_values = list()
+            n_bytes = 0
+            for entry in entries:
+                if entry is None:
+                    record_ids.append(None)
+                    continue
+                datatype, value, params = entry
+                fields = list()
+                payload, record_chunks = self._split_payload(datatype, value,
+                                                             fields)
+                records.append((record_id, datatype.value, db_timestamp,
+                                payload, *params))
+                if payload is not None:
+                    n_bytes += len(payload)
+                for chunk in record_chunks:
+                    chunks.append((record_id, chunk))
+                    n_bytes += len(chunk)
+                pointers.extend((field, record_id, start, stop)
+                                for field, start, stop in fields)
+                if indexed_fields and datatype == Datatype.DICT:
+                    field_values.extend(_get_field_values(record_id, value,
+                                                          indexed_fields))
+                record_ids.append(record_id)
+                record_id += 1
+                if len(records) >= BATCH_SIZE or n_bytes >= BATCH_BYTES:
+                    self._flush_many(sql, records, chunks,
+                                     pointers, field_values)  # write
+                    records, chunks, pointers = list(), list(), list()
+                    field_values = list()
+                    n_bytes = 0
+            self._flush_many(sql, records, chunks,
+                             pointers, field_values)  # write
+        return record_ids
+
+    def _flush_many(self, sql, records, chunks, pointers, field_values):
+        with self._dbc.cursor() as cur:
+            if records:
+                cur.executemany(sql, records)
+            if chunks:
+                sql = queries.STORE_DATA.format(model=self._model_name)
+                cur.executemany(sql, chunks)
+            if pointers:
+                sql = queries.ADD_POINTER.format(model=self._model_name)
+                cur.executemany(sql, pointers)
+            if field_values:
+                sql = queries.ADD_FIELD_VALUE.format(model=self._model_name)
+                cur.executemany(sql, field_values)
+
+    def _create_entry(self, value, params=()):
+        if value is None:
+            return
+        value = self._type_ref.adapt(value)
+        datatype = misc.ensure_datatype(value, self._type_ref)
+        if datatype is None:
+            raise TypeError
+        return datatype, value, params
+
+    def _rewrite_data(self, record_id, datatype, value, packed=None):
+        """Overwrite in place the data of an existing record.
+        Existing chunk slots are reused in order, only the chunks
+        and pointers that changed are written, and the slots left
+        unused by the new value are deleted."""
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_CHUNK_IDS.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))  # read
+            chunk_ids = [row[0] for row in cur.fetchall()]
+            if packed is None:
+                pointers = list()
+                payload, chunks = self._split_payload(datatype, value,
+                                                      pointers)
             else:
-                buffer = bytearray()
-                packer = Packer(type_ref=self._type_ref, auto_index=True)
-                for x in packer.pack(value):
-                    buffer.extend(x)
-                    while len(buffer) >= self._chunk_size:
-                        chunk = buffer[:self._chunk_size]
-                        del buffer[:self._chunk_size]
-                        cur.execute(sql, (record_id, chunk))
-                if buffer:
-                    cur.execute(sql, (record_id, buffer))
-                # create pointers
-                if datatype == Datatype.DICT and self._model in (Model.KV,
-                                                                 Model.DEPOT):
-                    sql = queries.ADD_POINTER.format(model=self._model_name)
-                    for field, slice_obj in packer.index_dict.items():
-                        if isinstance(field, str):
-                            cur.execute(sql, (field,
-                                              record_id,
-                                              slice_obj.start,
-                                              slice_obj.stop))
-
-    def _retrieve_data(self, record_id, datatype):
-        with self._dbc.cursor() as cur:
-            is_serialized = False if datatype == Datatype.BIN else True
-            sql = queries.RETRIEVE_DATA.format(model=self._model_name)
-            chunks = bytearray()
-            unpacker = Unpacker(type_ref=self._type_ref)
-            cur.execute(sql, (record_id, ))
-            for row in cur.fetch():
-                chunk = row[0]
-                if is_serialized:
-                    unpacker.feed(chunk)
+                payload, chunks, pointers = packed
+            sql = queries.SET_RECORD_PAYLOAD.format(model=self._model_name)
+            cur.execute(sql, (payload, record_id))  # write
+            update_sql = queries.UPDATE_CHUNK.format(model=self._model_name)
+            store_sql = queries.STORE_DATA.format(model=self._model_name)
+            n_chunks = 0
+            for chunk in chunks:
+                if n_chunks < len(chunk_ids):
+                    chunk_id = chunk_ids[n_chunks]
+                    cur.execute(update_sql, (chunk, chunk_id, chunk))  # write
                 else:
-                    chunks.extend(chunk)
-            if is_serialized:
-                return unpacker.data
+                    cur.execute(store_sql, (record_id, chunk))  # write
+                n_chunks += 1
+            for batch in misc.split_batches(chunk_ids[n_chunks:]):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.DELETE_CHUNKS.format(model=self._model_name,
+                                                   placeholders=placeholders)
+                cur.execute(sql, batch)  # write
+            if self._model in (Model.KV, Model.DEPOT):
+                self._rewrite_pointers(record_id, pointers)
+                sql = queries.DELETE_FIELD_VALUES.format(model=self._model_name)
+                cur.execute(sql, (record_id, ))  # write
+                self._index_data(record_id, datatype, value)
+
+    def _rewrite_pointers(self, record_id, pointers):
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_RECORD_POINTERS.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))  # read
+            old_pointers = {field: (start, stop)
+                            for field, start, stop in cur.fetchall()}
+            new_pointers = {field: (start, stop)
+                            for field, start, stop in pointers}
+            sql = queries.DELETE_POINTER.format(model=self._model_name)
+            cur.executemany(sql, [(field, record_id) for field in old_pointers
+                                  if field not in new_pointers])  # write
+            sql = queries.SET_POINTER.format(model=self._model_name)
+            cur.executemany(sql, [(field, record_id, start, stop)
+                                  for field, (start, stop) in new_pointers.items()
+                                  if old_pointers.get(field) != (start, stop)])  # write
+
+    def _patch_data(self, record_id, changes):
+        """Overwrite in place some top-level fields of a dict record.
+        The pointers locate the bytes to replace, so only the chunks
+        holding these bytes are rewritten when the new values have the
+        same size as the old ones. Otherwise, the following bytes shift,
+        and the chunks from the first changed one to the end are rewritten
+        along with the pointers of the fields that moved.
+        Returns False, without writing anything, if a field has no pointer
+        (e.g. a new field), in which case a full rewrite is needed."""
+        if not changes:
+            return True
+        with self._dbc.cursor() as cur:
+            pointers = dict()
+            fields = [field for field in changes if isinstance(field, str)]
+            for batch in misc.split_batches(fields):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.GET_POINTERS.format(model=self._model_name,
+                                                  placeholders=placeholders)
+                cur.execute(sql, (record_id, *batch))  # read
+                pointers.update((field, (start, stop))
+                                for field, start, stop in cur.fetchall())
+            if len(pointers) != len(changes):
+                return False
+            # except for the first field of the dict, the slice
+            # of a field includes the bytes of its key
+            sql = queries.GET_FIRST_POINTER_START.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))  # read
+            first_start = cur.fetchone()[0]
+            sql = queries.GET_RECORD_PAYLOAD.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))  # read
+            payload = cur.fetchone()[0]
+            if payload is None:
+                sql = queries.GET_CHUNK_SIZES.format(model=self._model_name)
+                cur.execute(sql, (record_id, ))  # read
+                chunk_sizes = cur.fetchall()
+                chunk_ids = [chunk_id for chunk_id, _ in chunk_sizes]
+                n_bytes = sum(size for _, size in chunk_sizes)
+                blob = Blob(self, record_id, n_bytes, len(chunk_ids),
+                            chunk_ids=chunk_ids, inline=False)
+            else:
+                blob = payload
+            try:
+                edits = list()
+                for field, value in changes.items():
+                    start, stop = pointers[field]
+                    data = self._pack_value(value)
+                    if start != first_start:
+                        data = self._pack_value(field) + data
+                    edits.append((field, start, stop, data))
+                edits.sort(key=lambda x: x[1])
+                is_resized = any(len(data) != stop - start
+                                 for _, start, stop, data in edits)
+                # chunks are read from the first changed one to the last
+                # changed one, or to the end if the following bytes shift
+                if payload is None:
+                    offset = (edits[0][1] // self._chunk_size) * self._chunk_size
+                    end = n_bytes if is_resized else edits[-1][2]
+                    end = min(n_bytes, -(-end // self._chunk_size) * self._chunk_size)
+                    buffer = bytearray(blob[offset:end])  # read
+                else:
+                    offset = 0
+                    buffer = bytearray(payload)
+            finally:
+                if payload is None:
+                    blob.close()
+            for _, start, stop, data in reversed(edits):
+                buffer[start-offset:stop-offset] = data
+            if payload is None:
+                self._patch_chunks(record_id,
+                                   chunk_ids[offset // self._chunk_size:],
+                                   buffer, is_resized)  # write
             else:
-                return self._type_ref.bin_type(chunks)
+                self._patch_payload(record_id, buffer)  # write
+            if is_resized:
+                self._shift_pointers(record_id, edits)  # write
+            self._patch_field_values(record_id, changes)  # write
+            return True
+
+    def _shift_pointers(self, record_id, edits):
+        """Update the pointers once the (field, start, stop, data) edits,
+        sorted by start, are applied. Edits are processed backwards so that
+        positions are compared with those of the data before the edits."""
+        with self._dbc.cursor() as cur:
+            shift_sql = queries.SHIFT_POINTERS.format(model=self._model_name)
+            set_sql = queries.SET_POINTER.format(model=self._model_name)
+            for field, start, stop, data in reversed(edits):
+                delta = len(data) - (stop - start)
+                if not delta:
+                    continue
+                cur.execute(shift_sql, (delta, delta, record_id, stop))  # write
+                cur.execute(set_sql, (field, record_id,
+                                      start, stop + delta))  # write
+
+    def _patch_payload(self, record_id, payload):
+        with self._dbc.cursor() as cur:
+            if len(payload) <= self._inline_size:
+                sql = queries.SET_RECORD_PAYLOAD.format(model=self._model_name)
+                cur.execute(sql, (payload, record_id))  # write
+                return
+            # the value outgrew the inline size
+            sql = queries.SET_RECORD_PAYLOAD.format(model=self._model_name)
+            cur.execute(sql, (None, record_id))  # write
+            sql = queries.STORE_DATA.format(model=self._model_name)
+            cur.executemany(sql, [(record_id, chunk) for chunk in
+                                  misc.split_bin(payload, self._chunk_size)])  # write
+
+    def _patch_chunks(self, record_id, chunk_ids, buffer, is_resized):
+        """Write the buffer over the chunk slots, from the first one.
+        The slots left unused are deleted if the buffer is the tail
+        of the data."""
+        with self._dbc.cursor() as cur:
+            update_sql = queries.UPDATE_CHUNK.format(model=self._model_name)
+            store_sql = queries.STORE_DATA.format(model=self._model_name)
+            n_chunks = 0
+            for chunk in misc.split_bin(buffer, self._chunk_size):
+                if n_chunks < len(chunk_ids):
+                    chunk_id = chunk_ids[n_chunks]
+                    cur.execute(update_sql, (chunk, chunk_id, chunk))  # write
+                else:
+                    cur.execute(store_sql, (record_id, chunk))  # write
+                n_chunks += 1
+            if not is_resized:
+                return
+            for batch in misc.split_batches(chunk_ids[n_chunks:]):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.DELETE_CHUNKS.format(model=self._model_name,
+                                                   placeholders=placeholders)
+                cur.execute(sql, batch)  # write
+
+    def _patch_field_values(self, record_id, changes):
+        indexed_fields = [field for field in self._get_indexed_fields()
+                          if field in changes]  # read
+        if not indexed_fields:
+            return
+        with self._dbc.cursor() as cur:
+            sql = queries.DELETE_FIELD_VALUE.format(model=self._model_name)
+            cur.executemany(sql, [(field, record_id)
+                                  for field in indexed_fields])  # write
+            sql = queries.ADD_FIELD_VALUE.format(model=self._model_name)
+            cur.executemany(sql, _get_field_values(record_id, changes,
+                                                   indexed_fields))  # write
+
+    def _pack_value(self, value):
+        packer = Packer(type_ref=self._type_ref)
+        return b"".join(packer.pack(value))
+
+    def _split_payload(self, datatype, value, pointers):
+        """Split a value into its inline payload and its chunks.
+        Values whose serialized size doesn't exceed the inline size are
+        returned as a (payload, ()) tuple, the others as (None, chunks)
+        where chunks is an iterable. See `_split_data` for `pointers`."""
+        chunks = self._split_data(datatype, value, pointers)
+        if not self._inline_size:
+            return None, chunks
+        first = next(chunks, None)
+        if first is None:
+            return b'', ()
+        second = next(chunks, None)
+        if second is None and len(first) <= self._inline_size:
+            return first, ()
+        if second is None:
+            return None, (first, )
+        return None, chain((first, second), chunks)
+
+    def _split_data(self, datatype, value, pointers):
+        """Generator of the chunks of a value. Once exhausted,
+        the `pointers` list is filled with (field, start, stop) tuples
+        for the string fields of a dict value stored in Kv or Depot."""
+        if datatype == Datatype.BIN:
+            yield from misc.split_bin(value, chunk_size=self._chunk_size)
+            return
+        buffer = bytearray()
+        packer = Packer(type_ref=self._type_ref, auto_index=True)
+        for x in packer.pack(value):
+            buffer.extend(x)
+            while len(buffer) >= self._chunk_size:
+                chunk = buffer[:self._chunk_size]
+                del buffer[:self._chunk_size]
+                yield chunk
+        if buffer:
+            yield buffer
+        if datatype == Datatype.DICT and self._model in (Model.KV,
+                                                         Model.DEPOT):
+            for field, slice_obj in packer.index_dict.items():
+                if isinstance(field, str):
+                    pointers.append((field, slice_obj.start, slice_obj.stop))
+
+    def _retrieve_data(self, record_id, datatype, payload=None):
+        value, _ = self._retrieve_sized_data(record_id, datatype, payload)
+        return value
+
+    def _retrieve_sized_data(self, record_id, datatype, payload=None):
+        """Returns the value of a record along with its size in bytes.
+        The data table is skipped when the inline payload is provided."""
+        if payload is not None:
+            return self._decode_payload(datatype, payload)
+        with self._dbc.cursor() as cur:
+            sql = queries.RETRIEVE_DATA.format(model=self._model_name)
+            cur.execute(sql, (record_id, ))
+            chunks = SizedChunks(row[0] for row in cur.fetch())
+            value = self._decode_chunks(datatype, chunks)
+            return value, chunks.n_bytes
+
+    def _decode_payload(self, datatype, payload):
+        """Returns the value of an inline payload along with its size in bytes"""
+        return self._decode_chunks(datatype, (payload, )), len(payload)
+
+    def _retrieve_many_data(self, records):
+        """Retrieve the data of many records with set-based queries.
+        The `records` argument is a dict mapping record ids to datatypes.
+        Yields (record_id, value, n_bytes) tuples ordered by record id."""
+        with self._dbc.cursor() as cur:
+            for batch in misc.split_batches(sorted(records)):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.RETRIEVE_MANY_DATA.format(model=self._model_name,
+                                                        placeholders=placeholders)
+                cur.execute(sql, batch)  # read
+                groups = groupby(cur.fetch(), key=lambda row: row[0])
+                group = next(groups, None)
+                for record_id in batch:
+                    # records without chunks (empty binary data) have no group
+                    if group is not None and group[0] == record_id:
+                        chunks = SizedChunks(row[1] for row in group[1])
+                        value = self._decode_chunks(records[record_id], chunks)
+                        group = next(groups, None)
+                    else:
+                        chunks = SizedChunks(())
+                        value = self._decode_chunks(records[record_id], chunks)
+                    yield record_id, value, chunks.n_bytes
+
+    def _stream_records(self, sql, params=None):
+        """Run a query whose rows are (record_id, datatype, head, chunk)
+        tuples grouped by record and ordered by chunk id, then decode
+        the records as their rows arrive. Records without chunks are
+        expected to come with a NULL chunk (LEFT JOIN). An optional fifth
+        column holds a native value (Kv counters) used instead of chunks.
+        Yields (head, value) tuples."""
+        with self._dbc.cursor() as cur:
+            cur.execute(sql, params)  # read
+            for _, rows in groupby(cur.fetch(), key=lambda row: row[0]):
+                _, dtype, head, chunk, *native = next(rows)
+                if native and native[0] is not None:
+                    yield head, native[0]
+                    continue
+                chunks = chain((chunk, ), (row[3] for row in rows))
+                chunks = (chunk for chunk in chunks if chunk is not None)
+                yield head, self._decode_chunks(Datatype(dtype), chunks)
+
+    def _decode_chunks(self, datatype, chunks):
+        if datatype == Datatype.BIN:
+            buffer = bytearray()
+            for chunk in chunks:
+                buffer.extend(chunk)
+            return self._type_ref.bin_type(buffer)
+        unpacker = Unpacker(type_ref=self._type_ref)
+        for chunk in chunks:
+            unpacker.feed(chunk)
+        return unpacker.data
+
+    def _take_many(self, n, asc=True, criteria=""):
+        """Read then delete up to `n` records from an edge of the store
+        (the smallest uids if `asc` is True, else the largest ones)
+        with set-based queries. Returns the tuple of values in read order.
+        The `criteria` string narrows the records (alias `r`).
+        This method must be called inside a write transaction."""
+        n = int(n)
+        if n <= 0:
+            return tuple()
+        sort_order = "ASC" if asc else "DESC"
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_EDGE_ID_RANGE.format(model=self._model_name,
+                                                   criteria=criteria,
+                                                   sort_order=sort_order)
+            cur.execute(sql, (n, ))  # read
+            first, last = cur.fetchone()
+            if first is None:
+                return tuple()
+            sql = queries.STREAM_RECORDS.format(model=self._model_name,
+                                                criteria=criteria,
+                                                sort_order=sort_order)
+            values = tuple(value for _, value
+                           in self._stream_records(sql, (first, last)))  # read
+            # chunks are deleted by range rather than by cascade
+            sql = queries.DELETE_RECORDS_DATA_BETWEEN.format(model=self._model_name,
+                                                             criteria=criteria)
+            cur.execute(sql, (first, last))  # write
+            sql = queries.DELETE_RECORDS_BETWEEN.format(model=self._model_name,
+                                                        criteria=criteria)
+            cur.execute(sql, (first, last))  # write
+            return values
+
+    def _wait_for(self, func, timeout=None, get_delay=None):
+        """Call `func` until it returns something other than None,
+        waiting for writes between calls. Returns None if the timeout
+        (in seconds, None to wait endlessly) expired.
+        The optional `get_delay` function returns the seconds after which
+        `func` is called again even without writes, or None."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            n_writes = self._n_writes
+            data_version = self._get_data_version()  # read
+            result = func()
+            if result is not None:
+                return result
+            timeout = None if deadline is None else deadline - time.monotonic()
+            delay = None if get_delay is None else get_delay()  # read
+            if delay is not None and (timeout is None or delay < timeout):
+                delay = max(delay, FOLLOW_MIN_INTERVAL)
+                self._wait_for_write(n_writes, data_version, delay,
+                                     FOLLOW_MIN_INTERVAL,
+                                     FOLLOW_MAX_INTERVAL)  # read
+            elif not self._wait_for_write(n_writes, data_version, timeout,
+                                          FOLLOW_MIN_INTERVAL,
+                                          FOLLOW_MAX_INTERVAL):  # read
+                return
+
+    def _wait_for_write(self, n_writes, data_version, timeout,
+                        min_interval, max_interval):
+        """Wait for a write of this object or a commit of another
+        connection. Returns False if the timeout expired, else True."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = min_interval
+        while True:
+            wait = interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            with self._written:
+                if self._written.wait_for(lambda: self._n_writes != n_writes,
+                                          timeout=wait):
+                    return True
+            if self._get_data_version() != data_version:  # read
+                return True
+            interval = min(interval * 2, max_interval)
+
+    def _notify_write(self):
+        with self._written:
+            self._n_writes += 1
+            self._written.notify_all()
+
+    def _get_data_version(self):
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_DATA_VERSION)  # read
+            return cur.fetchone()[0]
 
     def _delete_record(self, record_id):
         with self._dbc.cursor() as cur:
             sql = queries.DELETE_RECORD.format(model=self._model_name)
             cur.execute(sql, (record_id, ))
             return cur.rowcount
+
+
+def _ensure_field(field):
+    if not isinstance(field, str):
+        msg = "Only string fields can be indexed"
+        raise Exception(msg)
+    return field
+
+
+def _is_indexable(value):
+    # booleans are excluded since SQLite would store them as integers,
+    # and NaN since SQLite would store it as NULL
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return value == value
+    return isinstance(value, (int, str))
+
+
+def _get_field_values(record_id, value, fields):
+    """Returns (field, record_id, field_value) tuples for the indexed
+    fields of a dict value whose values are indexable scalars"""
+    field_values = list()
+    for field in fields:
+        field_value = value.get(field)
+        if _is_indexable(field_value):
+            field_values.append((field, record_id, field_value))
+    return field_values
+
+
+class SizedChunks:
+    """Iterable of chunks that counts the bytes it yields"""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.n_bytes = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.n_bytes += len(chunk)
+            yield chunk
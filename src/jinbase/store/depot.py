@@ -1,13 +1,36 @@
 """The Depot store is defined in this module."""
-from contextlib import contextmanager
-from paradict import Datatype, unpack
+import time
+import sqlite3
+import itertools
+from collections import namedtuple
+from contextlib import contextmanager, closing
+from datetime import timedelta
+from paradict import Datatype
 from jinbase import queries, misc
-from jinbase.const import Model
+from jinbase.const import (Model, RETENTION_BATCH_SIZE, RETENTION_LOCK_TIME,
+                           FOLLOW_BATCH_SIZE, FOLLOW_MIN_INTERVAL,
+                           FOLLOW_MAX_INTERVAL, AGGREGATE_OPS)
 from jinbase.store import Store, RecordInfo
 from jinbase.blob import Blob
 
 
-__all__ = ["Depot"]
+__all__ = ["Depot", "RetentionPolicy"]
+
+
+RetentionPolicy = namedtuple("RetentionPolicy",
+                             ("max_records", "max_bytes", "max_age"))
+RetentionPolicy.__doc__ = """\
+Named tuple returned by Depot.retention()
+
+[params]
+max_records: Max number of records, or None
+max_bytes: Max count of data bytes, or None
+max_age: Max age of records in seconds, or None
+"""
+
+
+# largest value of an SQLite INTEGER PRIMARY KEY
+MAX_UID = 2**63 - 1
 
 
 class Depot(Store):
@@ -16,14 +39,21 @@ class Depot(Store):
     Note that a Depot object isn't intended to be directly
     instantiated by the user.
     """
-    def __init__(self, jinbase):
+    def __init__(self, jinbase, retention_lock_time=RETENTION_LOCK_TIME):
         """
         Init
 
         [params]
         - jinbase: Jinbase object
+        - retention_lock_time: Max seconds a write transaction that
+            enforces the retention policy holds the write lock
         """
         super().__init__(Model.DEPOT, jinbase)
+        self._retention_lock_time = float(retention_lock_time)
+
+    @property
+    def retention_lock_time(self):
+        return self._retention_lock_time
 
     def exists(self, uid):
         r = self._get_record(uid)
@@ -36,7 +66,7 @@ class Depot(Store):
         r = self._get_record(uid)
         if r is None:  # nonexistent
             return
-        datatype, db_timestamp = r
+        datatype, db_timestamp, _ = r
         created_at = misc.get_datetime_str(self._db_epoch, db_timestamp,
                                            self._timestamp_precision)
         return RecordInfo(uid=uid, datatype=datatype, created_at=created_at)
@@ -46,22 +76,123 @@ class Depot(Store):
             r = self._get_record(uid)  # read
             if r is None:  # nonexistent
                 return default
-            datatype, _ = r
-            return self._retrieve_data(uid, datatype)  # read
+            datatype, _, payload = r
+            return self._retrieve_data(uid, datatype, payload)  # read
 
     def get_first(self, default=None):
-        with self._dbc.transaction() as cursor:
-            uid = self.uid(0)
-            if uid is None:
-                return default
-            return self.get(uid, default=default)
+        return self._get_edge(default=default, asc=True)
 
     def get_last(self, default=None):
+        return self._get_edge(default=default, asc=False)
+
+    def get_many(self, uids, default=None):
+        """
+        Get the values of many records at once. Records are fetched
+        along with their chunks by a single query per batch of uids,
+        inside a single read transaction.
+
+        [params]
+        - uids: Iterable of uids
+        - default: Value to use for nonexistent records
+
+        [return]
+        Returns a dict mapping each uid to its value
+        """
+        result = dict.fromkeys(uids, default)
         with self._dbc.transaction() as cursor:
-            uid = self.uid(-1)
-            if uid is None:
-                return default
-            return self.get(uid, default=default)
+            for batch in misc.split_batches(result):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.STREAM_RECORDS_BY_IDS.format(model=self._model_name,
+                                                           placeholders=placeholders)
+                for uid, value in self._stream_records(sql, batch):  # read
+                    result[uid] = value
+        return result
+
+    def slice(self, start=None, stop=None, step=None, *, by_uid=False):
+        """
+        Iterate over a slice of records. Records are streamed along with
+        their chunks from a single query on the sequence of records,
+        thus large slices are read lazily.
+
+        [params]
+        - start: Start position (inclusive), with the semantics of
+            Python slices (negative positions count from the end)
+        - stop: Stop position (exclusive)
+        - step: Step, possibly negative to iterate in reverse order
+        - by_uid: Boolean to tell whether `start` and `stop` are uids
+            instead of positions. A uid slice contains the records whose uids
+            are in the half-open range, and `step` still counts records.
+
+        [yield]
+        Yields (uid, value) tuples
+        """
+        step = 1 if step is None else int(step)
+        if step == 0:
+            msg = "The slice step can't be zero"
+            raise ValueError(msg)
+        if by_uid:
+            bounds = self._get_uid_slice_bounds(start, stop, step)  # read
+        else:
+            bounds = self._get_position_slice_bounds(start, stop, step)  # read
+        if bounds is None:
+            return
+        first, last, anchor = bounds
+        criteria = ""
+        if abs(step) > 1:
+            criteria = queries.DEPOT_STEP_CRITERIA.format(anchor=anchor,
+                                                         step=abs(step))
+        sort_order = "ASC" if step > 0 else "DESC"
+        sql = queries.STREAM_DEPOT_SLICE.format(criteria=criteria,
+                                                sort_order=sort_order)
+        yield from self._stream_records(sql, (first, last))  # read
+
+    def follow(self, after_uid=None, *, timeout=None,
+               batch_size=FOLLOW_BATCH_SIZE,
+               min_interval=FOLLOW_MIN_INTERVAL,
+               max_interval=FOLLOW_MAX_INTERVAL):
+        """
+        Follow the depot, that is, yield records as they are appended.
+        New records are read by batches. While the depot is idle, the
+        generator waits: appends of this Depot object wake it up at once,
+        and commits of other connections are detected with
+        `PRAGMA data_version`, checked with an interval that doubles
+        from `min_interval` up to `max_interval`.
+
+        [params]
+        - after_uid: Only records whose uid is greater than this one are
+            yielded. Defaults to None to follow the records appended
+            from now on.
+        - timeout: Seconds without new records after which the generator
+            stops. Defaults to None to follow the depot endlessly.
+        - batch_size: Max number of records read per query
+        - min_interval: Min seconds between two checks for commits
+        - max_interval: Max seconds between two checks for commits
+
+        [yield]
+        Yields (uid, value) tuples
+        """
+        batch_size = int(batch_size)
+        if batch_size < 1:
+            msg = "The batch size should be positive"
+            raise ValueError(msg)
+        if after_uid is None:
+            with self._dbc.cursor() as cur:
+                sql = queries.GET_DEPOT_EDGE_RECORD.format(sort_order="DESC")
+                cur.execute(sql)  # read
+                r = cur.fetchone()
+                after_uid = 0 if r is None else r[0]
+        while True:
+            n_writes = self._n_writes
+            data_version = self._get_data_version()  # read
+            batch = self._read_after(after_uid, batch_size)  # read
+            for uid, value in batch:
+                after_uid = uid
+                yield uid, value
+            if batch:
+                continue
+            if not self._wait_for_write(n_writes, data_version, timeout,
+                                        min_interval, max_interval):  # read
+                return
 
     def append(self, value):
         if value is None:
@@ -77,36 +208,56 @@ class Depot(Store):
             cursor.execute(sql, (datatype.value, db_timestamp))  # write
             record_id = cursor.lastrowid
             self._store_data(record_id, datatype, value)  # write
-            return record_id
+            has_retention = self._track_bytes((record_id, ))  # write
+        self._notify_write()
+        if has_retention:
+            self._trim(self._retention_lock_time, RETENTION_BATCH_SIZE)  # writeS
+        return record_id
 
     def extend(self, values):
         with self._dbc.immediate_transaction() as cursor:
-            uids = list()
-            for value in values:
-                uid = self.append(value)  #writeS
-                uids.append(uid)
-            return tuple(uids)
+            cursor.execute(queries.GET_NEXT_DEPOT_SEQ)  # read
+            seq = cursor.fetchone()[0]
+            entries = self._create_entries(values, seq)
+            uids = self._store_many(entries, queries.INSERT_DEPOT_RECORDS)  # writeS
+            has_retention = self._track_bytes(uids)  # write
+        self._notify_write()
+        if has_retention:
+            self._trim(self._retention_lock_time, RETENTION_BATCH_SIZE)  # writeS
+        return tuple(uids)
 
     def uid(self, position):
+        """
+        Get the uid of the record at a position.
+        This is an index lookup on the dense sequence of records.
+
+        [params]
+        - position: Zero-based position. Negative positions
+            count from the end, -1 being the last record.
+
+        [return]
+        Returns the uid, or None if the position is out of range
+        """
+        position = int(position)
         with self._dbc.transaction() as cursor:
-            try:
-                position = _ensure_position(self, position)  # possible read
-            except IndexError as e:
+            cursor.execute(queries.GET_DEPOT_SEQ_RANGE)  # read
+            first, last = cursor.fetchone()
+            if first is None:
                 return
-            r = self._get_record_by_position(position)  # read
-            if r is None:
+            seq = first + position if position >= 0 else last + 1 + position
+            if not first <= seq <= last:
                 return
-            record_id, _, _ = r
-            return record_id
+            cursor.execute(queries.GET_DEPOT_UID_BY_SEQ, (seq, ))  # read
+            r = cursor.fetchone()
+            return None if r is None else r[0]
 
     def position(self, uid):
-        with self._dbc.transaction() as cursor:
-            if not self.exists(uid):
-                return
-            sql = queries.COUNT_DEPOT_RECORD_OFFSET
-            cursor.execute(sql, (uid,))
-            r = cursor.fetchone()[0]
-            return r - 1
+        """Returns the zero-based position of a record,
+        or None if the record doesn't exist"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_DEPOT_POSITION, (uid, ))  # read
+            r = cur.fetchone()
+            return None if r is None else r[0]
 
     def uids(self, *, time_range=None, limit=None, asc=True):
         with self._dbc.cursor() as cur:
@@ -128,8 +279,21 @@ class Depot(Store):
                 yield uid
 
     def iterate(self, *, time_range=None, limit=None, asc=True):
-        for uid in self.uids(time_range=time_range, limit=limit, asc=asc):
-            yield uid, self.get(uid)
+        """Records are streamed along with their chunks from a single query"""
+        sort_order = "ASC" if asc else "DESC"
+        limit = None if limit is None else int(limit)
+        first, last, criteria = self._get_time_range_bounds(time_range)  # read
+        if first is None:
+            return
+        sql = queries.STREAM_RECORDS.format(model=self._model_name,
+                                            criteria=criteria,
+                                            sort_order=sort_order)
+        for uid, value in self._stream_records(sql, (first, last)):  # read
+            if limit is not None:
+                if limit <= 0:
+                    return
+                limit -= 1
+            yield uid, value
 
     def count_bytes(self, uid=None):
         if uid is None:
@@ -167,16 +331,10 @@ class Depot(Store):
                 blob.close()
 
     def load_field(self, uid, field, default=None):
-        with self._dbc.transaction() as cur:
-            sql = queries.GET_POINTER.format(model=self._model_name)
-            cur.execute(sql, (field, uid))  # read
-            r = cur.fetchone()
-            if r is None:
-                return default
-            slice_obj = slice(*r)
-            with self.open_blob(uid) as blob:
-                data = blob[slice_obj]
-                return unpack(data)
+        return self.load_fields(uid, (field, ), default=default)[field]
+
+    def load_fields(self, uid, fields, default=None):
+        return self._load_fields(uid, fields, default=default)
 
     def fields(self):
         with self._dbc.transaction() as cur:
@@ -185,18 +343,210 @@ class Depot(Store):
             for r in cur.fetch():
                 yield r[0]
 
+    def create_index(self, field):
+        """
+        Create a secondary index on a top-level field of dict records.
+        Values of the field that are integers, floats, or strings are
+        extracted at write time into an indexed side table, thus records
+        can be found by field value with the `find` method.
+        Existing records are indexed by this method.
+
+        [params]
+        - field: The string field to index
+
+        [return]
+        Returns False if the field was already indexed, else True
+        """
+        return self._create_index(field)
+
+    def drop_index(self, field):
+        """
+        Delete the secondary index of a field.
+
+        [return]
+        Returns a boolean to tell whether the index existed or not
+        """
+        return self._drop_index(field)
+
+    def indexes(self):
+        """Returns the sorted tuple of indexed fields"""
+        return self._get_indexed_fields()
+
+    def find(self, field, value=None, *, first=None, last=None,
+             limit=None, asc=True):
+        """
+        Find the uids of records by the value of an indexed field.
+        Records are sorted by field value, then by uid.
+
+        [params]
+        - field: The indexed field
+        - value: Optional value that the field must be equal to
+        - first: Optional lower bound (inclusive) of the field value
+        - last: Optional upper bound (inclusive) of the field value
+        - limit: Max number of uids
+        - asc: Boolean to tell whether the sort order is ascending or not
+        """
+        yield from self._find(queries.FIND_RECORDS, field, value=value,
+                              first=first, last=last, limit=limit, asc=asc)
+
+    def aggregate(self, field, ops=("count", "sum", "min", "max"), *,
+                  time_range=None):
+        """
+        Aggregate the numeric values of a top-level field of dict records.
+        Values that aren't integers or floats (booleans included) are ignored.
+        When the field is indexed, the aggregation is done by SQLite from
+        the secondary index, else only the bytes of the field are read
+        and decoded, thanks to the pointers of dict records.
+
+        [params]
+        - field: The string field
+        - ops: Sequence of operations among "count", "sum", "min",
+            "max", and "avg"
+        - time_range: Optional tuple of datetime objects (begin, end)
+            that narrows the records
+
+        [return]
+        Returns a dict mapping each operation to its result. With no values,
+        the count and sum are 0, and the other operations return None.
+        """
+        ops = tuple(ops)
+        for op in ops:
+            if op not in AGGREGATE_OPS:
+                msg = "Unknown aggregate operation '{}'".format(op)
+                raise ValueError(msg)
+        count, total, minimum, maximum = 0, 0, None, None
+        with self._dbc.transaction() as cur:
+            first, last, criteria = self._get_time_range_bounds(time_range)  # read
+            if first is None:
+                pass
+            elif field in self._get_indexed_fields():  # read
+                sql = queries.AGGREGATE_DEPOT_FIELD.format(criteria=criteria)
+                params = (field, first, last)
+                try:
+                    cur.execute(sql, params)  # read
+                except sqlite3.OperationalError as e:
+                    if "integer overflow" not in str(e):
+                        raise
+                    # Python integers don't overflow, unlike SQLite's SUM
+                    sql = queries.STREAM_DEPOT_FIELD_NUMBERS.format(criteria=criteria)
+                    cur.execute(sql, params)  # read
+                    values = (row[0] for row in cur)
+                    count, total, minimum, maximum = _aggregate_numbers(values)
+                else:
+                    count, total, minimum, maximum, _ = cur.fetchone()
+                    total = 0 if total is None else total
+            else:
+                criteria = "AND p.record_id BETWEEN ? AND ? {}".format(criteria)
+                values = self._iter_field_values(field, criteria=criteria,
+                                                 params=(first, last))  # read
+                values = (value for _, value in values)
+                count, total, minimum, maximum = _aggregate_numbers(values)
+        results = {"count": count, "sum": total, "min": minimum,
+                   "max": maximum, "avg": total / count if count else None}
+        return {op: results[op] for op in ops}
+
     def delete(self, uid):
-        with self._dbc.immediate_transaction() as cursor:
-            n = self._delete_record(uid)  # write
-            return True if n > 0 else False
+        return len(self.delete_many((uid, ))) > 0
 
     def delete_many(self, uids):
+        """The sequence of records is renumbered once for the whole batch"""
         with self._dbc.immediate_transaction() as cursor:
-            deleted_uids = list()
-            for uid in uids:
-                if self.delete(uid):
-                    deleted_uids.append(uid)
-            return tuple(deleted_uids)
+            return tuple(self._delete_records(uids))  # writeS
+
+    def delete_all(self):
+        """Delete all records in the store"""
+        with self._dbc.immediate_transaction() as cursor:
+            super().delete_all()  # write
+            cursor.execute(queries.RESET_DEPOT_BYTES)  # write
+
+    def set_retention(self, *, max_records=None, max_bytes=None, max_age=None):
+        """
+        Set the retention policy of the depot. The policy is stored in the
+        database, thus all connections enforce it. Once a limit is exceeded,
+        the oldest records are deleted by a bounded batch after each write,
+        and by the `enforce_retention` method. This method doesn't delete
+        any record itself: call `enforce_retention` to trim the existing
+        records down to the new limits.
+        Calling this method without limits removes the policy.
+
+        [params]
+        - max_records: Max number of records
+        - max_bytes: Max count of data bytes. This limit makes writes
+            keep a count of the data bytes of the depot.
+        - max_age: Max age of records, either in seconds or as a
+            `datetime.timedelta`. Records are aged by their timestamp.
+        """
+        max_records = _ensure_limit(max_records, "max_records")
+        max_bytes = _ensure_limit(max_bytes, "max_bytes")
+        if max_age is not None:
+            if isinstance(max_age, timedelta):
+                max_age = max_age.total_seconds()
+            max_age = float(_ensure_limit(max_age, "max_age"))
+        with self._dbc.immediate_transaction() as cursor:
+            if max_records is None and max_bytes is None and max_age is None:
+                cursor.execute(queries.DELETE_DEPOT_RETENTION)  # write
+                return
+            n_bytes = None if max_bytes is None else self.count_bytes()  # read
+            cursor.execute(queries.SET_DEPOT_RETENTION,
+                           (max_records, max_bytes, max_age, n_bytes))  # write
+
+    def retention(self):
+        """Returns the RetentionPolicy namedtuple of the depot,
+        or None if the depot has no retention policy"""
+        r = self._get_retention()  # read
+        if r is None:
+            return
+        max_records, max_bytes, max_age, _ = r
+        return RetentionPolicy(max_records=max_records, max_bytes=max_bytes,
+                               max_age=max_age)
+
+    def enforce_retention(self, lock_time=None, batch_size=RETENTION_BATCH_SIZE,
+                          pause=None):
+        """
+        Delete the oldest records until the retention policy is met.
+        Records are deleted by batches, each one in its own write
+        transaction, so that writers of other threads and processes
+        can take the write lock between two batches.
+
+        [params]
+        - lock_time: Max seconds a batch holds the write lock.
+            Defaults to the `retention_lock_time` of the depot.
+        - batch_size: Max number of records deleted per batch
+        - pause: Seconds to wait between two batches, during which
+            waiting writers take the write lock. Defaults to `lock_time`.
+
+        [return]
+        Returns the number of deleted records
+        """
+        lock_time = self._retention_lock_time if lock_time is None else float(lock_time)
+        batch_size = int(batch_size)
+        if batch_size < 1:
+            msg = "The batch size should be positive"
+            raise ValueError(msg)
+        pause = lock_time if pause is None else float(pause)
+        n = 0
+        while True:
+            n_deleted, is_done = self._trim(lock_time, batch_size)  # writeS
+            n += n_deleted
+            if is_done:
+                return n
+            time.sleep(pause)
+
+    def __getitem__(self, key):
+        """`depot[position]` returns the bare value at a position, like
+        `depot.get(depot.uid(position))`, whereas `depot[start:stop:step]`
+        returns an iterator of (uid, value) tuples, as the `slice` method
+        does. The shapes differ on purpose: a single item is looked up by
+        a position the caller already holds, while a slice streams records
+        whose uids the caller needs to address them later.
+        Use `depot[i:i+1]` to get the (uid, value) tuple of one position."""
+        if isinstance(key, slice):
+            return self.slice(key.start, key.stop, key.step)
+        uid = self.uid(key)
+        if uid is None:
+            msg = "Depot position out of range"
+            raise IndexError(msg)
+        return self.get(uid)
 
     def _get_record(self, uid):
         with self._dbc.cursor() as cur:
@@ -205,26 +555,242 @@ class Depot(Store):
             r = cur.fetchone()
             if r is None:  # nonexistent
                 return
-            dtype, db_timestamp = r
-            return Datatype(dtype), db_timestamp
+            dtype, db_timestamp, payload = r
+            return Datatype(dtype), db_timestamp, payload
 
-    def _get_record_by_position(self, position):
+    def _read_after(self, uid, batch_size):
+        """Returns a list of at most `batch_size` (uid, value) tuples
+        of the records that come after `uid`"""
+        sql = queries.STREAM_RECORDS.format(model=self._model_name,
+                                            criteria="", sort_order="ASC")
+        # the transaction waits for the writes of other threads
+        # on the connection to be committed
+        with self._dbc.transaction():
+            with closing(self._stream_records(sql, (uid + 1, MAX_UID))) as records:
+                return list(itertools.islice(records, batch_size))  # read
+
+    def _delete_records(self, uids):
+        """Delete records, then keep the sequence dense and the
+        tracked byte count current. Returns the list of deleted uids.
+        This method is intended to be called inside a write transaction."""
+        retention = self._get_retention()  # read
+        is_tracked = retention is not None and retention[3] is not None
+        deleted_uids, seqs, n_bytes = list(), list(), 0
         with self._dbc.cursor() as cur:
-            sql = queries.GET_DEPOT_RECORD_BY_POSITION.format(offset=position)
-            cur.execute(sql)
+            for uid in uids:
+                cur.execute(queries.GET_DEPOT_SEQ, (uid, ))  # read
+                r = cur.fetchone()
+                if r is None:
+                    continue
+                if is_tracked:
+                    n_bytes += self.count_bytes(uid)  # read
+                self._delete_record(uid)  # write
+                deleted_uids.append(uid)
+                seqs.append(r[0])
+            self._close_seq_gaps(seqs)  # write
+            if n_bytes:
+                cur.execute(queries.ADD_DEPOT_BYTES, (-n_bytes, ))  # write
+        return deleted_uids
+
+    def _trim(self, lock_time, batch_size):
+        """Delete a batch of the oldest records that break the
+        retention policy, inside a single write transaction.
+        Returns the tuple (number of deleted records, is_done)."""
+        deadline = time.monotonic() + lock_time
+        with self._dbc.immediate_transaction() as cursor:
+            retention = self._get_retention()  # read
+            if retention is None:
+                return 0, True
+            max_records, max_bytes, max_age, n_bytes = retention
+            cursor.execute(queries.GET_DEPOT_SEQ_RANGE)  # read
+            first, last = cursor.fetchone()
+            n_records = 0 if first is None else last - first + 1
+            cutoff = None
+            if max_age is not None:
+                cutoff = misc.get_timestamp(self._db_epoch,
+                                            misc.now_dt() - timedelta(seconds=max_age),
+                                            self._timestamp_precision)
+            n = 0
+            while True:
+                uid = None
+                if cutoff is not None:
+                    cursor.execute(queries.GET_DEPOT_UID_OLDER_THAN, (cutoff, ))  # read
+                    r = cursor.fetchone()
+                    uid = None if r is None else r[0]
+                if uid is None and ((max_records is not None and n_records > max_records)
+                                    or (max_bytes is not None and n_bytes > max_bytes)):
+                    cursor.execute(queries.GET_OLDEST_DEPOT_UID)  # read
+                    r = cursor.fetchone()
+                    uid = None if r is None else r[0]
+                if uid is None:
+                    return n, True
+                if n >= batch_size or (n > 0 and time.monotonic() >= deadline):
+                    return n, False
+                if max_bytes is not None:
+                    n_bytes -= self.count_bytes(uid)  # read
+                self._delete_records((uid, ))  # writeS
+                n += 1
+                n_records -= 1
+
+    def _track_bytes(self, uids):
+        """Add the data bytes of new records to the tracked byte count.
+        Returns a boolean to tell whether the depot has a retention policy."""
+        retention = self._get_retention()  # read
+        if retention is None:
+            return False
+        uids = [uid for uid in uids if uid is not None]
+        if retention[3] is not None and uids:
+            with self._dbc.cursor() as cur:
+                first, last = min(uids), max(uids)
+                cur.execute(queries.COUNT_DEPOT_BYTES_BETWEEN,
+                            (first, last, first, last))  # read
+                n_bytes = cur.fetchone()[0]
+                cur.execute(queries.ADD_DEPOT_BYTES, (n_bytes, ))  # write
+        return True
+
+    def _get_retention(self):
+        """Returns the (max_records, max_bytes, max_age, n_bytes)
+        row of the retention policy, or None"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_DEPOT_RETENTION)  # read
+            return cur.fetchone()
+
+    def _get_time_range_bounds(self, time_range):
+        """Returns the tuple (first uid, last uid, criteria) that narrows
+        a scan of the record table to a time range. The uids are None
+        when no record matches the time range."""
+        if time_range is None:
+            return 0, MAX_UID, ""
+        start, stop = misc.time_range_to_timestamps(self._db_epoch, time_range,
+                                                    self._timestamp_precision)
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_RECORD_ID_RANGE.format(model=self._model_name)
+            cur.execute(sql, (start, stop))  # read
+            first, last = cur.fetchone()
+        criteria = "AND {}".format(queries.STREAM_CRITERIA.format(start=start,
+                                                                  stop=stop))
+        return first, last, criteria
+
+    def _get_position_slice_bounds(self, start, stop, step):
+        """Returns the (first seq, last seq, anchor seq) of a slice
+        of positions, or None if the slice is empty"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_DEPOT_SEQ_RANGE)  # read
+            first, last = cur.fetchone()
+        if first is None:
+            return
+        positions = range(*slice(start, stop, step).indices(last - first + 1))
+        if not positions:
+            return
+        anchor = first + positions[0]
+        lowest, highest = sorted((positions[0], positions[-1]))
+        return first + lowest, first + highest, anchor
+
+    def _get_uid_slice_bounds(self, start, stop, step):
+        """Returns the (first seq, last seq, anchor seq) of a slice
+        of uids, or None if the slice is empty"""
+        if step > 0:
+            first = self._get_seq_after(start, ">=")
+            last = self._get_seq_before(stop, "<")
+            anchor = first
+        else:
+            first = self._get_seq_after(stop, ">")
+            last = self._get_seq_before(start, "<=")
+            anchor = last
+        if first is None or last is None or first > last:
+            return
+        return first, last, anchor
+
+    def _get_seq_after(self, uid, operator):
+        if uid is None:
+            uid, operator = 0, ">="
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_DEPOT_SEQ_AFTER.format(operator=operator)
+            cur.execute(sql, (uid, ))  # read
             r = cur.fetchone()
-            if r is None:  # nonexistent
+            return None if r is None else r[0]
+
+    def _get_seq_before(self, uid, operator):
+        if uid is None:
+            uid, operator = MAX_UID, "<="
+        with self._dbc.cursor() as cur:
+            sql = queries.GET_DEPOT_SEQ_BEFORE.format(operator=operator)
+            cur.execute(sql, (uid, ))  # read
+            r = cur.fetchone()
+            return None if r is None else r[0]
+
+    def _get_edge(self, default=None, asc=True):
+        """Get the value of the first or last record"""
+        with self._dbc.transaction() as cursor:
+            sort_order = "ASC" if asc else "DESC"
+            sql = queries.GET_DEPOT_EDGE_RECORD.format(sort_order=sort_order)
+            cursor.execute(sql)  # read
+            r = cursor.fetchone()
+            if r is None:
+                return default
+            record_id, dtype, payload = r
+            return self._retrieve_data(record_id, Datatype(dtype),
+                                       payload)  # read
+
+    def _create_entries(self, values, seq):
+        """Yields entries numbered from `seq` for `_store_many`"""
+        for value in values:
+            entry = self._create_entry(value, (seq, ))
+            if entry is not None:
+                seq += 1
+            yield entry
+
+    def _close_seq_gaps(self, seqs):
+        """Keep the sequence dense after the deletion of the records
+        numbered `seqs`, by renumbering the shorter side of the gaps"""
+        if not seqs:
+            return
+        lowest, highest = min(seqs), max(seqs)
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_DEPOT_SEQ_RANGE)  # read
+            first, last = cur.fetchone()
+            if first is None:
                 return
-            record_id, dtype, db_timestamp = r
-            return record_id, Datatype(dtype), db_timestamp
-
-
-def _ensure_position(store, position):
-    position = int(position)
-    if position >= 0:
-        return position
-    n = store.count_records()
-    abs_position = abs(position)
-    if abs_position > n:
-        raise IndexError
-    return n - abs_position
+            if highest - first <= last - lowest:
+                if lowest == highest:
+                    cur.execute(queries.SHIFT_DEPOT_HEAD, (highest, ))  # write
+                else:
+                    # the record below the highest gap takes its seq
+                    cur.execute(queries.RENUMBER_DEPOT_HEAD,
+                                (highest, highest))  # write
+            elif lowest == highest:
+                cur.execute(queries.SHIFT_DEPOT_TAIL, (lowest, ))  # write
+            else:
+                # the record above the lowest gap takes its seq
+                cur.execute(queries.RENUMBER_DEPOT_TAIL,
+                            (lowest, lowest))  # write
+
+
+def _aggregate_numbers(values):
+    """Returns the count, sum, min, and max of the integers and floats
+    among `values`. Booleans and NaN are ignored."""
+    count, total, minimum, maximum = 0, 0, None, None
+    for value in values:
+        if (isinstance(value, bool)
+                or not isinstance(value, (int, float))
+                or value != value):
+            continue
+        count += 1
+        total += value
+        if minimum is None or value < minimum:
+            minimum = value
+        if maximum is None or value > maximum:
+            maximum = value
+    return count, total, minimum, maximum
+
+
+def _ensure_limit(limit, name):
+    if limit is None:
+        return
+    if isinstance(limit, bool) or not isinstance(limit, (int, float)):
+        msg = "The '{}' limit should be an int or a float, not {}"
+        raise TypeError(msg.format(name, type(limit).__name__))
+    if limit <= 0:
+        msg = "The '{}' limit should be a positive number".format(name)
+        raise ValueError(msg)
+    return limit
@@ -1,33 +1,116 @@
 """The Kv store is defined in this module."""
+import re
+import threading
+from collections import namedtuple
 from contextlib import contextmanager
-from paradict import Datatype, unpack
+from datetime import timedelta
+from paradict import Datatype
 from jinbase import queries, misc
 from jinbase.blob import Blob
-from jinbase.const import Model
+from jinbase.bloom import BloomFilter
+from jinbase.cache import LruCache
+from jinbase.const import (Model, PURGE_BATCH_SIZE, REAPER_INTERVAL,
+                           FILTER_ERROR_RATE, FILTER_MIN_CAPACITY)
 from jinbase.store import Store, RecordInfo
 
 
 __all__ = ["Kv"]
 
 
+# sentinel for cache misses
+MISSING = object()
+
+
+# row of the jinbase_kv_record table
+KvRecord = namedtuple("KvRecord", ("uid", "datatype", "timestamp",
+                                   "expiry", "counter", "payload", "version"))
+
+
 class Kv(Store):
     """
     This class represents the Kv store.
     Note that a Kv object isn't intended to be directly
     instantiated by the user.
     """
-    def __init__(self, jinbase):
+    def __init__(self, jinbase, cache_size=0, use_filter=False, bucket=None):
         """
         Init
 
         [params]
         - jinbase: Jinbase object
+        - cache_size: Byte budget of the process-local LRU cache
+            of decoded values. Defaults to 0 to disable the cache.
+        - use_filter: Boolean to tell whether a process-local Bloom filter
+            of the keys should be kept, so that most lookups of nonexistent
+            keys skip the database. The filter is built lazily, kept current
+            on local writes, and rebuilt after commits of other connections.
+        - bucket: Name of the bucket whose tables back this store,
+            or None for the default Kv store
         """
-        super().__init__(Model.KV, jinbase)
+        self._bucket = None if bucket is None else _ensure_bucket_name(bucket)
+        model_name = None if bucket is None else "kvb_" + self._bucket
+        super().__init__(Model.KV, jinbase, model_name=model_name)
+        self._cache = LruCache(cache_size) if cache_size else None
+        self._use_filter = bool(use_filter)
+        self._filter = None
+        self._data_version = None
+        self._reaper = None
+        self._reaper_error = None
+
+    @property
+    def cache_size(self):
+        return 0 if self._cache is None else self._cache.max_bytes
+
+    @property
+    def bucket(self):
+        return self._bucket
+
+    @property
+    def use_filter(self):
+        return self._use_filter
+
+    @property
+    def reaper_error(self):
+        """The exception raised by the last failed sweep of the reaper,
+        or None once a sweep succeeds"""
+        return self._reaper_error
+
+    def filter_info(self):
+        """
+        Get the statistics of the Bloom filter of keys.
+
+        [return]
+        Returns a `jinbase.bloom.FilterInfo` namedtuple,
+        or None if the filter is disabled or not built yet.
+        """
+        bloom_filter = self._filter
+        if bloom_filter is None:
+            return
+        return bloom_filter.info()
+
+    def cache_info(self):
+        """
+        Get the statistics of the cache.
+
+        [return]
+        Returns a `jinbase.cache.CacheInfo` namedtuple,
+        or None if the cache is disabled.
+        """
+        if self._cache is None:
+            return
+        return self._cache.info()
+
+    def clear_cache(self):
+        """Remove all values from the cache"""
+        if self._cache is not None:
+            self._cache.clear()
 
     def exists(self, key):
+        key = _ensure_key(key)
+        self._sync()  # read
+        if not self._may_exist(key):  # read
+            return False
         with self._dbc.cursor() as cur:
-            key = _ensure_key(key)
             r = self._get_record_by_key(key)  # read
             return False if r is None else True
 
@@ -36,22 +119,115 @@ class Kv(Store):
         r = self._get_record_by_key(key)
         if r is None:
             return
-        record_id, datatype, db_timestamp = r
-        created_at = misc.get_datetime_str(self._db_epoch, db_timestamp,
+        created_at = misc.get_datetime_str(self._db_epoch, r.timestamp,
                                            self._timestamp_precision)
-        return RecordInfo(uid=record_id, datatype=datatype,
-                          created_at=created_at)
+        return RecordInfo(uid=r.uid, datatype=r.datatype,
+                          created_at=created_at, version=r.version)
 
     def get(self, key, default=None):
+        key = _ensure_key(key)
+        self._sync()  # read
+        if self._cache is not None:
+            value = self._cache.get(key, MISSING)
+            if value is not MISSING:
+                return value
+        if not self._may_exist(key):  # read
+            return default
+        # values read inside an ongoing transaction might never be committed
+        is_cacheable = self._cache is not None and not self._dbc.in_transaction
         with self._dbc.transaction() as cur:
-            key = _ensure_key(key)
             r = self._get_record_by_key(key)  # read
             if r is None:
                 return default
-            record_id, datatype, _ = r
-            return self._retrieve_data(record_id, datatype)  # read
+            if r.counter is not None:
+                return r.counter
+            value, n_bytes = self._retrieve_sized_data(r.uid, r.datatype,
+                                                       r.payload)  # read
+            # values that expire aren't cached
+            if is_cacheable and r.expiry is None:
+                self._cache.put(key, value, r.datatype, n_bytes)
+            return value
+
+    def get_with_version(self, key, default=None):
+        """
+        Get the value of a key along with the version of its record,
+        to be passed later to `compare_and_set`.
 
-    def set(self, key, value):
+        [params]
+        - key: Integer or string key
+        - default: Value to return for a nonexistent key
+
+        [return]
+        Returns a (value, version) tuple. The version is None
+        for a nonexistent key.
+        """
+        key = _ensure_key(key)
+        with self._dbc.transaction() as cur:
+            r = self._get_record_by_key(key)  # read
+            if r is None:
+                return default, None
+            if r.counter is not None:
+                return r.counter, r.version
+            value = self._retrieve_data(r.uid, r.datatype, r.payload)  # read
+            return value, r.version
+
+    def get_many(self, keys, default=None):
+        """
+        Get the values of many keys at once, with a few set-based
+        queries performed inside a single read transaction.
+
+        [params]
+        - keys: Iterable of keys
+        - default: Value to use for nonexistent keys
+
+        [return]
+        Returns a dict mapping each key to its value
+        """
+        result = {_ensure_key(key): MISSING for key in keys}
+        self._sync()  # read
+        if self._cache is not None:
+            for key in result:
+                result[key] = self._cache.get(key, MISSING)
+        missing_keys = [key for key, value in result.items()
+                        if value is MISSING and self._may_exist(key)]  # read
+        is_cacheable = self._cache is not None and not self._dbc.in_transaction
+        with self._dbc.transaction() as cur:
+            r = self._get_records_by_keys(missing_keys)  # read
+            values = list()
+            # counters and inline payloads need no further read
+            for key, record in r.items():
+                if record.counter is not None:
+                    result[key] = record.counter
+                elif record.payload is not None:
+                    value, n_bytes = self._decode_payload(record.datatype,
+                                                          record.payload)
+                    values.append((key, value, n_bytes))
+            records = {record.uid: record.datatype for record in r.values()
+                       if record.counter is None and record.payload is None}
+            record_keys = {record.uid: key for key, record in r.items()}
+            for record_id, value, n_bytes in self._retrieve_many_data(records):  # read
+                values.append((record_keys[record_id], value, n_bytes))
+            for key, value, n_bytes in values:
+                result[key] = value
+                if is_cacheable and r[key].expiry is None:
+                    self._cache.put(key, value, r[key].datatype, n_bytes)
+        return {key: (default if value is MISSING else value)
+                for key, value in result.items()}
+
+    def set(self, key, value, ttl=None):
+        """
+        Set a key-value pair.
+
+        [params]
+        - key: Integer or string key
+        - value: The value. Nothing is set if it is None.
+        - ttl: Optional time to live, either in seconds or as a
+            `datetime.timedelta`. Once the ttl has elapsed, the key is
+            treated as missing until the expired record is purged.
+
+        [return]
+        Returns the uid of the record
+        """
         if value is None:
             return
         with self._dbc.immediate_transaction() as cursor:
@@ -60,23 +236,85 @@ class Kv(Store):
             datatype = misc.ensure_datatype(value, self._type_ref)
             if datatype is None:
                 raise TypeError
-            sql = queries.SET_KV_RECORD.format(key_type=key_type)
-            db_timestamp = misc.get_timestamp(self._db_epoch, misc.now_dt(),
+            now_dt = misc.now_dt()
+            db_timestamp = misc.get_timestamp(self._db_epoch, now_dt,
                                               self._timestamp_precision)
-            params = (datatype.value, db_timestamp, key)
-            r = self._get_record_by_key(key)  # read
+            expiry = self._get_expiry(now_dt, ttl)
+            self._discard_cached(key)
+            # expired records are reused as well
+            r = self._get_record_by_key(key, expired=True)  # read
             # key doesn't exist
             if r is None:
-                cursor.execute(sql, params)  # write
-            # key already exists, therefore we should delete it first
+                sql = queries.SET_KV_RECORD.format(model=self._model_name,
+                                                   key_type=key_type)
+                cursor.execute(sql, (datatype.value, db_timestamp,
+                                     expiry, key))  # write
+                record_id = cursor.lastrowid
+                self._store_data(record_id, datatype, value)  # write
+                self._add_to_filter(key)
+            # key already exists, therefore its record is updated in place
             else:
-                record_id, _, _ = r
-                self._delete_record(record_id)  # write
-                cursor.execute(sql, params)  # write
-            record_id = cursor.lastrowid
-            self._store_data(record_id, datatype, value)  # write
+                record_id = r.uid
+                sql = queries.UPDATE_KV_RECORD.format(model=self._model_name)
+                cursor.execute(sql, (datatype.value, db_timestamp,
+                                     expiry, record_id))  # write
+                self._rewrite_data(record_id, datatype, value)  # write
             return record_id
 
+    def compare_and_set(self, key, expected_version, value, ttl=None):
+        """
+        Set a key-value pair only if the version of its record is
+        still the expected one. The value is serialized before the
+        write lock is acquired, so that concurrent writers hold it
+        only for a few short statements.
+
+        [params]
+        - key: Integer or string key
+        - expected_version: The version returned by `get_with_version`
+            or `info`. Set it to None to only create a nonexistent key.
+        - value: The value. Nothing is set if it is None.
+        - ttl: Optional time to live, either in seconds or as a
+            `datetime.timedelta`.
+
+        [return]
+        Returns the new version of the record, or None if the
+        version didn't match.
+        """
+        if value is None:
+            return
+        key = _ensure_key(key)
+        key_type = _get_key_type(key)
+        datatype = misc.ensure_datatype(value, self._type_ref)
+        if datatype is None:
+            raise TypeError
+        packed = self._pack_data(datatype, value)
+        with self._dbc.immediate_transaction() as cursor:
+            now_dt = misc.now_dt()
+            db_timestamp = misc.get_timestamp(self._db_epoch, now_dt,
+                                              self._timestamp_precision)
+            expiry = self._get_expiry(now_dt, ttl)
+            r = self._get_record_by_key(key, expired=True)  # read
+            is_live = r is not None and not self._is_expired(r.expiry)
+            if (r.version if is_live else None) != expected_version:
+                return
+            self._discard_cached(key)
+            if r is None:
+                sql = queries.SET_KV_RECORD.format(model=self._model_name,
+                                                   key_type=key_type)
+                cursor.execute(sql, (datatype.value, db_timestamp,
+                                     expiry, key))  # write
+                self._store_data(cursor.lastrowid, datatype, value,
+                                 packed=packed)  # write
+                self._add_to_filter(key)
+                return 1
+            # expired records are reused, their version keeps growing
+            sql = queries.UPDATE_KV_RECORD.format(model=self._model_name)
+            cursor.execute(sql, (datatype.value, db_timestamp,
+                                 expiry, r.uid))  # write
+            self._rewrite_data(r.uid, datatype, value,
+                               packed=packed)  # write
+            return r.version + 1
+
     def replace(self, key, value):
         with self._dbc.immediate_transaction() as cursor:
             old_value = self.get(key)
@@ -90,31 +328,167 @@ class Kv(Store):
         """data is a dictionary"""
         data = dict(dict_data)
         with self._dbc.immediate_transaction() as cursor:
-            uids = dict()
-            for key, val in data.items():
-                uid = self.set(key, val)  # writeS
-                uids[key] = uid
-            return uids
+            # the last non-None value of a key wins
+            keys = {key: _ensure_key(key) for key in data}
+            values = {keys[key]: val for key, val in data.items()
+                      if val is not None}
+            existing = self._get_records_by_keys(values.keys(),
+                                                 expired=True)  # read
+            # existing keys are updated in place
+            key_uids = dict()
+            for key, val in values.items():
+                if key in existing:
+                    key_uids[key] = self.set(key, val)  # writeS
+            # new keys are inserted in bulk
+            new_keys = [key for key in values if key not in existing]
+            for key in new_keys:
+                self._discard_cached(key)
+            entries = (self._create_entry(values[key], _get_key_columns(key))
+                       for key in new_keys)
+            sql = queries.INSERT_KV_RECORDS.format(model=self._model_name)
+            uids = self._store_many(entries, sql)  # writeS
+            for key in new_keys:
+                self._add_to_filter(key)
+            key_uids.update(zip(new_keys, uids))
+            return {key: (None if val is None else key_uids[keys[key]])
+                    for key, val in data.items()}
 
-    def keys(self, *, time_range=None, limit=None, asc=True):
-        with self._dbc.cursor() as cur:
-            sort_order = "ASC" if asc else "DESC"
-            if time_range is None:
-                timestamps = None
+    def patch(self, key, changes):
+        """
+        Update some top-level fields of a dict value without
+        rewriting the whole value. Only the chunks holding the changed
+        fields (and the following ones if their size changes) are
+        rewritten. Adding new fields falls back to a full rewrite.
+
+        [params]
+        - key: Integer or string key
+        - changes: Dict mapping fields to their new values
+
+        [return]
+        Returns the uid of the record, or None if the key doesn't exist
+        """
+        changes = dict(changes)
+        with self._dbc.immediate_transaction() as cursor:
+            key = _ensure_key(key)
+            r = self._get_record_by_key(key)  # read
+            if r is None:
+                return
+            if r.datatype != Datatype.DICT:
+                msg = "The value of the key '{}' isn't a dict".format(key)
+                raise TypeError(msg)
+            self._discard_cached(key)
+            if not self._patch_data(r.uid, changes):  # write
+                value = self._retrieve_data(r.uid, r.datatype, r.payload)  # read
+                value.update(changes)
+                self._rewrite_data(r.uid, r.datatype, value)  # write
+            sql = queries.TOUCH_KV_RECORD.format(model=self._model_name)
+            cursor.execute(sql, (self._get_now_timestamp(), r.uid))  # write
+            return r.uid
+
+    def incr(self, key, delta=1):
+        """
+        Atomically increment the integer counter of a key.
+        Counters are kept in a native INTEGER column and are
+        updated with a single statement, without serialization.
+        A nonexistent key is created with `delta` as value, and an
+        integer stored with `set` is converted to a counter.
+        The ttl of a counter is preserved.
+
+        [params]
+        - key: Integer or string key
+        - delta: Integer to add to the counter
+
+        [return]
+        Returns the new value of the counter
+        """
+        key = _ensure_key(key)
+        delta = _ensure_delta(delta)
+        counter = self._incr(key, delta)  # write
+        if counter is None:
+            with self._dbc.immediate_transaction() as cursor:
+                counter = self._incr_record(key, delta)  # writeS
+        # discarded once committed, so that a concurrent read
+        # can't cache again the value that was converted to a counter
+        self._discard_cached(key)
+        return counter
+
+    def decr(self, key, delta=1):
+        """
+        Atomically decrement the integer counter of a key.
+        See the `incr` method.
+
+        [return]
+        Returns the new value of the counter
+        """
+        return self.incr(key, -_ensure_delta(delta))
+
+    def incr_many(self, deltas):
+        """
+        Increment many counters inside a single write transaction,
+        with one UPSERT statement per key.
+
+        [params]
+        - deltas: Dict mapping keys to the integers to add to their counters
+
+        [return]
+        Returns a dict mapping each key to the new value of its counter
+        """
+        data = dict(deltas)
+        keys = {key: _ensure_key(key) for key in data}
+        # keys that normalize to the same key are merged
+        merged = dict()
+        for key, delta in data.items():
+            key = keys[key]
+            merged[key] = merged.get(key, 0) + _ensure_delta(delta)
+        with self._dbc.immediate_transaction() as cursor:
+            counters = dict()
+            for key, delta in merged.items():
+                counter = self._incr(key, delta)  # write
+                if counter is None:
+                    counter = self._incr_record(key, delta)  # writeS
+                counters[key] = counter
+        for key in merged:
+            self._discard_cached(key)
+        return {key: counters[keys[key]] for key in data}
+
+    def keys(self, *, after=None, time_range=None, limit=None, asc=True):
+        """
+        List keys. Integer keys come before string keys in ascending order.
+
+        [params]
+        - after: Continuation token, that is, the last key of the previous
+            page. Only the keys that come after it in the sort order are listed.
+        - time_range: Optional tuple of datetimes
+        - limit: Max number of keys
+        - asc: Boolean to tell whether the sort order is ascending or not
+        """
+        after = after if after is None else _ensure_key(after)
+        limit = None if limit is None else int(limit)
+        key_types = ("int", "str") if asc else ("str", "int")
+        if after is not None:
+            # skip the key type that comes before the 'after' key
+            key_types = key_types[key_types.index(_get_key_type(after)):]
+        for key_type in key_types:
+            if limit is not None and limit <= 0:
+                return
+            if key_type == "int":
+                int_after = after if isinstance(after, int) else None
+                keys = self.int_keys(after=int_after, time_range=time_range,
+                                     limit=limit, asc=asc)
             else:
-                timestamps = misc.time_range_to_timestamps(self._db_epoch, time_range,
-                                                           self._timestamp_precision)
-            criteria = _get_key_criteria(timestamps)
-            limit = misc.get_limit_spec(limit)
-            sql = queries.SELECT_KEYS.format(sort_order=sort_order,
-                                             criteria=criteria,
-                                             limit=limit)
-            cur.execute(sql)  # read
-            for row in cur.fetch():
-                yield row[0]
+                str_after = after if isinstance(after, str) else None
+                keys = self.str_keys(after=str_after, time_range=time_range,
+                                     limit=limit, asc=asc)
+            for key in keys:
+                if limit is not None:
+                    limit -= 1
+                yield key
 
-    def int_keys(self, first=None, last=None, *, time_range=None, limit=None,
-                 asc=True):
+    def int_keys(self, first=None, last=None, *, after=None, time_range=None,
+                 limit=None, asc=True):
+        if after is not None and not isinstance(after, int):
+            msg = "The 'after' key should be an integer"
+            raise Exception(msg)
         with self._dbc.cursor() as cur:
             first = first if first is None else int(first)
             last = last if last is None else int(last)
@@ -128,18 +502,41 @@ class Kv(Store):
             else:
                 timestamps = misc.time_range_to_timestamps(self._db_epoch, time_range,
                                                            self._timestamp_precision)
-            criteria = _get_int_key_criteria(first, last, timestamps)
+            criteria = _get_int_key_criteria(first, last, timestamps,
+                                             after, asc)
+            criteria = self._get_live_criteria() + criteria
             limit = misc.get_limit_spec(limit)
-            sql = queries.SELECT_INT_KEYS.format(sort_order=sort_order,
+            sql = queries.SELECT_INT_KEYS.format(model=self._model_name,
+                                                 sort_order=sort_order,
                                                  criteria=criteria, limit=limit)
             cur.execute(sql)
             for row in cur.fetch():
                 yield row[0]
 
-    def str_keys(self, glob=None, *, time_range=None, limit=None, asc=True):
+    def str_keys(self, glob=None, *, prefix=None, after=None, time_range=None,
+                 limit=None, asc=True):
+        """
+        List string keys.
+
+        [params]
+        - glob: Optional glob pattern
+        - prefix: Optional prefix. Unlike a glob pattern, a prefix is
+            always compiled to a range scan on the index of string keys.
+        - after: Continuation token, that is, the last key of the previous
+            page. Only the keys that come after it in the sort order are listed.
+        - time_range: Optional tuple of datetimes
+        - limit: Max number of keys
+        - asc: Boolean to tell whether the sort order is ascending or not
+        """
         if glob is not None and not isinstance(glob, str):
             msg = "The Glob should be a string"
             raise Exception(msg)
+        if prefix is not None and not isinstance(prefix, str):
+            msg = "The prefix should be a string"
+            raise Exception(msg)
+        if after is not None and not isinstance(after, str):
+            msg = "The 'after' key should be a string"
+            raise Exception(msg)
         with self._dbc.cursor() as cur:
             sort_order = "ASC" if asc else "DESC"
             if time_range is None:
@@ -147,40 +544,58 @@ class Kv(Store):
             else:
                 timestamps = misc.time_range_to_timestamps(self._db_epoch, time_range,
                                                            self._timestamp_precision)
-            criteria = _get_str_key_criteria(timestamps)
+            criteria, params = _get_str_key_criteria(timestamps, after, asc,
+                                                     prefix)
+            criteria = self._get_live_criteria() + criteria
             limit = misc.get_limit_spec(limit)
             if glob:
-                sql = queries.SELECT_STR_KEYS_WITH_GLOB.format(sort_order=sort_order,
+                sql = queries.SELECT_STR_KEYS_WITH_GLOB.format(model=self._model_name,
+                                                               sort_order=sort_order,
                                                                criteria=criteria,
                                                                limit=limit)
-                params = (glob, )
+                params = (glob, *params)
             else:
-                sql = queries.SELECT_STR_KEYS.format(sort_order=sort_order,
+                sql = queries.SELECT_STR_KEYS.format(model=self._model_name,
+                                                     sort_order=sort_order,
                                                      criteria=criteria, limit=limit)
-                params = None
             cur.execute(sql, params)
             for row in cur.fetch():
                 yield row[0]
 
     def iterate(self, *, time_range=None, limit=None, asc=True):
-        for key in self.keys(time_range=time_range, limit=limit, asc=asc):
-            try:
-                value = self[key]
-            except KeyError as e:
-                continue
-            yield key, value
+        """Records are streamed along with their chunks from a single
+        query per key type (int keys come before str keys in ascending order)"""
+        sort_order = "ASC" if asc else "DESC"
+        criteria = self._get_live_criteria()
+        if time_range is not None:
+            start, stop = misc.time_range_to_timestamps(self._db_epoch, time_range,
+                                                        self._timestamp_precision)
+            criteria += "AND {} ".format(queries.STREAM_CRITERIA.format(start=start,
+                                                                        stop=stop))
+        limit = None if limit is None else int(limit)
+        for key_type in (("int", "str") if asc else ("str", "int")):
+            sql = queries.STREAM_KV_RECORDS.format(model=self._model_name,
+                                                   key_type=key_type,
+                                                   criteria=criteria,
+                                                   sort_order=sort_order)
+            for key, value in self._stream_records(sql):  # read
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                yield key, value
 
     def uid(self, key):
         key = _ensure_key(key)
         r = self._get_record_by_key(key)
         if r is None:  # nonexistent
             return
-        record_id, _, _ = r
-        return record_id
+        return r.uid
 
     def key(self, uid):
         with self._dbc.cursor() as cur:
-            sql = queries.GET_KV_KEY_BY_UID
+            sql = queries.GET_KV_KEY_BY_UID.format(model=self._model_name,
+                                                   criteria=self._get_live_criteria())
             cur.execute(sql, (uid,))
             r = cur.fetchone()
             if r is None:  # nonexistent
@@ -195,9 +610,8 @@ class Kv(Store):
             r = self._get_record_by_key(key)  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
             sql = queries.COUNT_RECORD_BYTES.format(model=self._model_name)
-            cur.execute(sql, (record_id, ))  # read
+            cur.execute(sql, (r.uid, ))  # read
             return cur.fetchone()[0]
 
     def count_chunks(self, key=None):
@@ -208,9 +622,8 @@ class Kv(Store):
             r = self._get_record_by_key(key)  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
             sql = queries.COUNT_RECORD_CHUNKS.format(model=self._model_name)
-            cur.execute(sql, (record_id, ))  # read
+            cur.execute(sql, (r.uid, ))  # read
             return cur.fetchone()[0]
 
     @contextmanager
@@ -226,17 +639,12 @@ class Kv(Store):
                 blob.close()
 
     def load_field(self, key, field, default=None):
+        return self.load_fields(key, (field, ), default=default)[field]
+
+    def load_fields(self, key, fields, default=None):
         with self._dbc.transaction() as cur:
             uid = self.uid(key)
-            sql = queries.GET_POINTER.format(model=self._model_name)
-            cur.execute(sql, (field, uid))  # read
-            r = cur.fetchone()
-            if r is None:
-                return default
-            slice_obj = slice(*r)
-            with self.open_blob(key) as blob:
-                data = blob[slice_obj]
-                return unpack(data)
+            return self._load_fields(uid, fields, default=default)
 
     def fields(self):
         with self._dbc.transaction() as cur:
@@ -245,16 +653,64 @@ class Kv(Store):
             for r in cur.fetch():
                 yield r[0]
 
+    def create_index(self, field):
+        """
+        Create a secondary index on a top-level field of dict records.
+        Values of the field that are integers, floats, or strings are
+        extracted at write time into an indexed side table, thus records
+        can be found by field value with the `find` method.
+        Existing records are indexed by this method.
+
+        [params]
+        - field: The string field to index
+
+        [return]
+        Returns False if the field was already indexed, else True
+        """
+        return self._create_index(field)
+
+    def drop_index(self, field):
+        """
+        Delete the secondary index of a field.
+
+        [return]
+        Returns a boolean to tell whether the index existed or not
+        """
+        return self._drop_index(field)
+
+    def indexes(self):
+        """Returns the sorted tuple of indexed fields"""
+        return self._get_indexed_fields()
+
+    def find(self, field, value=None, *, first=None, last=None,
+             limit=None, asc=True):
+        """
+        Find the keys of records by the value of an indexed field.
+        Records are sorted by field value, then by uid.
+
+        [params]
+        - field: The indexed field
+        - value: Optional value that the field must be equal to
+        - first: Optional lower bound (inclusive) of the field value
+        - last: Optional upper bound (inclusive) of the field value
+        - limit: Max number of keys
+        - asc: Boolean to tell whether the sort order is ascending or not
+        """
+        yield from self._find(queries.FIND_KV_KEYS, field, value=value,
+                              first=first, last=last, limit=limit, asc=asc,
+                              criteria=self._get_live_criteria())
+
     def delete(self, key):
         with self._dbc.immediate_transaction() as cursor:
             key = _ensure_key(key)
+            self._discard_cached(key)
             # get the record id
-            r = self._get_record_by_key(key)  # read
+            r = self._get_record_by_key(key, expired=True)  # read
             if r is None:
                 return False
-            record_id, _, _ = r
-            self._delete_record(record_id)  # write
-            return True
+            self._delete_record(r.uid)  # write
+            # an expired key was already missing
+            return not self._is_expired(r.expiry)
 
     def delete_many(self, keys):
         with self._dbc.immediate_transaction() as cursor:
@@ -264,16 +720,255 @@ class Kv(Store):
                     deleted_keys.append(key)
             return tuple(deleted_keys)
 
-    def _get_record_by_key(self, key):
+    def delete_all(self):
+        """Delete all records in the store"""
+        with self._dbc.immediate_transaction() as cursor:
+            self.clear_cache()
+            super().delete_all()  # write
+            self._filter = None
+
+    def count_records(self):
+        """
+        Count the records of the store, except expired ones.
+
+        [return]
+        Returns the number of records
+        """
+        with self._dbc.cursor() as cur:
+            sql = queries.COUNT_LIVE_KV_RECORDS.format(model=self._model_name)
+            cur.execute(sql, (self._get_now_timestamp(), ))  # read
+            r = cur.fetchone()[0]
+            return r if r else 0
+
+    def purge_expired(self, batch_size=PURGE_BATCH_SIZE):
+        """
+        Delete expired records in bounded batches.
+        Each batch is deleted in its own write transaction
+        unless this method is called inside a transaction.
+
+        [params]
+        - batch_size: Max number of records deleted per batch
+
+        [return]
+        Returns the number of deleted records
+        """
+        n = 0
+        while True:
+            n_deleted = self._purge_batch(batch_size)  # write
+            n += n_deleted
+            if n_deleted < batch_size:
+                return n
+
+    def start_reaper(self, interval=REAPER_INTERVAL,
+                     batch_size=PURGE_BATCH_SIZE):
+        """
+        Start a daemon thread that periodically purges expired records
+        in bounded batches. The reaper is stopped when the Jinbase
+        connection is closed. A failed sweep is retried at the next
+        interval, and its exception is kept in `reaper_error`.
+
+        [params]
+        - interval: Seconds between two sweeps
+        - batch_size: Max number of records deleted per write transaction
+
+        [return]
+        Returns False if the reaper was already running, else True
+        """
+        if self._reaper is not None:
+            return False
+        self._reaper_error = None
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._reap,
+                                  args=(stop_event, interval, batch_size),
+                                  name="jinbase-kv-reaper", daemon=True)
+        self._reaper = (thread, stop_event)
+        thread.start()
+        return True
+
+    def stop_reaper(self):
+        """
+        Stop the reaper thread and wait for it to terminate.
+
+        [return]
+        Returns False if the reaper wasn't running, else True
+        """
+        if self._reaper is None:
+            return False
+        thread, stop_event = self._reaper
+        self._reaper = None
+        stop_event.set()
+        thread.join()
+        return True
+
+    def _reap(self, stop_event, interval, batch_size):
+        while not stop_event.wait(interval):
+            while not stop_event.is_set():
+                if self._dbc.is_closed:
+                    return
+                try:
+                    n_deleted = self._purge_batch(batch_size)  # write
+                except Exception as e:
+                    # the next sweep will retry (e.g. the database is locked)
+                    self._reaper_error = e
+                    break
+                if n_deleted < batch_size:
+                    self._reaper_error = None
+                    break
+
+    def _purge_batch(self, batch_size):
+        with self._dbc.immediate_transaction() as cursor:
+            sql = queries.PURGE_EXPIRED_KV_RECORDS.format(model=self._model_name)
+            cursor.execute(sql, (self._get_now_timestamp(),
+                                 int(batch_size)))  # write
+            return cursor.rowcount
+
+    def _incr(self, key, delta):
+        """Try to increment a live counter (or create it) with
+        a single UPSERT statement. Returns None when the key holds
+        a regular value or an expired record, or on overflow."""
+        key_type = _get_key_type(key)
+        now = self._get_now_timestamp()
+        sql = queries.INCR_KV_COUNTER.format(model=self._model_name,
+                                             key_type=key_type)
+        with self._dbc.write_lock, self._dbc.cursor() as cur:
+            cur.execute(sql, (Datatype.INT.value, now, key, delta, now))  # write
+            r = cur.fetchall()
+            if r:
+                self._add_to_filter(key)
+        return r[0][0] if r else None
+
+    def _incr_record(self, key, delta):
+        """Slow path of `incr`, to be called in a write transaction.
+        Expired records are dropped and integers stored as chunks
+        are converted to native counters."""
+        counter = self._incr(key, delta)  # write
+        if counter is not None:
+            return counter
+        r = self._get_record_by_key(key, expired=True)  # read
+        if self._is_expired(r.expiry):
+            self._delete_record(r.uid)  # write
+            return self._incr(key, delta)  # write
+        if r.counter is not None:
+            msg = "Counter overflow for the key '{}'".format(key)
+            raise OverflowError(msg)
+        if r.datatype != Datatype.INT:
+            msg = "The value of the key '{}' isn't an integer".format(key)
+            raise TypeError(msg)
+        counter = self._retrieve_data(r.uid, r.datatype, r.payload) + delta  # read
+        with self._dbc.cursor() as cur:
+            sql = queries.DELETE_RECORD_DATA.format(model=self._model_name)
+            cur.execute(sql, (r.uid, ))  # write
+            sql = queries.SET_KV_COUNTER.format(model=self._model_name)
+            cur.execute(sql, (Datatype.INT.value, self._get_now_timestamp(),
+                              counter, r.uid))  # write
+        return counter
+
+    def _get_now_timestamp(self):
+        return misc.get_timestamp(self._db_epoch, misc.now_dt(),
+                                  self._timestamp_precision)
+
+    def _get_expiry(self, now_dt, ttl):
+        if ttl is None:
+            return
+        if not isinstance(ttl, timedelta):
+            ttl = timedelta(seconds=ttl)
+        if ttl <= timedelta(0):
+            msg = "The ttl should be positive"
+            raise Exception(msg)
+        return misc.get_timestamp(self._db_epoch, now_dt + ttl,
+                                  self._timestamp_precision)
+
+    def _is_expired(self, expiry):
+        return expiry is not None and expiry <= self._get_now_timestamp()
+
+    def _get_live_criteria(self):
+        """Returns the criteria that excludes expired records"""
+        now = self._get_now_timestamp()
+        return "AND {} ".format(queries.KV_CRITERIA_11.format(now=now))
+
+    def _sync(self):
+        """Clear the cache and drop the filter if another connection
+        committed changes"""
+        if self._cache is None and not self._use_filter:
+            return
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_DATA_VERSION)  # read
+            data_version = cur.fetchone()[0]
+        if data_version != self._data_version:
+            if self._cache is not None:
+                self._cache.clear()
+            self._filter = None
+            self._data_version = data_version
+
+    def _may_exist(self, key):
+        """Returns False if the Bloom filter tells that the key
+        doesn't exist, else True. Call `_sync` beforehand."""
+        if not self._use_filter:
+            return True
+        bloom_filter = self._filter
+        if bloom_filter is None or bloom_filter.n_items > bloom_filter.capacity:
+            bloom_filter = self._build_filter()  # read
+        return key in bloom_filter
+
+    def _build_filter(self):
+        # the write lock prevents local writes from happening
+        # between the scan of the keys and the swap of the filter
+        with self._dbc.write_lock, self._dbc.cursor() as cur:
+            cur.execute(queries.COUNT_RECORDS.format(model=self._model_name))  # read
+            n_records = cur.fetchone()[0]
+            capacity = max(2 * n_records, FILTER_MIN_CAPACITY)
+            bloom_filter = BloomFilter(capacity, FILTER_ERROR_RATE)
+            sql = queries.GET_ALL_KV_KEYS.format(model=self._model_name)
+            cur.execute(sql)  # read
+            bloom_filter.update(row[0] for row in cur.fetch())
+            self._filter = bloom_filter
+            return bloom_filter
+
+    def _add_to_filter(self, key):
+        """To be called right after a local write that may have
+        created the key, while the write lock is still held"""
+        bloom_filter = self._filter
+        if bloom_filter is not None:
+            bloom_filter.add(key)
+
+    def _discard_cached(self, key):
+        if self._cache is not None:
+            self._cache.discard(key)
+
+    def _get_records_by_keys(self, keys, expired=False):
+        """Returns a dict mapping existing keys to KvRecord namedtuples.
+        Expired records are included only if `expired` is True."""
+        criteria = "" if expired else self._get_live_criteria()
+        with self._dbc.cursor() as cur:
+            records = dict()
+            int_keys = [key for key in keys if isinstance(key, int)]
+            str_keys = [key for key in keys if isinstance(key, str)]
+            for key_type, keys in (("int", int_keys), ("str", str_keys)):
+                for batch in misc.split_batches(keys):
+                    placeholders = misc.get_placeholders(len(batch))
+                    sql = queries.GET_KV_RECORDS_BY_KEYS.format(model=self._model_name,
+                                                                key_type=key_type,
+                                                                placeholders=placeholders,
+                                                                criteria=criteria)
+                    cur.execute(sql, batch)
+                    for *row, key in cur.fetch():
+                        records[key] = _create_record(row)
+            return records
+
+    def _get_record_by_key(self, key, expired=False):
+        """Returns a KvRecord namedtuple.
+        Expired records are included only if `expired` is True."""
+        criteria = "" if expired else self._get_live_criteria()
         with self._dbc.cursor() as cur:
             key_type = _get_key_type(key)
-            sql = queries.GET_KV_RECORD_BY_KEY.format(key_type=key_type)
+            sql = queries.GET_KV_RECORD_BY_KEY.format(model=self._model_name,
+                                                      key_type=key_type,
+                                                      criteria=criteria)
             cur.execute(sql, (key,))
             r = cur.fetchone()
             if r is None:  # nonexistent
                 return
-            record_id, dtype, db_timestamp = r
-            return record_id, Datatype(dtype), db_timestamp
+            return _create_record(r)
 
     def __getitem__(self, key):
         r = self.get(key)
@@ -307,27 +1002,42 @@ def _get_key_type(key):
         raise Exception(msg)
 
 
-def _get_key_criteria(timestamps):
-    # time_range_criteria
-    if timestamps is None:
-        time_range_criteria = ""
-    else:
-        time_range_criteria = queries.KV_CRITERIA_4.format(start=timestamps[0],
-                                                         stop=timestamps[1])
-    # criteria
-    if time_range_criteria:
-        criteria = "WHERE {}".format(time_range_criteria)
-    else:
-        criteria = ""
-    return criteria
+def _create_record(row):
+    record_id, dtype, db_timestamp, expiry, counter, payload, version = row
+    return KvRecord(uid=record_id, datatype=Datatype(dtype),
+                    timestamp=db_timestamp, expiry=expiry,
+                    counter=counter, payload=payload, version=version)
 
 
-def _get_int_key_criteria(first, last, timestamps):
+def _ensure_bucket_name(name):
+    # the name is part of table names
+    if not isinstance(name, str) or not re.fullmatch(r"[A-Za-z0-9_]{1,64}", name):
+        msg = ("A bucket name should be made of 1 to 64 ASCII letters, "
+               "digits, and underscores")
+        raise Exception(msg)
+    return name
+
+
+def _ensure_delta(delta):
+    if isinstance(delta, bool) or not isinstance(delta, int):
+        msg = "The delta should be an integer"
+        raise TypeError(msg)
+    return delta
+
+
+def _get_key_columns(key):
+    """Returns the (int_key, str_key) columns of a key"""
+    if _get_key_type(key) == "int":
+        return key, None
+    return None, key
+
+
+def _get_int_key_criteria(first, last, timestamps, after, asc):
     # key_criteria
     if first is not None and last is None:
-        key_criteria = queries.KV_CRITERIA_1.format(first)
+        key_criteria = queries.KV_CRITERIA_1.format(val=first)
     elif first is None and last is not None:
-        key_criteria = queries.KV_CRITERIA_2.format(last)
+        key_criteria = queries.KV_CRITERIA_2.format(val=last)
     elif first is not None and last is not None:
         key_criteria = queries.KV_CRITERIA_3.format(first=first, last=last)
     else:
@@ -338,28 +1048,47 @@ def _get_int_key_criteria(first, last, timestamps):
     else:
         time_range_criteria = queries.KV_CRITERIA_4.format(start=timestamps[0],
                                                          stop=timestamps[1])
-    # criteria
-    if key_criteria and not time_range_criteria:
-        criteria = "AND {}".format(key_criteria)
-    elif not key_criteria and time_range_criteria:
-        criteria = "AND {}".format(time_range_criteria)
-    elif key_criteria and time_range_criteria:
-        criteria = "AND {} AND {}".format(key_criteria, time_range_criteria)
+    # after_criteria
+    if after is None:
+        after_criteria = ""
+    elif asc:
+        after_criteria = queries.KV_CRITERIA_5.format(val=int(after))
     else:
-        criteria = ""
-    return criteria
+        after_criteria = queries.KV_CRITERIA_6.format(val=int(after))
+    # criteria
+    criteria = [x for x in (key_criteria, time_range_criteria, after_criteria) if x]
+    return "".join("AND {} ".format(x) for x in criteria)
 
 
-def _get_str_key_criteria(timestamps):
+def _get_str_key_criteria(timestamps, after, asc, prefix=None):
+    """Returns the criteria string and its query parameters"""
+    params = list()
     # time_range_criteria
     if timestamps is None:
         time_range_criteria = ""
     else:
         time_range_criteria = queries.KV_CRITERIA_4.format(start=timestamps[0],
                                                          stop=timestamps[1])
-    # criteria
-    if time_range_criteria:
-        criteria = "AND {}".format(time_range_criteria)
+    # after_criteria
+    if after is None:
+        after_criteria = ""
+    elif asc:
+        after_criteria = queries.KV_CRITERIA_7
+        params.append(after)
+    else:
+        after_criteria = queries.KV_CRITERIA_8
+        params.append(after)
+    # prefix_criteria
+    lower, upper = misc.get_prefix_bounds(prefix) if prefix else (None, None)
+    if lower is None:
+        prefix_criteria = ""
+    elif upper is None:
+        prefix_criteria = queries.KV_CRITERIA_9
+        params.append(lower)
     else:
-        criteria = ""
-    return criteria
+        prefix_criteria = queries.KV_CRITERIA_10
+        params.extend((lower, upper))
+    # criteria
+    criteria = [x for x in (time_range_criteria, after_criteria, prefix_criteria)
+                if x]
+    return "".join("AND {} ".format(x) for x in criteria), tuple(params)
@@ -1,11 +1,25 @@
 """The Queue store is defined in this module."""
+import secrets
+from collections import namedtuple
+from datetime import timedelta
 from paradict import Datatype
 from jinbase import queries, misc
-from jinbase.const import Model
+from jinbase.const import Model, VISIBILITY_TIMEOUT
 from jinbase.store import Store, RecordInfo
 
 
-__all__ = ["Queue"]
+__all__ = ["Queue", "Lease"]
+
+
+Lease = namedtuple("Lease", ("uid", "value", "receipt"))
+Lease.__doc__ = """\
+Named tuple returned by Queue.lease()
+
+[params]
+uid: The record id
+value: The leased item
+receipt: Token of the lease, to pass to Queue.ack() or Queue.nack()
+"""
 
 
 class Queue(Store):
@@ -37,50 +51,171 @@ class Queue(Store):
             cursor.execute(sql, (datatype.value, db_timestamp))  # write
             record_id = cursor.lastrowid
             self._store_data(record_id, datatype, value)  # write
-            return record_id
+        self._notify_write()
+        return record_id
 
     def enqueue_many(self, values):
         with self._dbc.immediate_transaction() as cursor:
-            uids = list()
-            for value in values:
-                uid = self.enqueue(value)
-                uids.append(uid)
-            return tuple(uids)
+            entries = (self._create_entry(value) for value in values)
+            sql = queries.INSERT_RECORDS.format(model=self._model_name)
+            uids = self._store_many(entries, sql)  # writeS
+        self._notify_write()
+        return tuple(uids)
+
+    def dequeue(self, default=None, *, block=False, timeout=None):
+        """
+        Dequeue an item. Leased items are skipped until their lease
+        expires, then they can be dequeued like the others.
+
+        [params]
+        - default: Value returned when the queue is empty
+        - block: Boolean to tell whether to wait for an item when the
+            queue is empty. Enqueues of this Queue object wake up the
+            waiter at once, and commits of other connections are
+            detected with `PRAGMA data_version`. The waiter also wakes
+            up when a lease expires.
+        - timeout: Max seconds to wait for an item. Defaults to None
+            to wait endlessly.
+
+        [return]
+        Returns the item, or `default`
+        """
+        if block:
+            value = self._wait_for(self._dequeue, timeout,
+                                   get_delay=self._get_lease_delay)  # writeS
+        else:
+            value = self._dequeue()  # write
+        return default if value is None else value
+
+    def dequeue_many(self, n, *, block=False, timeout=None):
+        """
+        Dequeue up to `n` items in a single write transaction.
+        With `block` set to True, wait for at least an item, like `dequeue`.
+
+        [return]
+        Returns the tuple of items, in FIFO order
+        """
+        n = int(n)
+        if block and n > 0:
+            values = self._wait_for(lambda: self._dequeue_many(n), timeout,
+                                    get_delay=self._get_lease_delay)  # writeS
+        else:
+            values = self._dequeue_many(n)  # write
+        return tuple() if values is None else values
+
+    def lease(self, n=1, visibility_timeout=VISIBILITY_TIMEOUT):
+        """
+        Lease up to `n` items: leased items are marked as in flight
+        instead of being deleted, thus they are skipped by `dequeue`
+        and by the peek methods until they are acknowledged with `ack`,
+        released with `nack`, or until their lease expires. Items whose
+        lease expired are leased again first, then items are leased
+        in FIFO order.
+
+        [params]
+        - n: Max number of items
+        - visibility_timeout: Seconds, or `datetime.timedelta`, after
+            which a leased item that isn't acknowledged can be leased again.
+            Defaults to `jinbase.const.VISIBILITY_TIMEOUT`.
 
-    def dequeue(self, default=None):
+        [return]
+        Returns the tuple of Lease namedtuples, ordered by uid
+        """
+        if isinstance(visibility_timeout, timedelta):
+            visibility_timeout = visibility_timeout.total_seconds()
+        if visibility_timeout <= 0:
+            msg = "The visibility timeout should be positive"
+            raise ValueError(msg)
+        n = int(n)
+        if n <= 0:
+            return tuple()
         with self._dbc.immediate_transaction() as cursor:
-            r = self._get_front()  # read
-            if r is None:  # nonexistent
-                return default
-            record_id, datatype, _ = r
-            # get value
-            value = self._retrieve_data(record_id, datatype)  # read
-            # delete record
-            self._delete_record(record_id)
-            return value
+            now = misc.now_dt()
+            timestamp = misc.get_timestamp(self._db_epoch, now,
+                                           self._timestamp_precision)
+            expiry = misc.get_timestamp(self._db_epoch,
+                                        now + timedelta(seconds=visibility_timeout),
+                                        self._timestamp_precision)
+            cursor.execute(queries.GET_EXPIRED_LEASES, (timestamp, n))  # read
+            uids = [row[0] for row in cursor.fetchall()]
+            if len(uids) < n:
+                cursor.execute(queries.GET_QUEUE_FRONT_UIDS, (n - len(uids), ))  # read
+                uids.extend(row[0] for row in cursor.fetchall())
+            receipt = secrets.randbits(63)
+            items = list()
+            for batch in misc.split_batches(sorted(uids)):
+                placeholders = misc.get_placeholders(len(batch))
+                sql = queries.SET_LEASES.format(placeholders=placeholders)
+                cursor.execute(sql, (expiry, receipt, *batch))  # write
+                sql = queries.STREAM_RECORDS_BY_IDS.format(model=self._model_name,
+                                                           placeholders=placeholders)
+                items.extend(Lease(uid=uid, value=value, receipt=receipt)
+                             for uid, value in self._stream_records(sql, batch))  # read
+            return tuple(items)
+
+    def ack(self, uid, receipt):
+        """
+        Acknowledge a leased item, that is, delete it
+
+        [params]
+        - uid: The uid of the item
+        - receipt: The receipt of the lease
+
+        [return]
+        Returns False if the item doesn't exist, isn't leased, or was
+        leased again under another receipt after its lease expired, else True
+        """
+        with self._dbc.immediate_transaction() as cursor:
+            cursor.execute(queries.ACK_LEASE, (uid, receipt))  # write
+            return cursor.rowcount > 0
+
+    def nack(self, uid, receipt):
+        """
+        Release a leased item, so that it goes back to its place in the queue
+
+        [params]
+        - uid: The uid of the item
+        - receipt: The receipt of the lease
+
+        [return]
+        Returns False if the item doesn't exist, isn't leased, or was
+        leased again under another receipt after its lease expired, else True
+        """
+        with self._dbc.immediate_transaction() as cursor:
+            cursor.execute(queries.NACK_LEASE, (uid, receipt))  # write
+            is_released = cursor.rowcount > 0
+        if is_released:
+            self._notify_write()
+        return is_released
+
+    def count_leases(self):
+        """Returns the number of leased items, expired leases included"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.COUNT_LEASES)  # read
+            return cur.fetchone()[0]
 
     def peek_front(self, default=None):
         with self._dbc.transaction():
             r = self._get_front()  # read
             if r is None:
                 return default
-            record_id, datatype, _ = r
-            return self._retrieve_data(record_id, datatype)  # read
+            record_id, datatype, _, payload = r
+            return self._retrieve_data(record_id, datatype, payload)  # read
 
     def peek_back(self, default=None):
         with self._dbc.transaction():
             r = self._get_back()  # read
             if r is None:
                 return default
-            record_id, datatype, _ = r
-            return self._retrieve_data(record_id, datatype)  # read
+            record_id, datatype, _, payload = r
+            return self._retrieve_data(record_id, datatype, payload)  # read
 
     def count_front_bytes(self):
         with self._dbc.transaction() as cur:
             r = self._get_front()  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
+            record_id, _, _, _ = r
             sql = queries.COUNT_RECORD_BYTES.format(model=self._model_name)
             cur.execute(sql, (record_id,))  # read
             r = cur.fetchone()[0]
@@ -91,7 +226,7 @@ class Queue(Store):
             r = self._get_back()  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
+            record_id, _, _, _ = r
             sql = queries.COUNT_RECORD_BYTES.format(model=self._model_name)
             cur.execute(sql, (record_id,))  # read
             r = cur.fetchone()[0]
@@ -102,7 +237,7 @@ class Queue(Store):
             r = self._get_front()  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
+            record_id, _, _, _ = r
             sql = queries.COUNT_RECORD_CHUNKS.format(model=self._model_name)
             cur.execute(sql, (record_id,))  # read
             r = cur.fetchone()[0]
@@ -113,7 +248,7 @@ class Queue(Store):
             r = self._get_back()  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
+            record_id, _, _, _ = r
             sql = queries.COUNT_RECORD_CHUNKS.format(model=self._model_name)
             cur.execute(sql, (record_id,))  # read
             r = cur.fetchone()[0]
@@ -122,26 +257,20 @@ class Queue(Store):
     def front_uid(self):
         with self._dbc.cursor() as cur:
             sql = queries.GET_QUEUE_FRONT_UID
-            cur.execute(sql)
-            r = cur.fetchone()
-            if r is None:
-                return
-            return r[0]
+            cur.execute(sql, (self._get_now_timestamp(), ))
+            return cur.fetchone()[0]
 
     def back_uid(self):
         with self._dbc.cursor() as cur:
             sql = queries.GET_QUEUE_BACK_UID
-            cur.execute(sql)
-            r = cur.fetchone()
-            if r is None:
-                return
-            return r[0]
+            cur.execute(sql, (self._get_now_timestamp(), ))
+            return cur.fetchone()[0]
 
     def info_front(self):
         r = self._get_front()  # read
         if r is None:
             return
-        record_id, datatype, db_timestamp = r
+        record_id, datatype, db_timestamp, _ = r
         created_at = misc.get_datetime_str(self._db_epoch, db_timestamp,
                                            self._timestamp_precision)
         return RecordInfo(uid=record_id, datatype=datatype, created_at=created_at)
@@ -150,27 +279,64 @@ class Queue(Store):
         r = self._get_back()  # read
         if r is None:
             return
-        record_id, datatype, db_timestamp = r
+        record_id, datatype, db_timestamp, _ = r
         created_at = misc.get_datetime_str(self._db_epoch, db_timestamp,
                                            self._timestamp_precision)
         return RecordInfo(uid=record_id, datatype=datatype, created_at=created_at)
 
+    def _dequeue(self):
+        """Returns the dequeued item, or None if the queue is empty"""
+        with self._dbc.immediate_transaction() as cursor:
+            r = self._get_front()  # read
+            if r is None:  # nonexistent
+                return
+            record_id, datatype, _, payload = r
+            # get value
+            value = self._retrieve_data(record_id, datatype, payload)  # read
+            # delete record
+            self._delete_record(record_id)
+            return value
+
+    def _dequeue_many(self, n):
+        """Returns the tuple of dequeued items, or None if the queue is empty"""
+        with self._dbc.immediate_transaction() as cursor:
+            now = self._get_now_timestamp()
+            criteria = queries.QUEUE_CRITERIA.format(now=now)
+            values = self._take_many(n, asc=True, criteria=criteria)  # writeS
+            return values if values else None
+
     def _get_front(self):
         with self._dbc.cursor() as cur:
             sql = queries.GET_QUEUE_FRONT
-            cur.execute(sql)
+            cur.execute(sql, (self._get_now_timestamp(), ))
             r = cur.fetchone()
             if r is None:
                 return
-            record_id, dtype, db_timestamp = r
-            return record_id, Datatype(dtype), db_timestamp
+            record_id, dtype, db_timestamp, payload = r
+            return record_id, Datatype(dtype), db_timestamp, payload
 
     def _get_back(self):
         with self._dbc.cursor() as cur:
             sql = queries.GET_QUEUE_BACK
-            cur.execute(sql)
+            cur.execute(sql, (self._get_now_timestamp(), ))
             r = cur.fetchone()
             if r is None:
                 return
-            record_id, dtype, db_timestamp = r
-            return record_id, Datatype(dtype), db_timestamp
+            record_id, dtype, db_timestamp, payload = r
+            return record_id, Datatype(dtype), db_timestamp, payload
+
+    def _get_lease_delay(self):
+        """Returns the seconds until the next lease expires,
+        or None if no item is leased"""
+        with self._dbc.cursor() as cur:
+            cur.execute(queries.GET_NEXT_LEASE_EXPIRY)  # read
+            expiry = cur.fetchone()[0]
+        if expiry is None:
+            return
+        expiry_dt = misc.get_datetime(self._db_epoch, expiry,
+                                      self._timestamp_precision)
+        return (expiry_dt - misc.now_dt()).total_seconds()
+
+    def _get_now_timestamp(self):
+        return misc.get_timestamp(self._db_epoch, misc.now_dt(),
+                                  self._timestamp_precision)
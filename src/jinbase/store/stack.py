@@ -37,35 +37,61 @@ class Stack(Store):
             cursor.execute(sql, (datatype.value, db_timestamp))  # write
             record_id = cursor.lastrowid
             self._store_data(record_id, datatype, value)  # write
-            return record_id
+        self._notify_write()
+        return record_id
 
     def push_many(self, values):
         with self._dbc.immediate_transaction() as cursor:
-            uids = list()
-            for value in values:
-                uid = self.push(value)
-                uids.append(uid)
-            return tuple(uids)
+            entries = (self._create_entry(value) for value in values)
+            sql = queries.INSERT_RECORDS.format(model=self._model_name)
+            uids = self._store_many(entries, sql)  # writeS
+        self._notify_write()
+        return tuple(uids)
 
-    def pop(self, default=None):
-        with self._dbc.immediate_transaction() as cursor:
-            r = self._get_top()  # read
-            if r is None:
-                return default
-            record_id, datatype, _ = r
-            # get value
-            value = self._retrieve_data(record_id, datatype)  # read
-            # delete record
-            self._delete_record(record_id)
-            return value
+    def pop(self, default=None, *, block=False, timeout=None):
+        """
+        Pop an item
+
+        [params]
+        - default: Value returned when the stack is empty
+        - block: Boolean to tell whether to wait for an item when the
+            stack is empty. Pushes of this Stack object wake up the
+            waiter at once, and commits of other connections are
+            detected with `PRAGMA data_version`.
+        - timeout: Max seconds to wait for an item. Defaults to None
+            to wait endlessly.
+
+        [return]
+        Returns the item, or `default`
+        """
+        if block:
+            value = self._wait_for(self._pop, timeout)  # writeS
+        else:
+            value = self._pop()  # write
+        return default if value is None else value
+
+    def pop_many(self, n, *, block=False, timeout=None):
+        """
+        Pop up to `n` items in a single write transaction.
+        With `block` set to True, wait for at least an item, like `pop`.
+
+        [return]
+        Returns the tuple of items, in LIFO order
+        """
+        n = int(n)
+        if block and n > 0:
+            values = self._wait_for(lambda: self._pop_many(n), timeout)  # writeS
+        else:
+            values = self._pop_many(n)  # write
+        return tuple() if values is None else values
 
     def peek(self, default=None):
         with self._dbc.transaction():
             r = self._get_top()  # read
             if r is None:
                 return default
-            record_id, datatype, _ = r
-            return self._retrieve_data(record_id, datatype)
+            record_id, datatype, _, payload = r
+            return self._retrieve_data(record_id, datatype, payload)
 
     def top_uid(self):
         with self._dbc.cursor() as cur:
@@ -81,7 +107,7 @@ class Stack(Store):
             r = self._get_top()  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
+            record_id, _, _, _ = r
             sql = queries.COUNT_RECORD_BYTES.format(model=self._model_name)
             cur.execute(sql, (record_id,))  # read
             r = cur.fetchone()[0]
@@ -92,7 +118,7 @@ class Stack(Store):
             r = self._get_top()  # read
             if r is None:
                 return 0
-            record_id, _, _ = r
+            record_id, _, _, _ = r
             sql = queries.COUNT_RECORD_CHUNKS.format(model=self._model_name)
             cur.execute(sql, (record_id,))  # read
             r = cur.fetchone()[0]
@@ -102,11 +128,30 @@ class Stack(Store):
         r = self._get_top()  # read
         if r is None:
             return
-        record_id, datatype, db_timestamp = r
+        record_id, datatype, db_timestamp, _ = r
         created_at = misc.get_datetime_str(self._db_epoch, db_timestamp,
                                            self._timestamp_precision)
         return RecordInfo(uid=record_id, datatype=datatype, created_at=created_at)
 
+    def _pop(self):
+        """Returns the popped item, or None if the stack is empty"""
+        with self._dbc.immediate_transaction() as cursor:
+            r = self._get_top()  # read
+            if r is None:
+                return
+            record_id, datatype, _, payload = r
+            # get value
+            value = self._retrieve_data(record_id, datatype, payload)  # read
+            # delete record
+            self._delete_record(record_id)
+            return value
+
+    def _pop_many(self, n):
+        """Returns the tuple of popped items, or None if the stack is empty"""
+        with self._dbc.immediate_transaction() as cursor:
+            values = self._take_many(n, asc=False)  # writeS
+            return values if values else None
+
     def _get_top(self):
         with self._dbc.cursor() as cur:
             sql = queries.GET_STACK_TOP
@@ -114,5 +159,5 @@ class Stack(Store):
             r = cur.fetchone()
             if r is None:
                 return
-            record_id, dtype, db_timestamp = r
-            return record_id, Datatype(dtype), db_timestamp
+            record_id, dtype, db_timestamp, payload = r
+            return record_id, Datatype(dtype), db_timestamp, payload
@@ -46,6 +46,11 @@ class TestGetBlobSlicesFunction(unittest.TestCase):
                         (2, slice(0, 5)),
                         (3, slice(0, 4)))
             self.assertEqual(expected, r)
+        with self.subTest():
+            start_index, stop_index = 6, 8
+            r = get_blob_slices(start_index, stop_index, chunk_size)
+            expected = ((1, slice(1, 4)), )
+            self.assertEqual(expected, r)
 
     def test_start_equals_stop(self):
         chunk_size = 5
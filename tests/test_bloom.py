@@ -0,0 +1,48 @@
+import unittest
+from jinbase.bloom import BloomFilter, FilterInfo
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def setUp(self):
+        self._filter = BloomFilter(1000, 0.01)
+
+    def test_add_and_lookup(self):
+        with self.subTest("Empty filter"):
+            self.assertNotIn("key", self._filter)
+            self.assertEqual(0, len(self._filter))
+        with self.subTest("Added keys"):
+            self.assertTrue(self._filter.add("key"))
+            self.assertTrue(self._filter.add(42))
+            self.assertIn("key", self._filter)
+            self.assertIn(42, self._filter)
+        with self.subTest("Integer and string keys are distinct"):
+            self.assertNotIn("42", self._filter)
+        with self.subTest("Added twice"):
+            self.assertFalse(self._filter.add("key"))
+            self.assertEqual(2, len(self._filter))
+
+    def test_false_positive_rate(self):
+        self._filter.update(range(1000))
+        for i in range(1000):
+            self.assertIn(i, self._filter)
+        n_false_positives = sum(1 for i in range(1000, 11000)
+                                if i in self._filter)
+        self.assertLess(n_false_positives, 300)
+
+    def test_info(self):
+        self._filter.add("a")
+        "a" in self._filter
+        "b" in self._filter
+        info = self._filter.info()
+        self.assertIsInstance(info, FilterInfo)
+        self.assertEqual((1, 1000, 1, 1), (info.n_items, info.capacity,
+                                           info.hits, info.skips))
+
+    def test_invalid_error_rate(self):
+        with self.assertRaises(ValueError):
+            BloomFilter(10, 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from paradict import Datatype
+from jinbase.cache import LruCache, CacheInfo
+
+
+class TestLruCache(unittest.TestCase):
+
+    def setUp(self):
+        self._cache = LruCache(10)
+
+    def test_get_and_put(self):
+        with self.subTest("Miss"):
+            self.assertIsNone(self._cache.get("key"))
+            self.assertEqual(-1, self._cache.get("key", -1))
+        with self.subTest("Hit"):
+            self._cache.put("key", "value", Datatype.STR, 5)
+            self.assertEqual("value", self._cache.get("key"))
+        with self.subTest("Counters"):
+            expected = CacheInfo(hits=1, misses=2, n_items=1,
+                                 n_bytes=5, max_bytes=10)
+            self.assertEqual(expected, self._cache.info())
+
+    def test_eviction(self):
+        self._cache.put("a", 1, Datatype.INT, 4)
+        self._cache.put("b", 2, Datatype.INT, 4)
+        self._cache.get("a")  # 'b' becomes the least recently used
+        self._cache.put("c", 3, Datatype.INT, 4)
+        self.assertIn("a", self._cache)
+        self.assertNotIn("b", self._cache)
+        self.assertIn("c", self._cache)
+        self.assertEqual(8, self._cache.info().n_bytes)
+
+    def test_oversized_value(self):
+        self._cache.put("a", b'x' * 11, Datatype.BIN, 11)
+        self.assertNotIn("a", self._cache)
+        self.assertEqual(0, len(self._cache))
+
+    def test_discard_and_clear(self):
+        self._cache.put("a", 1, Datatype.INT, 4)
+        self._cache.put("b", 2, Datatype.INT, 4)
+        self._cache.discard("a")
+        self._cache.discard("nonexistent")
+        self.assertNotIn("a", self._cache)
+        self.assertEqual(4, self._cache.info().n_bytes)
+        self._cache.clear()
+        self.assertEqual(0, len(self._cache))
+        self.assertEqual(0, self._cache.info().n_bytes)
+
+    def test_mutable_values_are_copied(self):
+        value = {"books": ["Dune"]}
+        self._cache.put("a", value, Datatype.DICT, 8)
+        value["books"].append("Neuromancer")
+        r = self._cache.get("a")
+        self.assertEqual({"books": ["Dune"]}, r)
+        r["books"].clear()
+        self.assertEqual({"books": ["Dune"]}, self._cache.get("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
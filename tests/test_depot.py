@@ -2,10 +2,11 @@ import os.path
 import time
 import unittest
 import tempfile
+import threading
 import paradict
 from paradict import Datatype
-from datetime import datetime
-from jinbase import Jinbase, RecordInfo, const
+from datetime import datetime, timedelta
+from jinbase import Jinbase, RecordInfo, RetentionPolicy, const, queries
 
 
 USER_CARD = {"id": 42, "name": "alex", "pi": 3.14,
@@ -186,6 +187,21 @@ class TestDepotStore(unittest.TestCase):
         self.assertEqual(USER_CARD, self._store.get(rowids[0]))
         self.assertEqual(USER_CARD, self._store.get(rowids[1]))
 
+    def test_extend_method_with_bulk_data(self):
+        with self.subTest("None values are skipped"):
+            rowids = self._store.extend([USER_CARD, None, b'', "alex"])
+            self.assertEqual((1, None, 2, 3), rowids)
+            self.assertEqual([USER_CARD, b'', "alex"],
+                             [x[1] for x in self._store.iterate()])
+            self.assertEqual("alex", self._store.load_field(1, "name"))
+        with self.subTest("Deleted uids are never reused"):
+            self._store.delete(3)
+            rowids = self._store.extend(range(1000))
+            self.assertEqual(tuple(range(4, 1004)), rowids)
+            self.assertEqual(1002, self._store.count_records())
+            self.assertEqual(999, self._store.get(1003))
+            self.assertEqual(1004, self._store.append(42))
+
     def test_delete_method(self):
         items = ("Z", "A", "B", "C", "D", "E", "F")
         self._store.extend(items)
@@ -404,6 +420,17 @@ class TestSmallestChunkSize(unittest.TestCase):
             rowid = self._store.append(None)
             self.assertIsNone(rowid)
 
+    def test_iterate(self):
+        values = [USER_CARD, b'', b'ABC', "alex", EMPTY_USER_CARD]
+        uids = self._store.extend(values)
+        with self.subTest("Ascending"):
+            r = tuple(self._store.iterate())
+            self.assertEqual(tuple(zip(uids, values)), r)
+        with self.subTest("Descending"):
+            r = tuple(self._store.iterate(asc=False, limit=2))
+            expected = ((uids[4], values[4]), (uids[3], values[3]))
+            self.assertEqual(expected, r)
+
     def test_count_chunks(self):
         rowid1 = self._store.append(USER_CARD)
         rowid2 = self._store.append(USER_CARD)
@@ -690,5 +717,525 @@ class TestFields(unittest.TestCase):
             self.assertEqual(expected, r)
 
 
+    def test_load_fields_method(self):
+        with self.subTest():
+            uid = self._store.append(USER_CARD)
+            fields = ("permission", "nonexistent-field", "birthday")
+            r = self._store.load_fields(uid, fields)
+            expected = {"permission": USER_CARD["permission"],
+                        "nonexistent-field": None,
+                        "birthday": USER_CARD["birthday"]}
+            self.assertEqual(expected, r)
+            self.assertEqual(fields, tuple(r.keys()))
+        with self.subTest():
+            r = self._store.load_fields(uid, ("nonexistent-field", ),
+                                        default=-1)
+            self.assertEqual({"nonexistent-field": -1}, r)
+        with self.subTest():
+            r = self._store.load_fields(uid, tuple())
+            self.assertEqual(dict(), r)
+
+    def test_load_fields_method_with_smallest_chunk_size(self):
+        self._jinbase.close()
+        self._jinbase = Jinbase(self._filename, chunk_size=1)
+        self._store = self._jinbase.depot
+        uid = self._store.append(USER_CARD)
+        fields = tuple(USER_CARD.keys())
+        r = self._store.load_fields(uid, fields)
+        expected = {field: USER_CARD[field] for field in fields}
+        self.assertEqual(expected, r)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.depot
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_create_index_method(self):
+        uid_1 = self._store.append({"customer": "alex", "amount": 4.2})
+        uid_2 = self._store.append({"customer": "bob", "amount": 10})
+        self._store.append(["alex", 42])
+        with self.subTest():
+            self.assertTrue(self._store.create_index("customer"))
+            self.assertFalse(self._store.create_index("customer"))
+            self.assertEqual(("customer", ), self._store.indexes())
+        with self.subTest():
+            r = tuple(self._store.find("customer", "alex"))
+            self.assertEqual((uid_1, ), r)
+        with self.subTest():
+            self.assertTrue(self._store.drop_index("customer"))
+            self.assertEqual(tuple(), self._store.indexes())
+            with self.assertRaises(Exception):
+                tuple(self._store.find("customer", "alex"))
+
+    def test_find_method(self):
+        self._store.create_index("customer")
+        self._store.create_index("amount")
+        uids = self._store.extend([{"customer": "alex", "amount": 4.2},
+                                   {"customer": "bob", "amount": 10},
+                                   {"customer": "alex", "amount": 1},
+                                   {"customer": "alex", "amount": True}])
+        uid = self._store.append({"customer": "bob", "amount": 2})
+        with self.subTest():
+            r = tuple(self._store.find("customer", "alex"))
+            self.assertEqual(uids[0:1] + uids[2:4], r)
+        with self.subTest():
+            r = tuple(self._store.find("amount", first=2, last=5))
+            self.assertEqual((uid, uids[0]), r)
+        with self.subTest():
+            r = tuple(self._store.find("amount", asc=False, limit=2))
+            self.assertEqual((uids[1], uids[0]), r)
+        with self.subTest():
+            self._store.delete(uids[0])
+            r = tuple(self._store.find("customer", "alex"))
+            self.assertEqual(uids[2:4], r)
+
+    def test_backfill_with_smallest_chunk_size(self):
+        self._jinbase.close()
+        self._jinbase = Jinbase(self._filename, chunk_size=1)
+        self._store = self._jinbase.depot
+        uid_1 = self._store.append({"customer": "alex"})
+        uid_2 = self._store.append({"customer": "bob"})
+        self._store.create_index("customer")
+        r = tuple(self._store.find("customer", "bob"))
+        self.assertEqual((uid_2, ), r)
+
+
+class TestPositions(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.depot
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _check_positions(self, expected_uids):
+        for position, uid in enumerate(expected_uids):
+            self.assertEqual(uid, self._store.uid(position))
+            self.assertEqual(uid, self._store.uid(position - len(expected_uids)))
+            self.assertEqual(position, self._store.position(uid))
+        self.assertIsNone(self._store.uid(len(expected_uids)))
+        self.assertIsNone(self._store.uid(-len(expected_uids) - 1))
+
+    def test_positions_after_deletions(self):
+        uids = list(self._store.extend(range(10)))
+        uids.append(self._store.append(10))
+        self._check_positions(uids)
+        with self.subTest("Delete the first record"):
+            self._store.delete(uids.pop(0))
+            self._check_positions(uids)
+        with self.subTest("Delete the last record"):
+            self._store.delete(uids.pop())
+            self._check_positions(uids)
+        with self.subTest("Delete records in the middle"):
+            self._store.delete(uids.pop(2))
+            self._store.delete(uids.pop(-3))
+            self._check_positions(uids)
+        with self.subTest("Append after deletions"):
+            uids.append(self._store.append(42))
+            uids.extend(self._store.extend([None, 43, 44]))
+            uids.remove(None)
+            self._check_positions(uids)
+        with self.subTest("delete_many"):
+            deleted = uids[1::2]
+            self._store.delete_many(deleted)
+            uids = uids[0::2]
+            self._check_positions(uids)
+        with self.subTest("First and last"):
+            self.assertEqual(self._store.get(uids[0]), self._store.get_first())
+            self.assertEqual(self._store.get(uids[-1]), self._store.get_last())
+        with self.subTest("delete_all"):
+            self._store.delete_all()
+            self._check_positions([])
+            uid = self._store.append("hello")
+            self._check_positions([uid])
+
+    def test_queries_use_the_seq_index(self):
+        with self._jinbase.dbc.cursor() as cur:
+            for sql, params in ((queries.GET_DEPOT_UID_BY_SEQ, (1, )),
+                                (queries.GET_DEPOT_SEQ_RANGE, ()),
+                                (queries.GET_DEPOT_POSITION, (1, )),
+                                (queries.SHIFT_DEPOT_TAIL, (1, )),
+                                (queries.RENUMBER_DEPOT_TAIL, (1, 1))):
+                cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+                plan = " ".join(str(row[-1]) for row in cur.fetchall())
+                with self.subTest(sql):
+                    self.assertIn("idx_jinbase_depot_record_seq", plan)
+                    self.assertNotIn("SCAN jinbase_depot_record", plan)
+
+
+class TestSlices(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename, chunk_size=16, inline_size=8)
+        self._store = self._jinbase.depot
+        values = ["record {}".format(i) * (i % 4) for i in range(20)]
+        uids = self._store.extend(values)
+        self._pairs = list(zip(uids, values))
+        # holes in the sequence of uids
+        for uid, _ in self._pairs[5:8]:
+            self._store.delete(uid)
+        del self._pairs[5:8]
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_get_many_method(self):
+        uids = [self._pairs[3][0], 42, self._pairs[0][0]]
+        r = self._store.get_many(uids, default="missing")
+        expected = {self._pairs[3][0]: self._pairs[3][1], 42: "missing",
+                    self._pairs[0][0]: self._pairs[0][1]}
+        self.assertEqual(expected, r)
+        self.assertEqual(uids, list(r.keys()))
+        self.assertEqual(dict(), self._store.get_many([]))
+
+    def test_slice_by_position(self):
+        for start, stop, step in ((None, None, None), (2, 9, None),
+                                  (-5, None, None), (1, 15, 3),
+                                  (None, None, -1), (12, 2, -4),
+                                  (42, None, None), (5, 2, None)):
+            with self.subTest(start=start, stop=stop, step=step):
+                r = list(self._store.slice(start, stop, step))
+                self.assertEqual(self._pairs[start:stop:step], r)
+
+    def test_slice_by_uid(self):
+        uids = [uid for uid, _ in self._pairs]
+        with self.subTest("Half-open range"):
+            r = list(self._store.slice(3, 10, by_uid=True))
+            expected = [x for x in self._pairs if 3 <= x[0] < 10]
+            self.assertEqual(expected, r)
+        with self.subTest("Step"):
+            r = list(self._store.slice(None, None, 2, by_uid=True))
+            self.assertEqual(self._pairs[::2], r)
+        with self.subTest("Reverse order"):
+            r = list(self._store.slice(uids[-2], uids[1], -1, by_uid=True))
+            self.assertEqual(self._pairs[-2:1:-1], r)
+        with self.subTest("Empty range"):
+            self.assertEqual([], list(self._store.slice(100, 200, by_uid=True)))
+
+    def test_zero_step(self):
+        with self.assertRaises(ValueError):
+            list(self._store.slice(0, 5, 0))
+
+    def test_getitem(self):
+        self.assertEqual(self._pairs[2][1], self._store[2])
+        self.assertEqual(self._pairs[-1][1], self._store[-1])
+        self.assertEqual(self._pairs[1:4], list(self._store[1:4]))
+        with self.assertRaises(IndexError):
+            self._store[42]
+
+    def test_getitem_shapes(self):
+        with self.subTest("Position returns the bare value"):
+            self.assertEqual(self._pairs[2][1], self._store[2])
+            self.assertNotIsInstance(self._store[2], tuple)
+        with self.subTest("Slice yields (uid, value) tuples"):
+            r = list(self._store[2:3])
+            self.assertEqual([self._pairs[2]], r)
+            self.assertIsInstance(r[0], tuple)
+            self.assertEqual(2, len(r[0]))
+
+    def test_slice_uses_the_seq_index(self):
+        sql = queries.STREAM_DEPOT_SLICE.format(criteria="", sort_order="ASC")
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, (0, 10))
+            plan = " ".join(str(row[-1]) for row in cur.fetchall())
+        self.assertIn("idx_jinbase_depot_record_seq", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.depot
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_retention_method(self):
+        with self.subTest("No policy"):
+            self.assertIsNone(self._store.retention())
+        with self.subTest("Set policy"):
+            self._store.set_retention(max_records=10, max_age=timedelta(hours=1))
+            expected = RetentionPolicy(max_records=10, max_bytes=None,
+                                       max_age=3600.0)
+            self.assertEqual(expected, self._store.retention())
+        with self.subTest("Policy is stored in the database"):
+            with Jinbase(self._filename) as jinbase:
+                self.assertEqual(expected, jinbase.depot.retention())
+        with self.subTest("Remove policy"):
+            self._store.set_retention()
+            self.assertIsNone(self._store.retention())
+        with self.subTest("Invalid limits"):
+            with self.assertRaises(ValueError):
+                self._store.set_retention(max_records=0)
+            with self.assertRaises(ValueError):
+                self._store.set_retention(max_age=-1)
+        with self.subTest("Invalid limit types"):
+            for kwargs in ({"max_records": "5"}, {"max_bytes": True},
+                           {"max_age": "60"}, {"max_records": [5]}):
+                with self.assertRaises(TypeError) as cm:
+                    self._store.set_retention(**kwargs)
+                self.assertIn(next(iter(kwargs)), str(cm.exception))
+            self.assertIsNone(self._store.retention())
+
+    def test_set_retention_defers_trimming(self):
+        self._store.extend(range(20))
+        self._store.set_retention(max_records=5)
+        self.assertEqual(20, self._store.count_records())
+        self.assertEqual(15, self._store.enforce_retention())
+        self.assertEqual(list(range(15, 20)),
+                         [x[1] for x in self._store.iterate()])
+
+    def test_max_records(self):
+        self._store.set_retention(max_records=5)
+        self._store.extend(range(20))
+        self._store.append(20)
+        self.assertEqual(list(range(16, 21)), [x[1] for x in self._store.iterate()])
+        self.assertEqual(16, self._store[0])
+        self.assertEqual(0, self._store.position(self._store.uid(0)))
+
+    def test_max_bytes(self):
+        self._store.extend(["x" * 100] * 5)
+        self._store.set_retention(max_bytes=1000)
+        for _ in range(20):
+            self._store.append("y" * 100)
+            self.assertLessEqual(self._store.count_bytes(), 1000)
+        self.assertEqual(["y" * 100] * self._store.count_records(),
+                         [x[1] for x in self._store.iterate()])
+        with self.subTest("Deletions are tracked"):
+            self._store.delete(self._store.uid(0))
+            self._store.delete_all()
+            self._store.extend(["z" * 100] * 5)
+            self.assertEqual(5, self._store.count_records())
+            n_bytes = self._store._get_retention()[3]
+            self.assertEqual(self._store.count_bytes(), n_bytes)
+
+    def test_max_age(self):
+        self._store.extend(range(3))
+        self._store.set_retention(max_age=0.1)
+        time.sleep(0.2)
+        self._store.append(3)
+        self.assertEqual([3], [x[1] for x in self._store.iterate()])
+
+    def test_enforce_retention_method(self):
+        self._store.extend(range(50))
+        self._store.set_retention(max_records=10)
+        with self.subTest("Batches"):
+            self.assertEqual(40, self._store.enforce_retention(batch_size=7))
+            self.assertEqual(list(range(40, 50)), [x[1] for x in self._store.iterate()])
+        with self.subTest("Nothing to delete"):
+            self.assertEqual(0, self._store.enforce_retention())
+        with self.subTest("No policy"):
+            self._store.set_retention()
+            self.assertEqual(0, self._store.enforce_retention())
+        with self.subTest("Invalid batch size"):
+            with self.assertRaises(ValueError):
+                self._store.enforce_retention(batch_size=0)
+
+    def test_writes_trim_by_bounded_batches(self):
+        filename = os.path.join(self._tempdir.name, "other.db")
+        with Jinbase(filename, retention_lock_time=0) as jinbase:
+            store = jinbase.depot
+            self.assertEqual(0, store.retention_lock_time)
+            store.extend(range(30))
+            store.set_retention(max_records=5)
+            # each write deletes at least one record
+            store.append(30)
+            self.assertLess(store.count_records(), 31)
+            store.enforce_retention()
+            self.assertEqual(5, store.count_records())
+
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.depot
+        # populate the store
+        self._store.append({"amount": 200, "customer": "alex"})
+        time.sleep(0.001)  # timestamp precision matters
+        self._dt1 = self._store.now()
+        self._store.append({"customer": "bob", "amount": 4.5})
+        # chunked record
+        self._store.append({"note": "x" * 100000, "amount": 10})
+        self._store.append({"amount": "ten"})
+        self._store.append({"amount": True})
+        self._store.append({"customer": "paul"})
+        self._store.append([1, 2, 3])
+        self._dt2 = self._store.now()
+        time.sleep(0.001)  # timestamp precision matters
+        self._store.append({"amount": -5})
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_aggregate_method(self):
+        for indexed in (False, True):
+            if indexed:
+                self._store.create_index("amount")
+            with self.subTest("Default operations", indexed=indexed):
+                r = self._store.aggregate("amount")
+                expected = {"count": 4, "sum": 209.5, "min": -5, "max": 200}
+                self.assertEqual(expected, r)
+            with self.subTest("Average", indexed=indexed):
+                r = self._store.aggregate("amount", ops=("avg", "count"))
+                self.assertEqual({"avg": 209.5 / 4, "count": 4}, r)
+            with self.subTest("Time range", indexed=indexed):
+                r = self._store.aggregate("amount", ops=("count", "sum", "max"),
+                                          time_range=(self._dt1, self._dt2))
+                self.assertEqual({"count": 2, "sum": 14.5, "max": 10}, r)
+            with self.subTest("No values", indexed=indexed):
+                r = self._store.aggregate("nonexistent", ops=("count", "sum",
+                                                              "min", "avg"))
+                expected = {"count": 0, "sum": 0, "min": None, "avg": None}
+                self.assertEqual(expected, r)
+
+    def test_sum_beyond_64_bits(self):
+        self._store.delete_all()
+        self._store.extend([{"n": 2**62}] * 3 + [{"n": -1}])
+        expected = {"count": 4, "sum": 3 * 2**62 - 1, "min": -1, "max": 2**62}
+        for indexed in (False, True):
+            if indexed:
+                self._store.create_index("n")
+            with self.subTest(indexed=indexed):
+                self.assertEqual(expected, self._store.aggregate("n"))
+
+    def test_field_bytes_of_chunked_records(self):
+        filename = os.path.join(self._tempdir.name, "chunks.db")
+        with Jinbase(filename, chunk_size=7, inline_size=0) as jinbase:
+            store = jinbase.depot
+            store.extend([{"note": "x" * i, "amount": i * 1000, "tail": "y" * i}
+                          for i in range(1, 30)])
+            with self.subTest("Values"):
+                r = store.aggregate("amount")
+                expected = {"count": 29, "sum": 435000, "min": 1000, "max": 29000}
+                self.assertEqual(expected, r)
+            with self.subTest("Only the chunks that overlap the field are read"):
+                sql = queries.STREAM_FIELD_CHUNKS.format(model="depot",
+                                                         chunk_size=7,
+                                                         criteria="")
+                with jinbase.dbc.cursor() as cur:
+                    cur.execute(sql, ("amount", ))
+                    rows = cur.fetchall()
+                    cur.execute("SELECT record_id, slice_start, slice_stop "
+                                "FROM jinbase_depot_pointer WHERE field = ?",
+                                ("amount", ))
+                    pointers = cur.fetchall()
+                n_chunks = sum((stop - 1) // 7 - start // 7 + 1
+                               for _, start, stop in pointers)
+                self.assertEqual(n_chunks, len(rows))
+                n_bytes = {record_id: 0 for record_id, _, _ in pointers}
+                for record_id, piece in rows:
+                    n_bytes[record_id] += len(piece)
+                expected = {record_id: stop - start
+                            for record_id, start, stop in pointers}
+                self.assertEqual(expected, n_bytes)
+
+    def test_empty_time_range(self):
+        dt = datetime.fromisoformat(self._store.now()) + timedelta(days=1)
+        r = self._store.aggregate("amount", time_range=(dt, dt))
+        self.assertEqual({"count": 0, "sum": 0, "min": None, "max": None}, r)
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError):
+            self._store.aggregate("amount", ops=("median", ))
+
+
+class TestFollow(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.depot
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _follow_in_thread(self, **kwargs):
+        results = list()
+        def consume():
+            for uid, value in self._store.follow(**kwargs):
+                results.append(value)
+        thread = threading.Thread(target=consume)
+        thread.start()
+        return thread, results
+
+    def test_existing_records(self):
+        uids = self._store.extend(range(10))
+        r = [value for _, value in self._store.follow(uids[4], timeout=0.01)]
+        self.assertEqual(list(range(5, 10)), r)
+        r = list(self._store.follow(0, timeout=0.01, batch_size=3))
+        self.assertEqual(list(zip(uids, range(10))), r)
+
+    def test_local_appends(self):
+        self._store.extend(range(3))
+        thread, results = self._follow_in_thread(timeout=0.5)
+        time.sleep(0.05)
+        self._store.append(3)
+        self._store.extend([4, 5])
+        thread.join()
+        # records appended before the call are skipped
+        self.assertEqual([3, 4, 5], results)
+
+    def test_appends_of_other_connections(self):
+        thread, results = self._follow_in_thread(after_uid=0, timeout=0.5)
+        with Jinbase(self._filename) as jinbase:
+            for i in range(5):
+                jinbase.depot.append(i)
+                time.sleep(0.02)
+        thread.join()
+        self.assertEqual(list(range(5)), results)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        self.assertEqual([], list(self._store.follow(timeout=0.1)))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            next(self._store.follow(batch_size=0))
+
+
 if __name__ == "__main__":
     unittest.main()
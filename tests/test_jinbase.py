@@ -3,7 +3,7 @@ import unittest
 import tempfile
 from datetime import datetime
 from litedbc import LiteDBC
-from jinbase import Jinbase, Model
+from jinbase import Jinbase, Model, queries
 from jinbase.store.kv import Kv
 from jinbase.store.depot import Depot
 from jinbase.store.queue import Queue
@@ -228,5 +228,286 @@ class TestTransactionContext(unittest.TestCase):
             stack_store.push(42)
 
 
+class TestSchemaUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+
+    def tearDown(self):
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_added_columns(self):
+        # database created by a version without the added columns
+        init_script = queries.INIT_SCRIPT
+        for table, column, definition in queries.ADDED_COLUMNS:
+            init_script = init_script.replace("{} {},".format(column, definition),
+                                              "")
+        dbc = LiteDBC(self._filename)
+        with dbc.cursor() as cur:
+            cur.executescript(init_script)
+            cur.execute("PRAGMA table_info(jinbase_kv_record)")
+            columns = {row[1] for row in cur.fetchall()}
+            for _ in range(3):
+                cur.execute("INSERT INTO jinbase_depot_record "
+                            "(datatype, timestamp) VALUES (1, 0)")
+            cur.execute("DELETE FROM jinbase_depot_record WHERE id = 2")
+        dbc.close()
+        self.assertNotIn("expiry", columns)
+        self.assertNotIn("payload", columns)
+        with Jinbase(self._filename) as jinbase:
+            with jinbase.dbc.cursor() as cur:
+                cur.execute("PRAGMA table_info(jinbase_kv_record)")
+                columns = {row[1] for row in cur.fetchall()}
+            self.assertIn("expiry", columns)
+            self.assertIn("payload", columns)
+            jinbase.kv.set("session", "alex", ttl=60)
+            self.assertEqual("alex", jinbase.kv.get("session"))
+            # positions of existing depot records are backfilled
+            self.assertEqual(1, jinbase.depot.uid(0))
+            self.assertEqual(3, jinbase.depot.uid(-1))
+            self.assertEqual(1, jinbase.depot.position(3))
+            uid = jinbase.depot.append("hello")
+            self.assertEqual(2, jinbase.depot.position(uid))
+            # queue items can be leased
+            jinbase.queue.enqueue("job")
+            self.assertEqual("job", jinbase.queue.lease()[0][1])
+
+
+class TestReadonlyOpen(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+
+    def tearDown(self):
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _create_baseline_database(self, drop_tables=True):
+        # database created by the first version of the schema, without
+        # the added columns and the tables introduced since then
+        init_script = queries.INIT_SCRIPT
+        for table, column, definition in queries.ADDED_COLUMNS:
+            init_script = init_script.replace("{} {},".format(column, definition),
+                                              "")
+        dbc = LiteDBC(self._filename)
+        with dbc.cursor() as cur:
+            cur.executescript(init_script)
+            tables = ("jinbase_kv_field_value", "jinbase_kv_indexed_field",
+                      "jinbase_depot_field_value", "jinbase_depot_indexed_field",
+                      "jinbase_kv_bucket", "jinbase_depot_retention")
+            for table in tables if drop_tables else ():
+                cur.execute("DROP TABLE {}".format(table))
+            cur.execute(queries.SET_JINBASE_INFO,
+                        ("0.0.1", datetime.now().isoformat(), 1024, 3))
+        dbc.close()
+
+    def test_baseline_database(self):
+        self._create_baseline_database()
+        with self.subTest("Readonly open fails with a clear error"):
+            with self.assertRaises(Exception) as cm:
+                Jinbase(self._filename, is_readonly=True)
+            self.assertIn("upgrade", str(cm.exception))
+        with self.subTest("Readonly open after a read-write open"):
+            with Jinbase(self._filename) as jinbase:
+                jinbase.kv.set("user", "alex")
+            with Jinbase(self._filename, is_readonly=True) as jinbase:
+                self.assertEqual("alex", jinbase.kv.get("user"))
+
+    def test_missing_columns(self):
+        self._create_baseline_database(drop_tables=False)
+        with self.subTest("Readonly open fails with a clear error"):
+            with self.assertRaises(Exception) as cm:
+                Jinbase(self._filename, is_readonly=True)
+            self.assertIn("jinbase_kv_record.expiry", str(cm.exception))
+        with self.subTest("Readonly open after a read-write open"):
+            with Jinbase(self._filename) as jinbase:
+                jinbase.depot.append("hello")
+            with Jinbase(self._filename, is_readonly=True) as jinbase:
+                self.assertEqual("hello", jinbase.depot[0])
+
+
+class TestInlinePayload(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename, inline_size=64)
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _count_data_rows(self, model):
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM jinbase_{}_data".format(model))
+            return cur.fetchone()[0]
+
+    def test_inline_size_property(self):
+        self.assertEqual(64, self._jinbase.inline_size)
+        self.assertEqual(64, self._jinbase.kv.inline_size)
+        filename = os.path.join(self._tempdir.name, "other.db")
+        with Jinbase(filename, chunk_size=32) as jinbase:
+            self.assertEqual(32, jinbase.kv.inline_size)
+
+    def test_small_and_big_values(self):
+        small = {"id": 42, "name": "alex"}
+        big = {"id": 42, "bio": "x" * 1000}
+        kv_store = self._jinbase.kv
+        depot_store = self._jinbase.depot
+        queue_store = self._jinbase.queue
+        stack_store = self._jinbase.stack
+        kv_store.set("small", small)
+        uid = depot_store.append(small)
+        queue_store.enqueue(small)
+        stack_store.push(small)
+        with self.subTest("Test small values are inline"):
+            for model in ("kv", "depot", "queue", "stack"):
+                self.assertEqual(0, self._count_data_rows(model))
+            self.assertEqual(small, kv_store.get("small"))
+            self.assertEqual(small, depot_store.get(uid))
+            self.assertEqual(small, queue_store.peek_front())
+            self.assertEqual(small, stack_store.peek())
+            self.assertEqual(1, kv_store.count_chunks("small"))
+            self.assertEqual(kv_store.count_bytes("small"),
+                             depot_store.count_bytes(uid))
+            self.assertEqual(small, queue_store.dequeue())
+            self.assertEqual(small, stack_store.pop())
+        with self.subTest("Test rewrite from inline to chunked"):
+            kv_store.set("small", big)
+            self.assertEqual(big, kv_store.get("small"))
+            self.assertLess(0, self._count_data_rows("kv"))
+            self.assertEqual(self._count_data_rows("kv"),
+                             kv_store.count_chunks("small"))
+        with self.subTest("Test rewrite from chunked to inline"):
+            kv_store.set("small", small)
+            self.assertEqual(small, kv_store.get("small"))
+            self.assertEqual(0, self._count_data_rows("kv"))
+        with self.subTest("Test get_many mixes inline and chunked values"):
+            kv_store.set("big", big)
+            self.assertEqual({"small": small, "big": big},
+                             kv_store.get_many(["small", "big"]))
+        with self.subTest("Test load_fields on inline data"):
+            self.assertEqual({"name": "alex"},
+                             kv_store.load_fields("small", ["name"]))
+
+    def test_find_on_inline_data(self):
+        kv_store = self._jinbase.kv
+        kv_store.create_index("name")
+        kv_store.set("user", {"id": 42, "name": "alex"})
+        kv_store.update({"a": {"name": "bob"}, "b": {"name": "alex"}})
+        self.assertEqual(["user", "b"], list(kv_store.find("name", "alex")))
+
+    def test_open_blob_on_inline_data(self):
+        kv_store = self._jinbase.kv
+        kv_store.set("data", b"hello world")
+        with kv_store.open_blob("data") as blob:
+            self.assertEqual(b"hello world", blob.read())
+            blob.seek(6)
+            self.assertEqual(b"wor", blob.read(3))
+            self.assertEqual(b"hello", blob[0:5])
+
+    def test_disabled_inlining(self):
+        with Jinbase(self._filename, inline_size=0) as jinbase:
+            jinbase.kv.set("user", 42)
+            self.assertEqual(42, jinbase.kv.get("user"))
+        self.assertEqual(1, self._count_data_rows("kv"))
+
+
+class TestKvBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _list_tables(self, prefix):
+        return [table for table in self._jinbase.dbc.list_tables()
+                if table.startswith(prefix)]
+
+    def test_isolation(self):
+        bucket_1 = self._jinbase.kv_bucket("tenant1")
+        bucket_2 = self._jinbase.kv_bucket("tenant2")
+        self.assertIsInstance(bucket_1, Kv)
+        self.assertIs(bucket_1, self._jinbase.kv_bucket("tenant1"))
+        self.assertEqual("tenant1", bucket_1.bucket)
+        self.assertIsNone(self._jinbase.kv.bucket)
+        self._jinbase.kv.set("user", "alex")
+        bucket_1.set("user", "bob")
+        bucket_2.update({"user": "carl", 42: "dan"})
+        self.assertEqual("alex", self._jinbase.kv.get("user"))
+        self.assertEqual("bob", bucket_1.get("user"))
+        self.assertEqual(["user"], list(bucket_1.keys()))
+        self.assertEqual([42, "user"], list(bucket_2.keys()))
+        self.assertEqual(1, self._jinbase.kv.count_records())
+
+    def test_features(self):
+        bucket = self._jinbase.kv_bucket("tenant")
+        bucket.create_index("age")
+        bucket.set("user", {"name": "alex", "age": 42, "bio": "x" * 1000})
+        bucket.patch("user", {"name": "bob"})
+        self.assertEqual(["user"], list(bucket.find("age", 42)))
+        self.assertEqual("bob", bucket.load_field("user", "name"))
+        with bucket.open_blob("user") as blob:
+            self.assertEqual(bucket.count_bytes("user"), len(blob.read()))
+        self.assertEqual(2, bucket.incr("hits", 2))
+        bucket.set("session", 1, ttl=60)
+        self.assertEqual(0, bucket.purge_expired())
+        self.assertEqual(3, bucket.count_records())
+
+    def test_registry(self):
+        self.assertEqual((), self._jinbase.kv_buckets())
+        self._jinbase.kv_bucket("b")
+        self._jinbase.kv_bucket("a")
+        self.assertEqual(("a", "b"), self._jinbase.kv_buckets())
+        self.assertTrue(self._jinbase.has_kv_bucket("a"))
+        self.assertFalse(self._jinbase.has_kv_bucket("c"))
+        with Jinbase(self._filename) as jinbase:
+            self.assertEqual(("a", "b"), jinbase.kv_buckets())
+            jinbase.kv_bucket("a").set("user", "alex")
+        self.assertEqual("alex", self._jinbase.kv_bucket("a").get("user"))
+
+    def test_drop_kv_bucket(self):
+        bucket = self._jinbase.kv_bucket("tenant")
+        bucket.update({i: {"value": i} for i in range(100)})
+        self.assertEqual(5, len(self._list_tables("jinbase_kvb_tenant_")))
+        self.assertTrue(self._jinbase.drop_kv_bucket("tenant"))
+        self.assertEqual([], self._list_tables("jinbase_kvb_tenant_"))
+        self.assertEqual((), self._jinbase.kv_buckets())
+        self.assertFalse(self._jinbase.drop_kv_bucket("tenant"))
+        with self.subTest("Test the bucket is recreated empty"):
+            bucket = self._jinbase.kv_bucket("tenant")
+            self.assertEqual(0, bucket.count_records())
+
+    def test_invalid_names(self):
+        for name in ("", "tenant-42", "a b", "x" * 65, 42):
+            with self.subTest(name=name):
+                with self.assertRaises(Exception):
+                    self._jinbase.kv_bucket(name)
+        self.assertEqual((), self._jinbase.kv_buckets())
+
+    def test_transaction(self):
+        with self.assertRaises(Exception):
+            with self._jinbase.write_transaction():
+                self._jinbase.kv_bucket("tenant")
+        self.assertEqual((), self._jinbase.kv_buckets())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,12 +1,17 @@
 import os
 import os.path
+import sqlite3
+import threading
 import unittest
 import tempfile
 import time
 import paradict
-from datetime import datetime
+from unittest import mock
+from datetime import datetime, timedelta
 from paradict import Datatype
-from jinbase import Jinbase, RecordInfo, const
+from jinbase import Jinbase, RecordInfo, const, queries
+from jinbase.store import kv
+from jinbase.blob import Blob
 
 
 USER_CARD = {"id": 42, "name": "alex", "pi": 3.14,
@@ -104,6 +109,24 @@ class TestKvStore(unittest.TestCase):
             r = self._store.get("unregistered-user", default=EMPTY_USER_CARD)
             self.assertEqual(EMPTY_USER_CARD, r)
 
+    def test_get_many_method(self):
+        self._store.set("user", USER_CARD)
+        self._store.set(1, "hello world")
+        self._store.set("empty", b'')
+        with self.subTest("Retrieve registered and unregistered keys"):
+            r = self._store.get_many(("user", 1, "2", "empty", "unregistered-user"))
+            expected = {"user": USER_CARD, 1: "hello world", 2: None,
+                        "empty": b'', "unregistered-user": None}
+            self.assertEqual(expected, r)
+            self.assertEqual(tuple(expected.keys()), tuple(r.keys()))
+        with self.subTest("Retrieve with default value on"):
+            r = self._store.get_many(("user", "unregistered-user"),
+                                     default=EMPTY_USER_CARD)
+            expected = {"user": USER_CARD, "unregistered-user": EMPTY_USER_CARD}
+            self.assertEqual(expected, r)
+        with self.subTest("Retrieve no keys"):
+            self.assertEqual(dict(), self._store.get_many(()))
+
     def test_set_method(self):
         # set data
         with self.subTest("Set complex data"):
@@ -135,6 +158,22 @@ class TestKvStore(unittest.TestCase):
             r = self._store.get("user")
             self.assertIsNotNone(r)
 
+    def test_set_method_on_existing_key(self):
+        uid = self._store.set("user", USER_CARD)
+        with self.subTest("The uid is preserved"):
+            r = self._store.set("user", {"name": "alex"})
+            self.assertEqual(uid, r)
+            self.assertEqual({"name": "alex"}, self._store.get("user"))
+        with self.subTest("Pointers are updated"):
+            self.assertEqual(("name", ), tuple(self._store.fields()))
+            self.assertEqual("alex", self._store.load_field("user", "name"))
+        with self.subTest("Datatype is updated"):
+            r = self._store.set("user", b'avatar.png')
+            self.assertEqual(uid, r)
+            self.assertEqual(Datatype.BIN, self._store.info("user").datatype)
+            self.assertEqual(tuple(), tuple(self._store.fields()))
+            self.assertEqual(b'avatar.png', self._store.get("user"))
+
     def test_replace_method(self):
         # replace data that doesnt exist
         with self.subTest("Set complex data"):
@@ -168,6 +207,18 @@ class TestKvStore(unittest.TestCase):
         expected_keys = ("user", "user1", "user2")
         self.assertEqual(expected_keys, tuple(self._store.keys()))
 
+    def test_update_method_with_existing_and_new_keys(self):
+        rowid = self._store.set("user", USER_CARD)
+        dict_data = {"user": "alex", "1": 10, 2: None,
+                     "user1": USER_CARD, "user2": b''}
+        rowids = self._store.update(dict_data)
+        expected = {"user": rowid, "1": 2, 2: None, "user1": 3, "user2": 4}
+        self.assertEqual(expected, rowids)
+        expected = {"user": "alex", 1: 10, 2: None,
+                    "user1": USER_CARD, "user2": b''}
+        self.assertEqual(expected, self._store.get_many(expected.keys()))
+        self.assertEqual("alex", self._store.load_field("user1", "name"))
+
     def test_get_rowid(self):
         rowid1 = self._store.set("k1", "hello world")
         rowid2 = self._store.set("k2", "hello world")
@@ -349,6 +400,39 @@ class TestKeysMethod(unittest.TestCase):
             expected = tuple(reversed(expected))
             self.assertEqual(expected, tuple(r))
 
+    def test_str_key_with_prefix(self):
+        self._store.set("admin", EMPTY_USER_CARD)
+        self._store.set("admio", EMPTY_USER_CARD)
+        with self.subTest("Ascending"):
+            r = self._store.str_keys(prefix="admin")
+            expected = ("admin", "admin1", "admin2", "admin3")
+            self.assertEqual(expected, tuple(r))
+        with self.subTest("Descending"):
+            r = self._store.str_keys(prefix="admin", asc=False, limit=2)
+            self.assertEqual(("admin3", "admin2"), tuple(r))
+        with self.subTest("With after"):
+            r = self._store.str_keys(prefix="admin", after="admin1")
+            self.assertEqual(("admin2", "admin3"), tuple(r))
+        with self.subTest("With glob"):
+            r = self._store.str_keys("*2", prefix="admin")
+            self.assertEqual(("admin2", ), tuple(r))
+        with self.subTest("With timespan"):
+            timespan = (self._dt1, self._dt2)
+            r = self._store.str_keys(prefix="user", time_range=timespan)
+            self.assertEqual(("user1", ), tuple(r))
+
+    def test_str_key_with_prefix_uses_index(self):
+        criteria, params = kv._get_str_key_criteria(None, None, True, "user")
+        sql = queries.SELECT_STR_KEYS.format(model="kv", sort_order="ASC",
+                                             criteria=criteria,
+                                             limit="LIMIT 10")
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(row[-1] for row in cur.fetchall())
+        self.assertIn("INDEX sqlite_autoindex_jinbase_kv_record", plan)
+        self.assertIn("str_key>? AND str_key<?", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
     def test_str_key_with_limit(self):
         expected = ("admin1", "admin2")
         with self.subTest("Ascending"):
@@ -390,6 +474,56 @@ class TestKeysMethod(unittest.TestCase):
             expected = tuple(reversed(expected))
             self.assertEqual(expected, tuple(r))
 
+    def test_int_key_with_one_bound(self):
+        with self.subTest("First"):
+            r = self._store.int_keys(first=4)
+            self.assertEqual((4, 5), tuple(r))
+        with self.subTest("Last"):
+            r = self._store.int_keys(last=2)
+            self.assertEqual((1, 2), tuple(r))
+
+    def test_keys_with_after(self):
+        with self.subTest("Ascending"):
+            r = self._store.keys(after=4, limit=3)
+            self.assertEqual((5, "admin1", "admin2"), tuple(r))
+            r = self._store.keys(after="admin2", limit=3)
+            self.assertEqual(("admin3", "user1", "user2"), tuple(r))
+            r = self._store.keys(after="user3")
+            self.assertEqual(tuple(), tuple(r))
+        with self.subTest("Descending"):
+            r = self._store.keys(after="admin2", limit=3, asc=False)
+            self.assertEqual(("admin1", 5, 4), tuple(r))
+            r = self._store.keys(after="4", asc=False)
+            self.assertEqual((3, 2, 1), tuple(r))
+        with self.subTest("Resume a paginated listing"):
+            keys, after = list(), None
+            while True:
+                page = tuple(self._store.keys(after=after, limit=4))
+                if not page:
+                    break
+                keys.extend(page)
+                after = page[-1]
+            self.assertEqual(tuple(self._store.keys()), tuple(keys))
+
+    def test_int_and_str_keys_with_after(self):
+        with self.subTest("Int keys"):
+            r = self._store.int_keys(after=2, limit=2)
+            self.assertEqual((3, 4), tuple(r))
+            r = self._store.int_keys(after=2, asc=False)
+            self.assertEqual((1, ), tuple(r))
+            r = self._store.int_keys(2, 4, after=2)
+            self.assertEqual((3, 4), tuple(r))
+        with self.subTest("Str keys"):
+            r = self._store.str_keys(after="admin3", limit=2)
+            self.assertEqual(("user1", "user2"), tuple(r))
+            r = self._store.str_keys("user*", after="user2", asc=False)
+            self.assertEqual(("user1", ), tuple(r))
+        with self.subTest("Wrong key type"):
+            with self.assertRaises(Exception):
+                tuple(self._store.int_keys(after="user1"))
+            with self.assertRaises(Exception):
+                tuple(self._store.str_keys(after=1))
+
     def test_int_key_with_limit(self):
         expected = (1, 2)
         with self.subTest("Ascending"):
@@ -528,6 +662,41 @@ class TestSmallestChunkSize(unittest.TestCase):
             r = self._store.get("user")
             self.assertIsNotNone(r)
 
+    def test_set_on_existing_key(self):
+        size_user_card = len(paradict.pack(USER_CARD))  # n bytes
+        uid = self._store.set("user", USER_CARD)
+        with self.subTest("Shrink the value"):
+            self.assertEqual(uid, self._store.set("user", b'ABC'))
+            self.assertEqual(b'ABC', self._store.get("user"))
+            self.assertEqual(3, self._store.count_chunks())
+        with self.subTest("Same chunk count"):
+            self.assertEqual(uid, self._store.set("user", b'XBZ'))
+            self.assertEqual(b'XBZ', self._store.get("user"))
+            self.assertEqual(3, self._store.count_chunks())
+        with self.subTest("Grow the value"):
+            self.assertEqual(uid, self._store.set("user", USER_CARD))
+            self.assertEqual(USER_CARD, self._store.get("user"))
+            self.assertEqual(size_user_card, self._store.count_chunks())
+
+    def test_iterate(self):
+        self._store.update({"user1": USER_CARD, "user2": b'', 3: b'ABC'})
+        with self.subTest("Ascending"):
+            r = tuple(self._store.iterate())
+            expected = ((3, b'ABC'), ("user1", USER_CARD), ("user2", b''))
+            self.assertEqual(expected, r)
+        with self.subTest("Descending"):
+            r = tuple(self._store.iterate(asc=False, limit=2))
+            expected = (("user2", b''), ("user1", USER_CARD))
+            self.assertEqual(expected, r)
+
+    def test_get_many(self):
+        self._store.set("user1", USER_CARD)
+        self._store.set("user2", b'ABCDEF')
+        self._store.set(3, "alex")
+        r = self._store.get_many(("user1", "user2", 3))
+        expected = {"user1": USER_CARD, "user2": b'ABCDEF', 3: "alex"}
+        self.assertEqual(expected, r)
+
     def test_count_chunks(self):
         self._store.set("user1", USER_CARD)
         self._store.set("user2", USER_CARD)
@@ -615,6 +784,75 @@ class TestLargeBinaryData(unittest.TestCase):
         self.assertEqual(data, self._store.get("user"))
 
 
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename, kv_cache_size=2**20)
+        self._store = self._jinbase.kv
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_hits_and_misses(self):
+        self._store.set("user", USER_CARD)
+        self.assertEqual(USER_CARD, self._store.get("user"))
+        self.assertEqual(USER_CARD, self._store.get("user"))
+        self.assertEqual({"user": USER_CARD, "user2": None},
+                         self._store.get_many(("user", "user2")))
+        info = self._store.cache_info()
+        self.assertEqual(2, info.hits)
+        self.assertEqual(2, info.misses)
+        self.assertEqual(1, info.n_items)
+        self.assertEqual(len(paradict.pack(USER_CARD)), info.n_bytes)
+
+    def test_local_writes(self):
+        self._store.set("user", USER_CARD)
+        self._store.get("user")
+        with self.subTest("Set"):
+            self._store.set("user", EMPTY_USER_CARD)
+            self.assertEqual(EMPTY_USER_CARD, self._store.get("user"))
+        with self.subTest("Update"):
+            self._store.update({"user": "alex"})
+            self.assertEqual("alex", self._store.get("user"))
+        with self.subTest("Delete"):
+            self._store.delete("user")
+            self.assertIsNone(self._store.get("user"))
+        with self.subTest("Delete all"):
+            self._store.set("user", USER_CARD)
+            self._store.get("user")
+            self._store.delete_all()
+            self.assertIsNone(self._store.get("user"))
+
+    def test_rollback(self):
+        self._store.set("user", USER_CARD)
+        try:
+            with self._store.write_transaction():
+                self._store.set("user", "alex")
+                self.assertEqual("alex", self._store.get("user"))
+                raise Exception
+        except Exception as e:
+            pass
+        self.assertEqual(USER_CARD, self._store.get("user"))
+
+    def test_foreign_commits(self):
+        self._store.set("user", USER_CARD)
+        self._store.get("user")
+        with self._jinbase.copy() as jinbase:
+            jinbase.kv.set("user", "alex")
+        self.assertEqual("alex", self._store.get("user"))
+
+    def test_disabled_cache(self):
+        with Jinbase(self._filename) as jinbase:
+            self.assertEqual(0, jinbase.kv.cache_size)
+            self.assertIsNone(jinbase.kv.cache_info())
+
+
 class TestBlobAccess(unittest.TestCase):
 
     def setUp(self):
@@ -811,5 +1049,583 @@ class TestFields(unittest.TestCase):
             self.assertEqual(expected, r)
 
 
+    def test_load_fields_method(self):
+        with self.subTest():
+            self._store.set("user", USER_CARD)
+            fields = ("permission", "nonexistent-field", "birthday")
+            r = self._store.load_fields("user", fields)
+            expected = {"permission": USER_CARD["permission"],
+                        "nonexistent-field": None,
+                        "birthday": USER_CARD["birthday"]}
+            self.assertEqual(expected, r)
+            self.assertEqual(fields, tuple(r.keys()))
+        with self.subTest():
+            r = self._store.load_fields("user", ("nonexistent-field", ),
+                                        default=-1)
+            self.assertEqual({"nonexistent-field": -1}, r)
+        with self.subTest():
+            r = self._store.load_fields("user", tuple())
+            self.assertEqual(dict(), r)
+
+    def test_load_fields_method_with_smallest_chunk_size(self):
+        self._jinbase.close()
+        self._jinbase = Jinbase(self._filename, chunk_size=1)
+        self._store = self._jinbase.kv
+        self._store.set("user", USER_CARD)
+        fields = tuple(USER_CARD.keys())
+        r = self._store.load_fields("user", fields)
+        expected = {field: USER_CARD[field] for field in fields}
+        self.assertEqual(expected, r)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.kv
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_create_index_method(self):
+        self._store.set("user1", {"name": "alex", "age": 30})
+        self._store.set("user2", {"name": "bob", "age": [30]})
+        self._store.set("user3", ["alex", 30])
+        with self.subTest():
+            self.assertTrue(self._store.create_index("age"))
+            self.assertFalse(self._store.create_index("age"))
+            self.assertEqual(("age", ), self._store.indexes())
+        with self.subTest():
+            r = tuple(self._store.find("age", 30))
+            self.assertEqual(("user1", ), r)
+        with self.subTest():
+            self.assertTrue(self._store.drop_index("age"))
+            self.assertFalse(self._store.drop_index("age"))
+            self.assertEqual(tuple(), self._store.indexes())
+        with self.subTest():
+            with self.assertRaises(Exception):
+                tuple(self._store.find("age", 30))
+
+    def test_find_method(self):
+        self._store.create_index("age")
+        self._store.update({"user{}".format(i): {"age": i % 5}
+                            for i in range(10)})
+        self._store.set(42, {"age": 3})
+        with self.subTest("equality"):
+            r = tuple(self._store.find("age", 3))
+            self.assertEqual(("user3", "user8", 42), r)
+        with self.subTest("range"):
+            r = tuple(self._store.find("age", first=3))
+            expected = ("user3", "user8", 42, "user4", "user9")
+            self.assertEqual(expected, r)
+            r = tuple(self._store.find("age", first=1, last=2))
+            expected = ("user1", "user6", "user2", "user7")
+            self.assertEqual(expected, r)
+        with self.subTest("limit and sort order"):
+            r = tuple(self._store.find("age", first=3, limit=2, asc=False))
+            self.assertEqual(("user9", "user4"), r)
+
+    def test_index_maintenance(self):
+        self._store.create_index("status")
+        self._store.set("job", {"status": "pending"})
+        with self.subTest():
+            self._store.set("job", {"status": "done"})
+            self.assertEqual(tuple(), tuple(self._store.find("status", "pending")))
+            self.assertEqual(("job", ), tuple(self._store.find("status", "done")))
+        with self.subTest():
+            self._store.set("job", "done")
+            self.assertEqual(tuple(), tuple(self._store.find("status", "done")))
+        with self.subTest():
+            self._store.set("job", {"status": "done"})
+            self._store.delete("job")
+            self.assertEqual(tuple(), tuple(self._store.find("status", "done")))
+
+    def test_backfill_with_smallest_chunk_size(self):
+        self._jinbase.close()
+        self._jinbase = Jinbase(self._filename, chunk_size=1)
+        self._store = self._jinbase.kv
+        self._store.set("user1", {"name": "alex"})
+        self._store.set("user2", {"name": "bob"})
+        self._store.create_index("name")
+        r = tuple(self._store.find("name", "bob"))
+        self.assertEqual(("user2", ), r)
+
+    def test_find_uses_the_index(self):
+        self._store.create_index("age")
+        sql = queries.FIND_KV_KEYS.format(model="kv",
+                                          criteria="AND value = ?",
+                                          sort_order="ASC", limit="")
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, ("age", 42))
+            plan = " ".join(str(row[-1]) for row in cur.fetchall())
+        self.assertIn("INDEX idx_jinbase_kv_field_value_value", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class TestTtl(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.kv
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _expire(self):
+        time.sleep(0.05)
+
+    def test_expired_keys_are_missing(self):
+        self._store.set("session", {"user": "alex"}, ttl=0.01)
+        self._store.set("user", "alex", ttl=timedelta(hours=1))
+        self._store.set(42, "alex")
+        with self.subTest():
+            self.assertTrue(self._store.exists("session"))
+            self.assertEqual(3, self._store.count_records())
+        self._expire()
+        with self.subTest():
+            self.assertFalse(self._store.exists("session"))
+            self.assertIsNone(self._store.get("session"))
+            self.assertIsNone(self._store.info("session"))
+            self.assertIsNone(self._store.load_field("session", "user"))
+            self.assertEqual({"session": None, "user": "alex"},
+                             self._store.get_many(("session", "user")))
+        with self.subTest():
+            self.assertEqual((42, "user"), tuple(self._store.keys()))
+            self.assertEqual(((42, "alex"), ("user", "alex")),
+                             tuple(self._store.iterate()))
+            self.assertEqual(2, self._store.count_records())
+
+    def test_set_and_delete_expired_key(self):
+        uid = self._store.set("session", "a", ttl=0.01)
+        self._expire()
+        with self.subTest():
+            self.assertEqual(uid, self._store.set("session", "b"))
+            self._expire()
+            self.assertEqual("b", self._store.get("session"))
+        with self.subTest():
+            self._store.set("session", "c", ttl=0.01)
+            self._expire()
+            self.assertFalse(self._store.delete("session"))
+            self.assertEqual(0, self._store.count_records())
+        with self.subTest():
+            self._store.set("session", "c", ttl=0.01)
+            self._expire()
+            r = self._store.update({"session": "d"})
+            self.assertEqual("d", self._store.get("session"))
+
+    def test_non_positive_ttl(self):
+        with self.assertRaises(Exception):
+            self._store.set("session", "a", ttl=0)
+
+    def test_purge_expired_method(self):
+        for i in range(25):
+            self._store.set(i, i, ttl=0.01)
+        self._store.set("user", "alex")
+        self._expire()
+        n = self._store.purge_expired(batch_size=10)
+        self.assertEqual(25, n)
+        self.assertEqual(1, self._store.count_chunks())
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM jinbase_kv_record")
+            self.assertEqual(1, cur.fetchone()[0])
+
+    def test_reaper(self):
+        self._store.set("session", "a", ttl=0.01)
+        with self.subTest():
+            self.assertTrue(self._store.start_reaper(interval=0.01))
+            self.assertFalse(self._store.start_reaper(interval=0.01))
+        time.sleep(0.2)
+        with self.subTest():
+            self.assertTrue(self._store.stop_reaper())
+            self.assertFalse(self._store.stop_reaper())
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM jinbase_kv_record")
+            self.assertEqual(0, cur.fetchone()[0])
+
+    def test_reaper_records_failures(self):
+        error = sqlite3.OperationalError("database is locked")
+        purge_batch = self._store._purge_batch
+        is_locked = threading.Event()
+        is_locked.set()
+
+        def flaky_purge_batch(batch_size):
+            if is_locked.is_set():
+                raise error
+            return purge_batch(batch_size)
+
+        self._store.set("session", "a", ttl=0.01)
+        with mock.patch.object(self._store, "_purge_batch",
+                               side_effect=flaky_purge_batch):
+            self._store.start_reaper(interval=0.01)
+            with self.subTest("Failure is recorded"):
+                time.sleep(0.1)
+                self.assertIs(error, self._store.reaper_error)
+            with self.subTest("Next sweep retries and clears the error"):
+                is_locked.clear()
+                time.sleep(0.1)
+                self.assertIsNone(self._store.reaper_error)
+            self._store.stop_reaper()
+        self.assertIsNone(self._store.get("session"))
+
+    def test_purge_uses_the_expiry_index(self):
+        sql = queries.PURGE_EXPIRED_KV_RECORDS.format(model="kv")
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, (0, 10))
+            plan = " ".join(str(row[-1]) for row in cur.fetchall())
+        self.assertIn("INDEX idx_jinbase_kv_record_expiry", plan)
+
+
+class TestCounters(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.kv
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_incr_and_decr_methods(self):
+        with self.subTest():
+            self.assertEqual(1, self._store.incr("hits"))
+            self.assertEqual(11, self._store.incr("hits", 10))
+            self.assertEqual(9, self._store.decr("hits", 2))
+            self.assertEqual(-1, self._store.decr(42))
+        with self.subTest():
+            self.assertEqual(9, self._store.get("hits"))
+            self.assertEqual(Datatype.INT, self._store.info("hits").datatype)
+            self.assertEqual({"hits": 9, 42: -1},
+                             self._store.get_many(("hits", 42)))
+            self.assertEqual(((42, -1), ("hits", 9)),
+                             tuple(self._store.iterate()))
+        with self.subTest():
+            # counters aren't serialized
+            self.assertEqual(0, self._store.count_chunks())
+
+    def test_incr_converts_integer_values(self):
+        self._store.set("hits", 41)
+        with self.subTest():
+            self.assertEqual(42, self._store.incr("hits"))
+            self.assertEqual(0, self._store.count_chunks("hits"))
+        with self.subTest():
+            self._store.set("hits", {"n": 1})
+            self.assertEqual({"n": 1}, self._store.get("hits"))
+            with self.assertRaises(TypeError):
+                self._store.incr("hits")
+        with self.subTest():
+            with self.assertRaises(TypeError):
+                self._store.incr("hits", 1.5)
+
+    def test_incr_with_ttl(self):
+        self._store.set("hits", 10, ttl=0.01)
+        time.sleep(0.05)
+        self.assertEqual(1, self._store.incr("hits"))
+        self.assertEqual(1, self._store.get("hits"))
+
+    def test_incr_overflow(self):
+        self._store.incr("hits", 2**63 - 1)
+        with self.assertRaises(OverflowError):
+            self._store.incr("hits")
+        self.assertEqual(2**63 - 1, self._store.get("hits"))
+
+    def test_incr_many_method(self):
+        self._store.incr("a", 5)
+        self._store.set("b", 10)
+        self._store.set("c", "text")
+        with self.subTest():
+            r = self._store.incr_many({"a": 1, "b": 2, 7: 3, "7": 4})
+            self.assertEqual({"a": 6, "b": 12, 7: 7, "7": 7}, r)
+            self.assertEqual({"a": 6, "b": 12, 7: 7},
+                             self._store.get_many(("a", "b", 7)))
+        with self.subTest():
+            with self.assertRaises(TypeError):
+                self._store.incr_many({"a": 1, "c": 1})
+            # the transaction was rolled back
+            self.assertEqual(6, self._store.get("a"))
+        with self.subTest():
+            self._store.incr("d", 2**63 - 1)
+            with self.assertRaises(OverflowError):
+                self._store.incr_many({"a": 1, "d": 1})
+            self.assertEqual(6, self._store.get("a"))
+
+    def test_incr_discards_cached_value(self):
+        self._jinbase.close()
+        self._jinbase = Jinbase(self._filename, kv_cache_size=2**20)
+        self._store = self._jinbase.kv
+        self._store.set("hits", 1)
+        self.assertEqual(1, self._store.get("hits"))
+        self._store.incr("hits")
+        self.assertEqual(2, self._store.get("hits"))
+
+    def test_incr_discards_value_cached_during_the_write(self):
+        self._jinbase.close()
+        self._jinbase = Jinbase(self._filename, kv_cache_size=2**20)
+        self._store = self._jinbase.kv
+        self._store.set("hits", 1)
+        incr = self._store._incr
+
+        def read_then_incr(key, delta):
+            # a concurrent read right before the write caches the old value
+            self.assertEqual(1, self._store.get(key))
+            return incr(key, delta)
+
+        with mock.patch.object(self._store, "_incr", side_effect=read_then_incr):
+            self.assertEqual(2, self._store.incr("hits"))
+        self.assertEqual(2, self._store.get("hits"))
+
+
+class TestVersions(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.kv
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_version_increments(self):
+        with self.subTest("Test nonexistent key"):
+            self.assertEqual((None, None), self._store.get_with_version("user"))
+            self.assertIsNone(self._store.info("user"))
+        with self.subTest("Test set"):
+            self._store.set("user", "alex")
+            self.assertEqual(("alex", 1), self._store.get_with_version("user"))
+            self._store.set("user", "bob")
+            self.assertEqual(("bob", 2), self._store.get_with_version("user"))
+            self.assertEqual(2, self._store.info("user").version)
+        with self.subTest("Test update"):
+            self._store.update({"user": "carl", "other": "dan"})
+            self.assertEqual(3, self._store.info("user").version)
+            self.assertEqual(1, self._store.info("other").version)
+        with self.subTest("Test counters"):
+            self._store.incr("hits")
+            self._store.incr("hits")
+            self.assertEqual((2, 2), self._store.get_with_version("hits"))
+
+    def test_compare_and_set_method(self):
+        with self.subTest("Test create only if nonexistent"):
+            self.assertEqual(1, self._store.compare_and_set("user", None, "alex"))
+            self.assertIsNone(self._store.compare_and_set("user", None, "bob"))
+            self.assertEqual("alex", self._store.get("user"))
+        with self.subTest("Test matching version"):
+            value, version = self._store.get_with_version("user")
+            self.assertEqual(2, self._store.compare_and_set("user", version,
+                                                            value + "!"))
+            self.assertEqual("alex!", self._store.get("user"))
+        with self.subTest("Test stale version"):
+            self.assertIsNone(self._store.compare_and_set("user", 1, "bob"))
+            self.assertEqual(("alex!", 2), self._store.get_with_version("user"))
+        with self.subTest("Test big value"):
+            data = {"bio": "x" * 5000}
+            self.assertEqual(3, self._store.compare_and_set("user", 2, data))
+            self.assertEqual(data, self._store.get("user"))
+
+    def test_compare_and_set_on_expired_key(self):
+        self._store.set("session", "alex", ttl=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self._store.compare_and_set("session", 1, "bob"))
+        self.assertEqual(2, self._store.compare_and_set("session", None, "bob"))
+        self.assertEqual("bob", self._store.get("session"))
+
+    def test_read_modify_write_loop(self):
+        self._store.set("total", 0)
+        n_retries = 0
+        for _ in range(5):
+            while True:
+                value, version = self._store.get_with_version("total")
+                # a concurrent writer sneaks in once
+                if n_retries == 0:
+                    self._store.set("total", value + 100)
+                if self._store.compare_and_set("total", version, value + 1):
+                    break
+                n_retries += 1
+        self.assertEqual(1, n_retries)
+        self.assertEqual(105, self._store.get("total"))
+
+
+class TestPatch(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename, chunk_size=16, inline_size=0)
+        self._store = self._jinbase.kv
+        self._user = {"name": "alex", "status": "new", "bio": "x" * 100,
+                      "age": 42, 1: "int field"}
+        self._store.set("user", self._user)
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _get_chunks(self):
+        with self._jinbase.dbc.cursor() as cur:
+            cur.execute("SELECT id, chunk FROM jinbase_kv_data ORDER BY id")
+            return cur.fetchall()
+
+    def test_same_size_fields(self):
+        chunks = self._get_chunks()
+        uid = self._store.patch("user", {"status": "old"})
+        self._user["status"] = "old"
+        self.assertEqual(self._store.uid("user"), uid)
+        self.assertEqual(self._user, self._store.get("user"))
+        new_chunks = self._get_chunks()
+        with self.subTest("Test only one chunk is rewritten"):
+            self.assertEqual([x[0] for x in chunks], [x[0] for x in new_chunks])
+            n_changed = sum(1 for a, b in zip(chunks, new_chunks) if a != b)
+            self.assertEqual(1, n_changed)
+
+    def test_resized_fields(self):
+        changes = {"name": "alexander", "bio": "y", "age": 10 ** 12}
+        self._store.patch("user", changes)
+        self._user.update(changes)
+        self.assertEqual(self._user, self._store.get("user"))
+        expected = {"name": "alexander", "status": "new", "age": 10 ** 12}
+        self.assertEqual(expected, self._store.load_fields("user",
+                                                           expected.keys()))
+        self.assertEqual(self._store.count_bytes("user"),
+                         sum(len(chunk) for _, chunk in self._get_chunks()))
+
+    def test_new_and_non_string_fields(self):
+        changes = {"city": "paris", 1: "other"}
+        self._store.patch("user", changes)
+        self._user.update(changes)
+        self.assertEqual(self._user, self._store.get("user"))
+        self.assertEqual("paris", self._store.load_field("user", "city"))
+
+    def test_inline_value(self):
+        with Jinbase(self._filename) as jinbase:
+            jinbase.kv.set("small", {"a": 1, "b": "x"})
+            jinbase.kv.patch("small", {"a": 1000, "b": "y" * 1000})
+            self.assertEqual({"a": 1000, "b": "y" * 1000},
+                             jinbase.kv.get("small"))
+            self.assertEqual("y" * 1000, jinbase.kv.load_field("small", "b"))
+
+    def test_index_and_version(self):
+        self._store.create_index("status")
+        version = self._store.info("user").version
+        self._store.patch("user", {"status": "active"})
+        self.assertEqual(["user"], list(self._store.find("status", "active")))
+        self.assertEqual([], list(self._store.find("status", "new")))
+        self.assertEqual(version + 1, self._store.info("user").version)
+
+    def test_late_field_reads_only_its_chunks(self):
+        record = {"f{:03}".format(i): "x" * 10 for i in range(200)}
+        self._store.set("big", record)
+        n_bytes_read = list()
+        get_chunk = Blob._get_chunk
+
+        def spy(blob, blob_slice):
+            chunk = get_chunk(blob, blob_slice)
+            n_bytes_read.append(len(chunk))
+            return chunk
+        with mock.patch.object(Blob, "_get_chunk", spy):
+            self._store.patch("big", {"f199": "y" * 10})
+        record["f199"] = "y" * 10
+        self.assertEqual(record, self._store.get("big"))
+        # the field spans at most 2 chunks of 16 bytes
+        self.assertLessEqual(sum(n_bytes_read), 32)
+
+    def test_invalid_keys(self):
+        with self.subTest("Test nonexistent key"):
+            self.assertIsNone(self._store.patch("other", {"a": 1}))
+            self.assertFalse(self._store.exists("other"))
+        with self.subTest("Test non-dict value"):
+            self._store.set("number", 42)
+            with self.assertRaises(TypeError):
+                self._store.patch("number", {"a": 1})
+
+
+class TestKeyFilter(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename, kv_filter=True)
+        self._store = self._jinbase.kv
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_properties(self):
+        self.assertTrue(self._jinbase.kv_filter)
+        self.assertTrue(self._store.use_filter)
+        self.assertIsNone(self._store.filter_info())
+        with Jinbase(self._filename) as jinbase:
+            self.assertFalse(jinbase.kv.use_filter)
+
+    def test_misses_skip_the_database(self):
+        self._store.set("user", "alex")
+        self.assertFalse(self._store.exists("other"))
+        self.assertIsNone(self._store.get("other"))
+        self.assertEqual({"other": 0, "user": "alex"},
+                         self._store.get_many(["other", "user"], default=0))
+        info = self._store.filter_info()
+        self.assertEqual(3, info.skips)
+        self.assertEqual(1, info.hits)
+
+    def test_local_writes(self):
+        self.assertFalse(self._store.exists("a"))
+        self._store.set("a", 1)
+        self._store.update({"b": 2, 3: 3})
+        self._store.incr("c")
+        self._store.compare_and_set("d", None, 4)
+        self.assertEqual({"a": 1, "b": 2, 3: 3, "c": 1, "d": 4},
+                         self._store.get_many(["a", "b", 3, "c", "d"]))
+        with self.subTest("Test delete_all"):
+            self._store.delete_all()
+            self.assertFalse(self._store.exists("a"))
+            self._store.set("a", 1)
+            self.assertTrue(self._store.exists("a"))
+
+    def test_foreign_commits(self):
+        self.assertFalse(self._store.exists("user"))
+        with Jinbase(self._filename) as jinbase:
+            jinbase.kv.set("user", "alex")
+        self.assertTrue(self._store.exists("user"))
+        self.assertEqual("alex", self._store.get("user"))
+
+    def test_growth(self):
+        self.assertFalse(self._store.exists("user"))
+        capacity = self._store.filter_info().capacity
+        self._store.update({i: i for i in range(2 * capacity)})
+        for i in range(0, 2 * capacity, 100):
+            self.assertTrue(self._store.exists(i))
+        info = self._store.filter_info()
+        self.assertLess(capacity, info.capacity)
+        self.assertLessEqual(info.n_items, info.capacity)
+        self.assertFalse(self._store.exists(5000))
+
+
 if __name__ == "__main__":
     unittest.main()
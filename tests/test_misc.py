@@ -2,5 +2,22 @@ import unittest
 from jinbase import misc
 
 
+class TestGetPrefixBoundsFunction(unittest.TestCase):
+
+    def test(self):
+        with self.subTest():
+            r = misc.get_prefix_bounds("user:123:")
+            self.assertEqual(("user:123:", "user:123;"), r)
+        with self.subTest():
+            r = misc.get_prefix_bounds("a\U0010FFFF")
+            self.assertEqual(("a\U0010FFFF", "b"), r)
+        with self.subTest():
+            r = misc.get_prefix_bounds("\U0010FFFF")
+            self.assertEqual(("\U0010FFFF", None), r)
+        with self.subTest("Surrogates are skipped"):
+            r = misc.get_prefix_bounds("a\uD7FF")
+            self.assertEqual(("a\uD7FF", "a\uE000"), r)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,10 @@
 import os.path
+import time
 import unittest
 import tempfile
+import threading
 import paradict
-from datetime import datetime
+from datetime import datetime, timedelta
 from paradict import Datatype
 from jinbase import Jinbase, RecordInfo, const
 
@@ -135,6 +137,21 @@ class TestQueueStore(unittest.TestCase):
             self.assertEqual(USER_CARD, self._store.dequeue())
             self.assertEqual(0, self._store.count_records())
 
+    def test_dequeue_many_method(self):
+        with self.subTest("Test empty queue store"):
+            self.assertEqual(tuple(), self._store.dequeue_many(3))
+        self._store.enqueue_many((USER_CARD, EMPTY_USER_CARD, b'', 10, 11))
+        with self.subTest("Test FIFO order"):
+            r = self._store.dequeue_many(3)
+            self.assertEqual((USER_CARD, EMPTY_USER_CARD, b''), r)
+            self.assertEqual(2, self._store.count_records())
+        with self.subTest("Test zero items"):
+            self.assertEqual(tuple(), self._store.dequeue_many(0))
+        with self.subTest("Test more items than available"):
+            self.assertEqual((10, 11), self._store.dequeue_many(10))
+            self.assertEqual(0, self._store.count_records())
+            self.assertEqual(0, self._store.count_chunks())
+
     def test_peek_front_method(self):
         with self.subTest("Test empty queue store"):
             self.assertIsNone(self._store.peek_front())
@@ -204,6 +221,13 @@ class TestSmallestChunkSize(unittest.TestCase):
             self.assertEqual(EMPTY_USER_CARD, r)
             self.assertEqual(0, self._store.count_records())
 
+    def test_dequeue_many_method(self):
+        self._store.enqueue_many((USER_CARD, EMPTY_USER_CARD, USER_CARD))
+        r = self._store.dequeue_many(2)
+        self.assertEqual((USER_CARD, EMPTY_USER_CARD), r)
+        size_user_card = len(paradict.pack(USER_CARD))  # n bytes
+        self.assertEqual(size_user_card, self._store.count_chunks())
+
     def test_count_front_chunks_method(self):
         self._store.enqueue(USER_CARD)
         self._store.enqueue(EMPTY_USER_CARD)
@@ -315,5 +339,194 @@ class TestLargeBinaryData(unittest.TestCase):
         self.assertEqual(data, self._store.dequeue())
 
 
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.queue
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_lease_method(self):
+        uids = self._store.enqueue_many((USER_CARD, b'', 10, 11))
+        with self.subTest("Test FIFO order"):
+            r = self._store.lease(2)
+            self.assertEqual([(uids[0], USER_CARD), (uids[1], b'')],
+                             [(x.uid, x.value) for x in r])
+            self.assertEqual(r[0].receipt, r[1].receipt)
+            self.assertEqual(2, self._store.count_leases())
+        with self.subTest("Test leased items are skipped"):
+            self.assertEqual(uids[2], self._store.front_uid())
+            self.assertEqual(10, self._store.peek_front())
+            self.assertEqual(4, self._store.count_records())
+            (lease, ) = self._store.lease()
+            self.assertEqual((uids[2], 10), (lease.uid, lease.value))
+            self.assertNotEqual(r[0].receipt, lease.receipt)
+            self.assertEqual((11, ), self._store.dequeue_many(5))
+            self.assertIsNone(self._store.dequeue())
+        with self.subTest("Test empty queue store"):
+            self.assertEqual(tuple(), self._store.lease(3))
+
+    def test_ack_method(self):
+        uid, _ = self._store.enqueue_many((10, 11))
+        (lease, ) = self._store.lease()
+        with self.subTest("Test wrong receipt"):
+            self.assertFalse(self._store.ack(uid, lease.receipt + 1))
+            self.assertEqual(1, self._store.count_leases())
+        with self.subTest("Test acknowledged item is deleted"):
+            self.assertTrue(self._store.ack(uid, lease.receipt))
+            self.assertEqual(1, self._store.count_records())
+            self.assertEqual(0, self._store.count_leases())
+        with self.subTest("Test item that isn't leased"):
+            self.assertFalse(self._store.ack(uid, lease.receipt))
+            self.assertFalse(self._store.ack(self._store.front_uid(),
+                                             lease.receipt))
+            self.assertEqual(11, self._store.dequeue())
+
+    def test_nack_method(self):
+        uid, _ = self._store.enqueue_many((10, 11))
+        (lease, ) = self._store.lease()
+        self.assertEqual(11, self._store.peek_front())
+        with self.subTest("Test wrong receipt"):
+            self.assertFalse(self._store.nack(uid, lease.receipt + 1))
+        with self.subTest("Test released item goes back to its place"):
+            self.assertTrue(self._store.nack(uid, lease.receipt))
+            self.assertEqual(0, self._store.count_leases())
+            self.assertEqual(10, self._store.peek_front())
+        with self.subTest("Test item that isn't leased"):
+            self.assertFalse(self._store.nack(uid, lease.receipt))
+
+    def test_expired_leases_are_redelivered(self):
+        self._store.enqueue_many((10, 11, 12))
+        (lease, ) = self._store.lease(visibility_timeout=0.05)
+        uid = lease.uid
+        time.sleep(0.1)
+        r = self._store.lease(2, visibility_timeout=timedelta(seconds=60))
+        self.assertEqual([(uid, 10), (uid + 1, 11)], [(x.uid, x.value) for x in r])
+        self.assertEqual([uid + 2], [x.uid for x in self._store.lease(5)])
+        self.assertEqual(tuple(), self._store.lease(5))
+
+    def test_stale_receipt_after_redelivery(self):
+        self._store.enqueue(10)
+        (stale, ) = self._store.lease(visibility_timeout=0.05)
+        time.sleep(0.1)
+        (lease, ) = self._store.lease()
+        self.assertEqual(stale.uid, lease.uid)
+        with self.subTest("Test stale ack"):
+            self.assertFalse(self._store.ack(stale.uid, stale.receipt))
+            self.assertEqual(1, self._store.count_records())
+        with self.subTest("Test stale nack"):
+            self.assertFalse(self._store.nack(stale.uid, stale.receipt))
+            self.assertEqual(1, self._store.count_leases())
+        with self.subTest("Test current receipt"):
+            self.assertTrue(self._store.ack(lease.uid, lease.receipt))
+            self.assertTrue(self._store.is_empty())
+
+    def test_expired_leases_are_dequeued(self):
+        uids = self._store.enqueue_many((10, 11, 12, 13))
+        (stale, ) = self._store.lease(visibility_timeout=0.05)
+        self._store.lease(visibility_timeout=60)
+        self.assertEqual(uids[2], self._store.front_uid())
+        time.sleep(0.1)
+        with self.subTest("Test peek"):
+            self.assertEqual(uids[0], self._store.front_uid())
+            self.assertEqual(10, self._store.peek_front())
+            self.assertEqual(uids[3], self._store.back_uid())
+        with self.subTest("Test dequeue"):
+            self.assertEqual(10, self._store.dequeue())
+            self.assertFalse(self._store.ack(stale.uid, stale.receipt))
+        with self.subTest("Test dequeue_many"):
+            self._store.lease(visibility_timeout=0.05)
+            time.sleep(0.1)
+            self.assertEqual((12, 13), self._store.dequeue_many(5))
+            self.assertEqual(1, self._store.count_leases())
+
+    def test_blocking_dequeue_wakes_up_on_expiry(self):
+        self._store.enqueue(10)
+        self._store.lease(visibility_timeout=0.1)
+        start = time.monotonic()
+        self.assertEqual(10, self._store.dequeue(block=True, timeout=5))
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertLess(time.monotonic() - start, 1)
+        self._store.enqueue(11)
+        self._store.lease(visibility_timeout=0.1)
+        self.assertEqual((11, ), self._store.dequeue_many(2, block=True,
+                                                           timeout=5))
+
+    def test_invalid_visibility_timeout(self):
+        with self.assertRaises(ValueError):
+            self._store.lease(visibility_timeout=0)
+
+
+class TestBlocking(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.queue
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _dequeue_in_thread(self, **kwargs):
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.append(self._store.dequeue(**kwargs)))
+        thread.start()
+        return thread, results
+
+    def test_timeout(self):
+        start = time.monotonic()
+        self.assertEqual("empty", self._store.dequeue("empty", block=True,
+                                                      timeout=0.1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(tuple(), self._store.dequeue_many(2, block=True,
+                                                           timeout=0.05))
+
+    def test_item_available(self):
+        self._store.enqueue(42)
+        self.assertEqual(42, self._store.dequeue(block=True, timeout=0))
+
+    def test_local_producer(self):
+        thread, results = self._dequeue_in_thread(block=True, timeout=5)
+        time.sleep(0.05)
+        start = time.monotonic()
+        self._store.enqueue(USER_CARD)
+        thread.join()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([USER_CARD], results)
+
+    def test_producer_of_other_connection(self):
+        thread, results = self._dequeue_in_thread(block=True, timeout=5)
+        time.sleep(0.05)
+        with Jinbase(self._filename) as jinbase:
+            jinbase.queue.enqueue(USER_CARD)
+        thread.join()
+        self.assertEqual([USER_CARD], results)
+
+    def test_dequeue_many_method(self):
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.append(self._store.dequeue_many(5, block=True,
+                                                                   timeout=5)))
+        thread.start()
+        time.sleep(0.05)
+        self._store.enqueue_many((1, 2, 3))
+        thread.join()
+        self.assertEqual([(1, 2, 3)], results)
+
+
 if __name__ == "__main__":
     unittest.main()
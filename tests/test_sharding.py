@@ -0,0 +1,264 @@
+import os.path
+import unittest
+import tempfile
+import threading
+from collections import Counter
+from jinbase import Model
+from jinbase.sharding import ShardedJinbase, HashRing
+
+
+N_SHARDS = 3
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_get_shard_method(self):
+        ring = HashRing(N_SHARDS)
+        with self.subTest("Stable routing"):
+            self.assertEqual(ring.get_shard("alex"), HashRing(N_SHARDS).get_shard("alex"))
+        with self.subTest("Numeric strings are integers"):
+            self.assertEqual(ring.get_shard("42"), ring.get_shard(42))
+        with self.subTest("Keys spread over all shards"):
+            counter = Counter(ring.get_shard(i) for i in range(3000))
+            self.assertEqual(N_SHARDS, len(counter))
+            for n in counter.values():
+                self.assertGreater(n, 500)
+        with self.subTest("Single shard"):
+            self.assertEqual(0, HashRing(1).get_shard("alex"))
+
+    def test_consistency(self):
+        ring = HashRing(N_SHARDS)
+        bigger_ring = HashRing(N_SHARDS + 1)
+        keys = ["key-{}".format(i) for i in range(3000)]
+        # only keys moving to the new shard change shard
+        for key in keys:
+            index = bigger_ring.get_shard(key)
+            if index != N_SHARDS:
+                self.assertEqual(ring.get_shard(key), index)
+
+
+class TestShardedJinbase(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filenames = [os.path.join(self._tempdir.name, "shard{}.db".format(i))
+                           for i in range(N_SHARDS)]
+        self._jinbase = ShardedJinbase(self._filenames)
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def test_init(self):
+        with self.subTest("Shards"):
+            self.assertEqual(N_SHARDS, self._jinbase.n_shards)
+            self.assertEqual(tuple(self._filenames), self._jinbase.filenames)
+        with self.subTest("No filename"):
+            with self.assertRaises(Exception):
+                ShardedJinbase([])
+        with self.subTest("Duplicate filenames"):
+            with self.assertRaises(Exception):
+                ShardedJinbase([self._filenames[0], self._filenames[0]])
+
+    def test_kv_routing(self):
+        kv = self._jinbase.kv
+        for i in range(30):
+            kv.set("key-{}".format(i), i)
+        with self.subTest("Each key lives in its shard"):
+            for i in range(30):
+                key = "key-{}".format(i)
+                shard = self._jinbase.shard(key)
+                self.assertEqual(i, shard.kv.get(key))
+                self.assertEqual(i, kv.get(key))
+        with self.subTest("Records are spread"):
+            counts = [shard.kv.count_records() for shard in self._jinbase.shards]
+            self.assertEqual(30, sum(counts))
+            self.assertNotIn(0, counts)
+        with self.subTest("Global uids"):
+            uid = kv.uid("key-7")
+            self.assertEqual("key-7", kv.key(uid))
+            self.assertEqual(uid, kv.info("key-7").uid)
+        with self.subTest("Numeric string keys"):
+            kv.set("42", "hello")
+            self.assertEqual("hello", kv.get(42))
+
+    def test_kv_methods(self):
+        kv = self._jinbase.kv
+        data = {i: str(i) for i in range(20)}
+        data.update({"key-{}".format(i): i for i in range(20)})
+        uids = kv.update(data)
+        with self.subTest("update"):
+            self.assertEqual(list(data.keys()), list(uids.keys()))
+            for key, uid in uids.items():
+                self.assertEqual(key, kv.key(uid))
+        with self.subTest("get_many"):
+            r = kv.get_many(["key-1", 3, "nonexistent"], default=-1)
+            self.assertEqual({"key-1": 1, 3: "3", "nonexistent": -1}, r)
+        with self.subTest("incr_many"):
+            r = kv.incr_many({"a": 1, "b": 2, "c": 3})
+            self.assertEqual({"a": 1, "b": 2, "c": 3}, r)
+            self.assertEqual(11, kv.incr("a", 10))
+        with self.subTest("compare_and_set"):
+            kv.set("card", {"name": "alex"})
+            _, version = kv.get_with_version("card")
+            self.assertIsNotNone(kv.compare_and_set("card", version, {"name": "rustic"}))
+            self.assertIsNone(kv.compare_and_set("card", version, {"name": "alex"}))
+            kv.patch("card", {"name": "paul"})
+            self.assertEqual("paul", kv.load_field("card", "name"))
+        with self.subTest("delete_many"):
+            r = kv.delete_many(["a", "b", "nonexistent"])
+            self.assertEqual(("a", "b"), r)
+        with self.subTest("count_records"):
+            self.assertEqual(len(data) + 2, kv.count_records())
+
+    def test_kv_keys_are_merged(self):
+        kv = self._jinbase.kv
+        keys = [5, 1, 10, "b", "a", "c", "aa"]
+        for key in keys:
+            kv.set(key, True)
+        expected = [1, 5, 10, "a", "aa", "b", "c"]
+        with self.subTest("Ascending order"):
+            self.assertEqual(expected, list(kv.keys()))
+        with self.subTest("Descending order"):
+            self.assertEqual(expected[::-1], list(kv.keys(asc=False)))
+        with self.subTest("Limit"):
+            self.assertEqual(expected[:4], list(kv.keys(limit=4)))
+        with self.subTest("Pagination"):
+            self.assertEqual(["aa", "b"], list(kv.keys(after="a", limit=2)))
+        with self.subTest("int_keys and str_keys"):
+            self.assertEqual([1, 5, 10], list(kv.int_keys()))
+            self.assertEqual(["a", "aa"], list(kv.str_keys(prefix="a")))
+        with self.subTest("iterate"):
+            self.assertEqual(expected, [key for key, _ in kv.iterate()])
+
+    def test_depot(self):
+        depot = self._jinbase.depot
+        uids = [depot.append(i) for i in range(10)]
+        with self.subTest("Round-robin"):
+            counts = [shard.depot.count_records() for shard in self._jinbase.shards]
+            self.assertEqual([4, 3, 3], counts)
+        with self.subTest("Global uids preserve the insertion order"):
+            self.assertEqual(sorted(uids), uids)
+            self.assertEqual(uids, list(depot.uids()))
+            self.assertEqual(list(range(10)), [v for _, v in depot.iterate()])
+            self.assertEqual(list(range(9, 4, -1)),
+                             [v for _, v in depot.iterate(asc=False, limit=5)])
+        with self.subTest("get"):
+            for i, uid in enumerate(uids):
+                self.assertEqual(i, depot.get(uid))
+            self.assertEqual(0, depot.get_first())
+            self.assertEqual(9, depot.get_last())
+        with self.subTest("extend"):
+            new_uids = depot.extend(["a", "b", "c", "d"])
+            self.assertEqual(["a", "b", "c", "d"], [depot.get(uid) for uid in new_uids])
+        with self.subTest("Partition key"):
+            uid = depot.append("hello", partition_key="user-1")
+            index = self._jinbase.shard_index("user-1")
+            self.assertEqual(index, uid % N_SHARDS)
+        with self.subTest("delete_many"):
+            self.assertEqual(tuple(uids[:3]), depot.delete_many(uids[:3]))
+            self.assertFalse(depot.exists(uids[0]))
+            self.assertEqual(12, depot.count_records())
+
+    def test_queue(self):
+        queue = self._jinbase.queue
+        queue.enqueue_many(range(5))
+        for i in range(5, 10):
+            queue.enqueue(i)
+        with self.subTest("Spread over shards"):
+            for shard in self._jinbase.shards:
+                self.assertFalse(shard.queue.is_empty())
+        with self.subTest("peek"):
+            self.assertEqual(0, queue.peek_front())
+            self.assertEqual(9, queue.peek_back())
+            self.assertEqual(queue.front_uid(), queue.info_front().uid)
+        with self.subTest("FIFO"):
+            self.assertEqual(list(range(10)), [queue.dequeue() for _ in range(10)])
+            self.assertEqual("empty", queue.dequeue(default="empty"))
+            self.assertTrue(queue.is_empty())
+
+    def test_queue_order_across_sessions(self):
+        self._jinbase.queue.enqueue_many(range(4))
+        self._jinbase.queue.enqueue(4, partition_key="user-1")
+        self._jinbase.close()
+        self._jinbase = ShardedJinbase(self._filenames)
+        queue = self._jinbase.queue
+        queue.enqueue(5)
+        queue.enqueue_many([6, 7], partition_key="user-2")
+        queue.enqueue_many(range(8, 12))
+        self._jinbase.close()
+        self._jinbase = ShardedJinbase(self._filenames)
+        queue = self._jinbase.queue
+        queue.enqueue(12)
+        self.assertEqual(list(range(13)), [queue.dequeue() for _ in range(13)])
+        self.assertTrue(queue.is_empty())
+
+    def test_stack_order_across_sessions(self):
+        self._jinbase.stack.push_many(range(4))
+        self._jinbase.close()
+        self._jinbase = ShardedJinbase(self._filenames)
+        stack = self._jinbase.stack
+        stack.push(4, partition_key="user-1")
+        stack.push_many(range(5, 8))
+        self.assertEqual(list(range(7, -1, -1)), [stack.pop() for _ in range(8)])
+
+    def test_stack(self):
+        stack = self._jinbase.stack
+        stack.push_many(range(5))
+        for i in range(5, 10):
+            stack.push(i)
+        with self.subTest("peek"):
+            self.assertEqual(9, stack.peek())
+            self.assertEqual(stack.top_uid(), stack.info_top().uid)
+        with self.subTest("LIFO"):
+            self.assertEqual(list(range(9, -1, -1)), [stack.pop() for _ in range(10)])
+            self.assertIsNone(stack.pop())
+
+    def test_scan_and_counts(self):
+        self._jinbase.kv.update({i: i for i in range(10)})
+        self._jinbase.depot.extend(range(5))
+        self._jinbase.queue.enqueue_many(range(4))
+        self._jinbase.stack.push_many(range(3))
+        r = self._jinbase.scan()
+        with self.subTest("scan"):
+            self.assertEqual(10, r[Model.KV][0])
+            self.assertEqual(5, r[Model.DEPOT][0])
+            self.assertEqual(4, r[Model.QUEUE][0])
+            self.assertEqual(3, r[Model.STACK][0])
+        with self.subTest("count_records"):
+            self.assertEqual(22, self._jinbase.count_records())
+        with self.subTest("count_bytes"):
+            expected = sum(shard.count_bytes() for shard in self._jinbase.shards)
+            self.assertEqual(expected, self._jinbase.count_bytes())
+
+    def test_parallel_writers(self):
+        kv = self._jinbase.kv
+        errors = list()
+
+        def writer(n):
+            try:
+                for i in range(50):
+                    kv.set("writer-{}-{}".format(n, i), i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=writer, args=(n, )) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(200, kv.count_records())
+
+    def test_reopen(self):
+        self._jinbase.kv.update({"key-{}".format(i): i for i in range(20)})
+        self._jinbase.close()
+        self._jinbase = ShardedJinbase(self._filenames)
+        for i in range(20):
+            self.assertEqual(i, self._jinbase.kv.get("key-{}".format(i)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 import os.path
+import time
 import unittest
 import tempfile
+import threading
 import paradict
 from datetime import datetime
 from paradict import Datatype
@@ -111,6 +113,21 @@ class TestStackStore(unittest.TestCase):
             self.assertEqual(EMPTY_USER_CARD, self._store.pop())
             self.assertEqual(0, self._store.count_records())
 
+    def test_pop_many_method(self):
+        with self.subTest("Test empty stack store"):
+            self.assertEqual(tuple(), self._store.pop_many(3))
+        self._store.push_many((10, 11, b'', EMPTY_USER_CARD, USER_CARD))
+        with self.subTest("Test LIFO order"):
+            r = self._store.pop_many(3)
+            self.assertEqual((USER_CARD, EMPTY_USER_CARD, b''), r)
+            self.assertEqual(2, self._store.count_records())
+        with self.subTest("Test zero items"):
+            self.assertEqual(tuple(), self._store.pop_many(0))
+        with self.subTest("Test more items than available"):
+            self.assertEqual((11, 10), self._store.pop_many(10))
+            self.assertEqual(0, self._store.count_records())
+            self.assertEqual(0, self._store.count_chunks())
+
     def test_peek_method(self):
         with self.subTest("Test empty stack store"):
             self.assertIsNone(self._store.peek())
@@ -250,5 +267,68 @@ class TestLargeBinaryData(unittest.TestCase):
         self.assertEqual(data, self._store.pop())
 
 
+class TestBlocking(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tempdir.name, "my.db")
+        self._jinbase = Jinbase(self._filename)
+        self._store = self._jinbase.stack
+
+    def tearDown(self):
+        self._jinbase.close()
+        try:
+            self._tempdir.cleanup()
+        except Exception as e:
+            pass
+
+    def _pop_in_thread(self, **kwargs):
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.append(self._store.pop(**kwargs)))
+        thread.start()
+        return thread, results
+
+    def test_timeout(self):
+        start = time.monotonic()
+        self.assertEqual("empty", self._store.pop("empty", block=True,
+                                                  timeout=0.1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(tuple(), self._store.pop_many(2, block=True,
+                                                       timeout=0.05))
+
+    def test_item_available(self):
+        self._store.push(42)
+        self.assertEqual(42, self._store.pop(block=True, timeout=0))
+
+    def test_local_producer(self):
+        thread, results = self._pop_in_thread(block=True, timeout=5)
+        time.sleep(0.05)
+        start = time.monotonic()
+        self._store.push(USER_CARD)
+        thread.join()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([USER_CARD], results)
+
+    def test_producer_of_other_connection(self):
+        thread, results = self._pop_in_thread(block=True, timeout=5)
+        time.sleep(0.05)
+        with Jinbase(self._filename) as jinbase:
+            jinbase.stack.push(USER_CARD)
+        thread.join()
+        self.assertEqual([USER_CARD], results)
+
+    def test_pop_many_method(self):
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.append(self._store.pop_many(5, block=True,
+                                                               timeout=5)))
+        thread.start()
+        time.sleep(0.05)
+        self._store.push_many((1, 2, 3))
+        thread.join()
+        self.assertEqual([(3, 2, 1)], results)
+
+
 if __name__ == "__main__":
     unittest.main()